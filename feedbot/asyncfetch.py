@@ -0,0 +1,585 @@
+""" Contains the AsyncFetcher, which downloads many feed documents at once on a single thread. """
+
+from __future__ import absolute_import
+import asyncore
+from collections import deque
+import errno
+import socket
+import ssl
+import sys
+import threading
+import time
+import urlparse
+
+from . import exceptions
+from .download import (
+    USER_AGENT,
+    Download,
+)
+
+
+MAX_REDIRECTS = 5
+REDIRECT_CODES = frozenset([301, 302, 303, 307, 308])
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class AsyncFetcher(object):
+    """
+    Downloads many feed documents at once, on the calling thread.
+
+    All the downloads of a `fetch` share one asyncore event loop, so a single
+    thread can keep thousands of requests in flight, where the threaded
+    fetch stage needs a thread, and its stack, for each one. Requests speak
+    HTTP/1.1 and send the same headers as `feedbot.download.download`.
+
+    Connections are limited to `per_host` per server, and a connection is
+    reused for the next request to its server once a response is read. Idle
+    connections are kept for up to `keepalive` seconds, so the next `fetch`
+    can reuse them too. A request which fails on a reused connection before
+    any response arrives, because the server closed it in the meantime, is
+    retried once on a new connection.
+
+    Each request has `timeout` seconds from the moment it is sent. Requests
+    waiting for a free connection are not penalized for waiting.
+
+    Note:
+        Host names are resolved with the blocking `socket.getaddrinfo`, once
+        per server per `fetch`.
+
+    Args:
+        per_host (int): The most connections to open to one server at once.
+        timeout (float): Seconds a single request may take.
+        keepalive (float): Seconds to keep an idle connection open.
+        max_connections (int): The most connections to open in total.
+    """
+    def __init__(self, per_host=2, timeout=30, keepalive=15, max_connections=256):
+        self.per_host = max(1, per_host)
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.max_connections = max(1, max_connections)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '{0}(per_host={1}, timeout={2})'.format(type(self).__name__, self.per_host, self.timeout)
+
+    def fetch(self, requests):
+        """
+        Download some feed documents.
+
+        Args:
+            requests: An iterable of `(url, etag, modified)` tuples. The ETag
+            and Last-Modified validators may be None.
+
+        Returns:
+            A list with, for each request and in the same order, either a
+            `feedbot.download.Download` or the FeedDataError which stopped it.
+        """
+        return _Batch(self, list(requests)).run()
+
+    def close(self):
+        """ Close every idle connection. """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _checkout(self, key):
+        """ Return an idle connection to a server, or None if there isn't a fresh one. """
+        with self._lock:
+            connections = self._idle.get(key, [])
+            while connections:
+                connection = connections.pop()
+                if time.time() - connection.idle_since < self.keepalive:
+                    return connection
+                connection.close()
+        return None
+
+    def _checkin(self, connection):
+        """ Keep an idle connection for a later `fetch`. """
+        connection.idle_since = time.time()
+        with self._lock:
+            self._idle.setdefault(connection.key, []).append(connection)
+
+
+class _Request(object):
+    """ One document to download, and how far downloading it has got. """
+    __slots__ = ('index', 'url', 'etag', 'modified', 'key', 'path', 'host_header', 'redirects', 'retried', 'deadline')
+
+    def __init__(self, index, url, etag=None, modified=None):
+        self.index = index
+        self.etag = etag
+        self.modified = modified
+        self.redirects = 0
+        self.retried = False
+        self.deadline = None
+        self.set_url(url)
+
+    def set_url(self, url):
+        """
+        Point the request at a URL.
+
+        Raises:
+            FeedDataError: If the URL isn't an http or https URL.
+        """
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in DEFAULT_PORTS or not parts.hostname:
+            raise exceptions.FeedDataError("Unsupported URL: {0}".format(url))
+        port = parts.port or DEFAULT_PORTS[parts.scheme]
+        self.url = url
+        self.key = (parts.scheme, parts.hostname, port)
+        self.path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        self.host_header = parts.hostname if port == DEFAULT_PORTS[parts.scheme] else '{0}:{1}'.format(parts.hostname, port)
+
+    def to_bytes(self):
+        """ Return the HTTP request to send. """
+        lines = [
+            'GET {0} HTTP/1.1'.format(self.path),
+            'Host: {0}'.format(self.host_header),
+            'User-Agent: {0}'.format(USER_AGENT),
+            'Accept-Encoding: gzip, deflate',
+            'Connection: keep-alive']
+        if self.etag:
+            lines.append('If-None-Match: {0}'.format(self.etag))
+        if self.modified:
+            lines.append('If-Modified-Since: {0}'.format(self.modified))
+        request = '\r\n'.join(lines) + '\r\n\r\n'
+        if isinstance(request, unicode):
+            request = request.encode('utf-8')
+        return request
+
+
+class _Batch(object):
+    """ The state of one `AsyncFetcher.fetch`: its queues, connections and event loop. """
+    def __init__(self, fetcher, requests):
+        self.fetcher = fetcher
+        self.map = {}
+        self.results = [None] * len(requests)
+        self.outstanding = len(requests)
+        self.pending = {}
+        self.connections = {}
+        self.busy = set()
+        self.addresses = {}
+        for index, (url, etag, modified) in enumerate(requests):
+            try:
+                self.enqueue(_Request(index, url, etag, modified))
+            except exceptions.FeedDataError as error:
+                self.finish(index, error)
+
+    def run(self):
+        """ Run the event loop until every request has a result. """
+        try:
+            while self.outstanding:
+                self.dispatch()
+                asyncore.loop(timeout=self.poll_timeout(), map=self.map, use_poll=True, count=1)
+                self.expire()
+        finally:
+            for connection in self.map.values():
+                if connection.request is None and connection.connected:
+                    connection.del_channel()
+                    self.fetcher._checkin(connection)
+                else:
+                    connection.close()
+        return self.results
+
+    def enqueue(self, request, first=False):
+        queue = self.pending.setdefault(request.key, deque())
+        if first:
+            queue.appendleft(request)
+        else:
+            queue.append(request)
+
+    def dispatch(self):
+        """ Start as many queued requests as the connection limits allow. """
+        for key, queue in self.pending.items():
+            connections = self.connections.setdefault(key, set())
+            while queue:
+                connection = self.idle_connection(key)
+                if connection is None:
+                    if len(connections) >= self.fetcher.per_host or len(self.map) >= self.fetcher.max_connections:
+                        break
+                    request = queue[0]
+                    try:
+                        connection = _Connection(self, key, self.resolve(key))
+                    except (socket.error, ssl.SSLError) as error:
+                        queue.popleft()
+                        self.finish(request.index, error)
+                        continue
+                    connections.add(connection)
+                connection.start(queue.popleft())
+            if not queue:
+                del self.pending[key]
+
+    def idle_connection(self, key):
+        """ Return an idle connection to a server, from this batch or an earlier one. """
+        for connection in self.connections.get(key, ()):
+            if connection.request is None and connection.connected:
+                return connection
+        connection = self.fetcher._checkout(key)
+        if connection is not None:
+            connection.adopt(self)
+            self.connections[key].add(connection)
+        return connection
+
+    def resolve(self, key):
+        """ Return the socket family and address of a server. """
+        if key not in self.addresses:
+            _, host, port = key
+            family, _, _, _, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            self.addresses[key] = (family, address)
+        return self.addresses[key]
+
+    def poll_timeout(self):
+        """ Return how long the event loop may wait before a request times out. """
+        deadlines = [connection.request.deadline for connection in self.busy]
+        if not deadlines:
+            return 0.1
+        return max(0, min(1.0, min(deadlines) - time.time()))
+
+    def expire(self):
+        """ Fail the requests which have run out of time. """
+        now = time.time()
+        for connection in list(self.busy):
+            if connection.request.deadline <= now:
+                error = exceptions.FeedDataError("Timed out after {0} seconds.".format(self.fetcher.timeout))
+                connection.fail(error, retry=False)
+
+    def discard(self, connection):
+        self.busy.discard(connection)
+        self.connections.get(connection.key, set()).discard(connection)
+
+    def response_received(self, request, parser):
+        """ Record the result of a request, or follow its redirect. """
+        status, headers = parser.status, parser.headers
+        if status in REDIRECT_CODES and 'location' in headers:
+            if request.redirects >= MAX_REDIRECTS:
+                self.finish(request.index, exceptions.FeedDataError("Too many redirects."))
+                return
+            request.redirects += 1
+            try:
+                request.set_url(urlparse.urljoin(request.url, headers['location']))
+            except exceptions.FeedDataError as error:
+                self.finish(request.index, error)
+                return
+            self.enqueue(request, first=True)
+        elif status == 304:
+            self.finish(request.index, Download(304, '', headers))
+        elif 200 <= status < 300:
+            headers['content-location'] = request.url
+            self.finish(request.index, Download(status, parser.body, headers))
+        else:
+            self.finish(request.index, exceptions.FeedDataError("HTTP Error {0}: {1}".format(status, parser.reason)))
+
+    def request_failed(self, request, error, retry):
+        """ Retry a request on a new connection, or record its error. """
+        if retry and not request.retried:
+            request.retried = True
+            self.enqueue(request, first=True)
+        else:
+            self.finish(request.index, error)
+
+    def finish(self, index, result):
+        """ Record the result of the request at `index`: a Download or an exception. """
+        if isinstance(result, Exception) and not isinstance(result, exceptions.FeedDataError):
+            result = exceptions.FeedDataError(str(result))
+        self.results[index] = result
+        self.outstanding -= 1
+
+
+class _Connection(asyncore.dispatcher, object):
+    """ A keep-alive connection to one server, running one request at a time. """
+    # Mixing in object makes this a new-style class. Old-style dispatchers pass
+    # __hash__ through to their socket, which changes when TLS is started.
+    def __init__(self, batch, key, address):
+        asyncore.dispatcher.__init__(self, map=batch.map)
+        self.batch = batch
+        self.key = key
+        self.request = None
+        self.idle_since = None
+        self._parser = None
+        self._out = ''
+        self._received = False
+        self._served = 0
+        self._handshaking = False
+        self._want_write = False
+        family, sockaddr = address
+        self.create_socket(family, socket.SOCK_STREAM)
+        self.connect(sockaddr)
+
+    def adopt(self, batch):
+        """ Move an idle connection into the event loop of another batch. """
+        self.batch = batch
+        self._map = batch.map
+        # del_channel forgot the file descriptor when the connection went idle.
+        self._fileno = self.socket.fileno()
+        self.add_channel()
+
+    def start(self, request):
+        """ Send a request on this connection. """
+        request.deadline = time.time() + self.batch.fetcher.timeout
+        self.request = request
+        self._parser = _ResponseParser()
+        self._out = request.to_bytes()
+        self._received = False
+        self.batch.busy.add(self)
+
+    def handle_connect(self):
+        scheme, host, _ = self.key
+        if scheme == 'https':
+            context = ssl.create_default_context()
+            self.socket = context.wrap_socket(self.socket, server_hostname=host, do_handshake_on_connect=False)
+            self._handshaking = True
+            self._handshake()
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self._want_write = False
+            return
+        except ssl.SSLWantWriteError:
+            self._want_write = True
+            return
+        self._handshaking = False
+        self._want_write = False
+
+    def writable(self):
+        if not self.connected:
+            return True
+        if self._handshaking:
+            return self._want_write
+        return bool(self._out)
+
+    def handle_write(self):
+        if self.socket is None or not self.connected:
+            return
+        if self._handshaking:
+            self._handshake()
+            return
+        if not self._out:
+            return
+        try:
+            sent = self.socket.send(self._out)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error as error:
+            if error.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            raise
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        if self.socket is None or not self.connected:
+            return
+        if self._handshaking:
+            self._handshake()
+            return
+        data, closed = self._recv()
+        if self.request is None:
+            # The server closed an idle connection, or sent something unasked for.
+            if data or closed:
+                self.close()
+            return
+        if data:
+            self._received = True
+            self._parser.feed(data)
+        if closed and not self._parser.done:
+            self._parser.feed_eof()
+        if self._parser.done:
+            self._response_done()
+        elif closed:
+            self.fail(socket.error(errno.ECONNRESET, "Connection closed before the response was complete"))
+
+    def _recv(self):
+        """ Read everything available. Returns the data and whether the server closed the connection. """
+        chunks = []
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except socket.error as error:
+                if error.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                raise
+            if not data:
+                return ''.join(chunks), True
+            chunks.append(data)
+            # TLS can hold decrypted data which poll() doesn't know about.
+            if not (isinstance(self.socket, ssl.SSLSocket) and self.socket.pending()):
+                break
+        return ''.join(chunks), False
+
+    def _response_done(self):
+        request, parser = self.request, self._parser
+        self.request = self._parser = None
+        self.batch.busy.discard(self)
+        self._served += 1
+        if not parser.keep_alive:
+            self.close()
+        self.batch.response_received(request, parser)
+
+    def fail(self, error, retry=None):
+        """ Close the connection and fail or retry its request. """
+        request = self.request
+        self.close()
+        if request is not None:
+            if retry is None:
+                # A reused connection may have been closed by the server while idle.
+                retry = self._served > 0 and not self._received
+            self.batch.request_failed(request, error, retry)
+
+    def handle_close(self):
+        if self.request is not None and self._parser is not None and not self._parser.done:
+            try:
+                self._parser.feed_eof()
+            except exceptions.FeedDataError as error:
+                self.fail(error)
+                return
+            if self._parser.done:
+                self._response_done()
+                return
+        self.fail(socket.error(errno.ECONNRESET, "Connection closed"))
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def close(self):
+        self.request = None
+        self.batch.discard(self)
+        if self.socket is not None:
+            asyncore.dispatcher.close(self)
+            self.socket = None
+        self.connected = False
+
+
+class _ResponseParser(object):
+    """ Incrementally parses an HTTP/1.x response. """
+    def __init__(self):
+        self.status = None
+        self.reason = None
+        self.headers = {}
+        self.keep_alive = False
+        self.done = False
+        self._buffer = ''
+        self._body = []
+        self._state = 'head'
+        self._remaining = 0
+
+    @property
+    def body(self):
+        return ''.join(self._body)
+
+    def feed(self, data):
+        """
+        Parse some more of the response.
+
+        Raises:
+            FeedDataError: If the response is malformed.
+        """
+        self._buffer += data
+        while not self.done:
+            if self._state == 'head':
+                progressed = self._parse_head()
+            elif self._state == 'length':
+                progressed = self._parse_length()
+            elif self._state == 'chunk_size':
+                progressed = self._parse_chunk_size()
+            elif self._state == 'chunk_data':
+                progressed = self._parse_chunk_data()
+            elif self._state == 'trailer':
+                progressed = self._parse_trailer()
+            else:
+                self._body.append(self._buffer)
+                self._buffer = ''
+                progressed = False
+            if not progressed:
+                break
+
+    def feed_eof(self):
+        """ The server closed the connection. """
+        if self._state == 'close':
+            self.done = True
+
+    def _parse_head(self):
+        end = self._buffer.find('\r\n\r\n')
+        if end < 0:
+            return False
+        head, self._buffer = self._buffer[:end], self._buffer[end + 4:]
+        lines = head.split('\r\n')
+        status_line = lines[0].split(None, 2)
+        try:
+            version, self.status = status_line[0], int(status_line[1])
+        except (IndexError, ValueError):
+            raise exceptions.FeedDataError("Malformed HTTP response.")
+        self.reason = status_line[2] if len(status_line) > 2 else ''
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name, value = name.strip().lower(), value.strip()
+            if name in self.headers:
+                self.headers[name] += ', ' + value
+            else:
+                self.headers[name] = value
+        connection = self.headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = 'close' not in connection
+        else:
+            self.keep_alive = 'keep-alive' in connection
+
+        if self.status in (204, 304) or 100 <= self.status < 200:
+            self.done = True
+        elif 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self._state = 'chunk_size'
+        elif 'content-length' in self.headers:
+            try:
+                self._remaining = int(self.headers['content-length'])
+            except ValueError:
+                raise exceptions.FeedDataError("Malformed Content-Length header.")
+            self._state = 'length'
+            self.done = self._remaining == 0
+        else:
+            self._state = 'close'
+            self.keep_alive = False
+        return True
+
+    def _parse_length(self):
+        if not self._buffer:
+            return False
+        data, self._buffer = self._buffer[:self._remaining], self._buffer[self._remaining:]
+        self._body.append(data)
+        self._remaining -= len(data)
+        self.done = self._remaining == 0
+        return True
+
+    def _parse_chunk_size(self):
+        end = self._buffer.find('\r\n')
+        if end < 0:
+            return False
+        line, self._buffer = self._buffer[:end], self._buffer[end + 2:]
+        try:
+            self._remaining = int(line.split(';')[0].strip(), 16)
+        except ValueError:
+            raise exceptions.FeedDataError("Malformed chunked response.")
+        self._state = 'chunk_data' if self._remaining else 'trailer'
+        return True
+
+    def _parse_chunk_data(self):
+        if len(self._buffer) < self._remaining + 2:
+            return False
+        self._body.append(self._buffer[:self._remaining])
+        self._buffer = self._buffer[self._remaining + 2:]
+        self._state = 'chunk_size'
+        return True
+
+    def _parse_trailer(self):
+        if self._buffer.startswith('\r\n'):
+            self._buffer = self._buffer[2:]
+            self.done = True
+            return True
+        end = self._buffer.find('\r\n\r\n')
+        if end < 0:
+            return False
+        self._buffer = self._buffer[end + 4:]
+        self.done = True
+        return True
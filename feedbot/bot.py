@@ -14,30 +14,116 @@ Args:
     bot_name (string): the username for the bot
     bot_password (string): the password the bot should use with the chat server.
 
+A FeedBot can serve several chatrooms at once: join each of them with
+`muc_join_room`. Every room has its own feeds, filters and story history, but
+a URL followed in several rooms is only downloaded and parsed once per poll.
+
+The FeedBot polls its feeds in the background and posts new stories as they
+appear. Each feed is polled between FEEDBOT_POLL_MIN_INTERVAL and
+FEEDBOT_POLL_MAX_INTERVAL seconds apart, depending on how often it publishes,
+and at most half its age filter window apart so that no story gets too old to
+be shown before it is fetched. Set FEEDBOT_POLLING=0 to only show stories on
+request.
+
+Feeds are downloaded on FEEDBOT_FETCH_WORKERS threads (default: 8), giving up on
+a server after FEEDBOT_FETCH_TIMEOUT seconds (default: 30), and parsed on a pool
+of FEEDBOT_PARSE_PROCESSES processes (default: one per CPU), so large fetches
+use every core. Set FEEDBOT_PARSE_PROCESSES=0 to parse on the download threads
+instead. Set FEEDBOT_FETCH_BACKEND=async to download many feeds at once on a
+single event loop instead of a thread per feed, with up to
+FEEDBOT_FETCH_PER_HOST connections to each server (default: 2).
+
+Set FEEDBOT_HTTP_CACHE_DIRECTORY to keep downloaded feed documents in an HTTP
+cache there, which several FeedBots on one host may share. Documents are reused
+while their Cache-Control or Expires headers say they are fresh, and the cache
+is kept under FEEDBOT_HTTP_CACHE_SIZE bytes (default: 64MB).
+
+A feed which fails FEEDBOT_BREAKER_THRESHOLD times in a row (default: 3) is
+skipped for FEEDBOT_BREAKER_COOLDOWN seconds (default: 300) and then tried
+again. The cool-down doubles with every further failure, up to
+FEEDBOT_BREAKER_MAX_COOLDOWN seconds (default: 21600).
+
+Stories are posted one feed per message where possible. Messages are kept under
+FEEDBOT_MAX_STANZA_SIZE bytes (default: 8000) so that the chat server accepts
+them; a feed with more to say is split between entries. Messages are queued
+and sent at up to FEEDBOT_SEND_RATE messages a second (default: 1), in bursts of
+up to FEEDBOT_SEND_BURST (default: 5). Replies to commands skip ahead of
+stories waiting to be sent.
+
+The time taken to download, parse, filter, format and send stories is kept in
+rolling histograms, which the /stats command summarizes. Set
+FEEDBOT_METRICS_FILE to also write them to that file in the Prometheus text
+format every FEEDBOT_METRICS_INTERVAL seconds (default: 60), eg: for
+node_exporter's textfile collector.
+
+Users listed in FEEDBOT_ADMINS, a comma separated list of bare JIDs, eg:
+'alice@example.com', may run `/profile <seconds>` to profile the bot with
+cProfile for a while. Admins are recognized by their real JID, never by their
+nickname: in a chatroom that only works if the room isn't anonymous. A private
+message through an anonymous room carries no real JID either, so there send the
+command as a direct message to the bot's own JID instead. The stats are saved
+to a .pstats file in the data directory and the FEEDBOT_PROFILE_TOP functions
+(default: 15) with the most cumulative time are posted to the room.
+
 In order for the FeedBot to have persistence it saves feed/filter data to a
-local flat-file via Pickle. You must define this path with the
-FEEDBOT_DATAFILE_PATH, setting or suffer the consequences! (The consequences
-are you'll lose your feeds when the bot exits.)
+local flat-file in FEEDBOT_DATA_DIRECTORY (default: ~/.feedbot), named by
+FEEDBOT_DATA_FILENAME. Set FEEDBOT_STORAGE=sqlite to keep feeds, filters, the
+story history and fetch statistics in an SQLite database there instead. The
+data of rooms other than `chatroom` is kept in `rooms/<room>` beneath it.
 
  """
 
 from __future__ import absolute_import
-from collections import deque
-from datetime import datetime
-import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
 import logging
+import multiprocessing
 import os
+import sqlite3
+import time
 
-import humanize
 from jabberbot import (
     JabberBot,
     botcmd
 )
-from pytz import utc
+from xmpp import JID
 
 from . import exceptions
 from . import messages
+from . import metrics
+from . import outbox
+from .asyncfetch import AsyncFetcher
+from .breaker import CircuitBreaker
+from .download import Download
 from .feed import Feed
+from .fetch import (
+    BackgroundExecutor,
+    FetchResult,
+    fetch_feeds,
+)
+from .history import (
+    EntryHistory,
+    entry_key,
+)
+from .httpcache import HttpCache
+from .profiling import (
+    ProfileSession,
+    save_and_summarize,
+)
+from .render import EntryRenderer
+from .room import Room
+from .scheduler import PollScheduler
+from .sqlite_storage import SqliteFeedStore
+from .storage import JsonFeedStore
+from .timeutils import (
+    pub_time_to_string,
+    struct_to_datetime,
+    time_delta_from_now,
+    time_until,
+    utc_now,
+)
 from .filters import (
     ALLOWED_FILTER_TYPES,
     AgeFilter,
@@ -46,6 +132,22 @@ from .filters import (
 
 logger = logging.getLogger(__name__)
 
+# The longest /profile allowed, in seconds.
+MAX_PROFILE_SECONDS = 600
+
+# The stages /stats summarizes, for every feed and for one feed.
+STATS_STAGES = ('fetch_seconds', 'fetch_batch_seconds', 'parse_seconds', 'filter_seconds', 'render_seconds',
+                'send_delay_seconds', 'send_seconds')
+STATS_FEED_STAGES = ('fetch_seconds', 'parse_seconds', 'filter_seconds', 'render_seconds')
+
+# The response Feeds which share another Feed's entries are filtered with, see `Feed.share_entries`.
+SHARED_RESPONSE = Download(304, '', {})
+
+
+def _room_attribute(name):
+    """ Return a property which reads and writes an attribute of the room being served. """
+    return property(lambda self: getattr(self.room, name), lambda self, value: setattr(self.room, name, value))
+
 
 class FeedBot(JabberBot):
     """ A JabberBot to monitor RSS/Atom feeds. """
@@ -56,44 +158,231 @@ class FeedBot(JabberBot):
         if 'command_prefix' not in kwargs:
             kwargs['command_prefix'] = '/'
         super(FeedBot, self).__init__(bot_name, bot_password, *args, **kwargs)
+        self.outbox = outbox.Outbox(
+            rate=float(os.getenv('FEEDBOT_SEND_RATE', 1)),
+            burst=int(os.getenv('FEEDBOT_SEND_BURST', 5)))
+        self.rooms = OrderedDict()
+        self.room = self.rooms[chatroom] = Room(chatroom)
         self._init_data_dir()
-        self.feeds = self._load_feed_data()
-        queue_length = int(os.getenv('FEED_HISTORY_QUEUE_LENGTH', 200))
-        self.entry_history = deque(maxlen=queue_length)
+        self.max_stanza_size = int(os.getenv('FEEDBOT_MAX_STANZA_SIZE', 8000))
+        self.entry_renderer = EntryRenderer(maxlen=int(os.getenv('FEEDBOT_RENDER_CACHE_SIZE', 500)))
+        self.save_delay = float(os.getenv('FEEDBOT_SAVE_DELAY', 2))
+        self.fetch_workers = int(os.getenv('FEEDBOT_FETCH_WORKERS', 8))
+        self.fetch_timeout = float(os.getenv('FEEDBOT_FETCH_TIMEOUT', 30))
+        self.executor = BackgroundExecutor(workers=self.fetch_workers)
+        self.http_cache = None
+        if os.getenv('FEEDBOT_HTTP_CACHE_DIRECTORY'):
+            self.http_cache = HttpCache(
+                os.getenv('FEEDBOT_HTTP_CACHE_DIRECTORY'),
+                max_size=int(os.getenv('FEEDBOT_HTTP_CACHE_SIZE', 64 * 1024 * 1024)),
+                timeout=self.fetch_timeout)
+        self.parse_processes = int(os.getenv('FEEDBOT_PARSE_PROCESSES', multiprocessing.cpu_count()))
+        self._parse_pool = None
+        self.async_fetcher = None
+        if os.getenv('FEEDBOT_FETCH_BACKEND', 'threads') == 'async':
+            self.async_fetcher = AsyncFetcher(
+                per_host=int(os.getenv('FEEDBOT_FETCH_PER_HOST', 2)),
+                timeout=self.fetch_timeout)
+        self.breaker = CircuitBreaker(
+            threshold=int(os.getenv('FEEDBOT_BREAKER_THRESHOLD', 3)),
+            cooldown=float(os.getenv('FEEDBOT_BREAKER_COOLDOWN', 300)),
+            max_cooldown=float(os.getenv('FEEDBOT_BREAKER_MAX_COOLDOWN', 21600)))
+        self.metrics_file = os.getenv('FEEDBOT_METRICS_FILE')
+        self.metrics_interval = float(os.getenv('FEEDBOT_METRICS_INTERVAL', 60))
+        self._metrics_due = time.time()
+        self.admins = set(name.strip() for name in os.getenv('FEEDBOT_ADMINS', '').split(',') if name.strip())
+        self.profile_top = int(os.getenv('FEEDBOT_PROFILE_TOP', 15))
+        self.profile_session = None
+        self._profile_finished = None
+        self.polling = os.getenv('FEEDBOT_POLLING', '1') != '0'
+        self._load_room()
 
     def __repr__(self):
         return "{0}({1}, {2})".format(type(self).__name__, self.chatroom, self.bot_name)
 
+    # The state of the chatroom being served, see `_serving`.
+    data_file = _room_attribute('data_file')
+    feeds = _room_attribute('feeds')
+    feed_store = _room_attribute('feed_store')
+    entry_history = _room_attribute('entry_history')
+    poller = _room_attribute('poller')
+    _save_due = _room_attribute('save_due')
+    _polls_in_flight = _room_attribute('polls_in_flight')
+
+    def _load_room(self):
+        """ Load the feeds and history of the room being served, and start polling its Feeds. """
+        self.feeds = self._load_feed_data()
+        self.entry_history = self._load_entry_history()
+        self.poller = PollScheduler(
+            min_interval=float(os.getenv('FEEDBOT_POLL_MIN_INTERVAL', 300)),
+            max_interval=float(os.getenv('FEEDBOT_POLL_MAX_INTERVAL', 21600)))
+        for feed_name in self.feeds:
+            self.poller.schedule(feed_name)
+
+    @contextmanager
+    def _serving(self, room):
+        """ Make `room` the room which commands act on and messages are sent to, for a while. """
+        previous, self.room = self.room, room
+        try:
+            yield room
+        finally:
+            self.room = previous
+
+    def _in_room(self, callback):
+        """ Wrap a background work callback so that it runs in the room being served now. """
+        room = self.room
+
+        def callback_in_room(*args):
+            with self._serving(room):
+                return callback(*args)
+        return callback_in_room
+
+    def _room_for(self, mess):
+        """ Return the Room a message was sent in. Private messages are served in the first room. """
+        if mess and mess.getType() == 'groupchat':
+            room = self.rooms.get(mess.getFrom().getStripped())
+            if room is not None:
+                return room
+        return self.rooms[self.chatroom]
+
+    def callback_message(self, conn, mess):
+        """ Run commands in the room they were sent from. """
+        with self._serving(self._room_for(mess)), self._profiling():
+            super(FeedBot, self).callback_message(conn, mess)
+
+    @contextmanager
+    def _profiling(self):
+        """ Profile a block of code on the bot's thread, if a /profile is running. """
+        session = self.profile_session
+        if session is None:
+            yield
+        else:
+            with session.on_bot_thread():
+                yield
+
+    def _submit(self, func, callback, *args):
+        """ Run work in the background, see `BackgroundExecutor.submit`. It is profiled if a /profile is running. """
+        if self.profile_session is not None:
+            func, args = self.profile_session.call, (func,) + args
+        self.executor.submit(func, callback, *args)
+
+    def callback_presence(self, conn, presence):
+        """ Keep track of the real JIDs of the occupants of the rooms being served. """
+        sender = presence.getFrom()
+        room = self.rooms.get(sender.getStripped())
+        if room is not None:
+            nickname = sender.getResource()
+            jid = presence.getJid()
+            if presence.getType() == 'unavailable' or not jid:
+                room.occupants.pop(nickname, None)
+            else:
+                room.occupants[nickname] = JID(jid).getStripped()
+        super(FeedBot, self).callback_presence(conn, presence)
+
+    def muc_join_room(self, room, *args, **kwargs):
+        """
+        Join a chatroom and start serving it.
+
+        Rooms other than the first keep their data in a directory of their own,
+        `rooms/<room>` in the first room's data directory.
+        """
+        if room not in self.rooms:
+            data_dir = os.path.join(os.path.dirname(self.rooms[self.chatroom].data_file), 'rooms', room)
+            self.rooms[room] = Room(room)
+            with self._serving(self.rooms[room]):
+                self._create_data_file(data_dir)
+                self._load_room()
+        super(FeedBot, self).muc_join_room(room, *args, **kwargs)
+
+    def muc_part_room(self, room, *args, **kwargs):
+        """ Leave a chatroom, saving its feeds and history. The first room is always served. """
+        super(FeedBot, self).muc_part_room(room, *args, **kwargs)
+        if room != self.chatroom and room in self.rooms:
+            with self._serving(self.rooms.pop(room)):
+                self._close_room()
+
+    def _close_room(self):
+        """ Save and close the feeds and history of the room being served. """
+        self._flush_feed_data(force=True)
+        self.entry_history.close()
+        self.feed_store.close()
+
     def _add_entry_to_history(self, entry):
         """ Track an entry that has already been displayed. """
-        if entry.link not in self.entry_history:
-            self.entry_history.append(entry.link)
+        key = entry_key(entry)
+        if key is not None:
+            self.entry_history.add(key)
 
-    def _seen_entry(self, entry):
-        """ Has an entry been displayed? """
-        return entry.link in self.entry_history
+    def _seen_entry(self, entry, room=None):
+        """
+        Has an entry been displayed in a room, by default the room being served?
+
+        Entries with neither an id nor a link can't be told apart, so they
+        count as seen and are never displayed.
+        """
+        key = entry_key(entry)
+        if key is None:
+            return True
+        history = (room or self.room).entry_history
+        # Histories kept before entries were keyed on their id hold links.
+        return key in history or (entry.get('link') is not None and entry.get('link') in history)
 
     def _load_feed_data(self):
         """
-        Attempt to load the feed data from a storage file and unpickle it.
+        Attempt to load the feed data from a storage file and replay its journal.
 
         Note:
             If any exceptions are raised in this method they are caught, a standard
             error message is sent to the channel, and the bot initializes itself
             without restoring any saved state.
         """
+        self.feed_store = self._open_feed_store()
         feeds = {}
         try:
-            with open(self.data_file, 'r') as data_file:
-                serialized_feed_data = json.load(data_file)
-                for feed_data in serialized_feed_data:
-                    deserialized_feed = Feed.from_dict(feed_data)
-                    feeds[deserialized_feed.name] = deserialized_feed
+            feeds = self.feed_store.load()
         except:  # We never want to blow up on instantiating the bot.
             message = messages.FEED_DATA_LOAD_ERROR.format(path=self.data_file)
             self.send_groupchat_message(message)
+        if self.feed_store.needs_compaction():
+            self._save_due = time.time() + self.save_delay
         return feeds
 
+    def _open_feed_store(self):
+        """
+        Return the store which the feed data is saved to.
+
+        Feeds are kept in the JSON data file unless FEEDBOT_STORAGE is set to
+        `sqlite`, in which case they are kept in FEEDBOT_SQLITE_FILENAME next
+        to the data file. The first time the SQLite store is used, it imports
+        the feeds and history of the JSON store.
+        """
+        data_dir = os.path.dirname(self.data_file)
+        history_path = os.path.join(data_dir, os.getenv('FEEDBOT_HISTORY_FILENAME', 'feedbot.history'))
+        if os.getenv('FEEDBOT_STORAGE', 'json').lower() == 'sqlite':
+            sqlite_path = os.path.join(data_dir, os.getenv('FEEDBOT_SQLITE_FILENAME', 'feedbot.sqlite'))
+            try:
+                return SqliteFeedStore(sqlite_path, import_path=self.data_file, import_history_path=history_path)
+            except sqlite3.Error:
+                self.send_groupchat_message(messages.FEED_DATA_LOAD_ERROR.format(path=sqlite_path))
+        compact_threshold = int(os.getenv('FEEDBOT_JOURNAL_COMPACT_THRESHOLD', 500))
+        return JsonFeedStore(self.data_file, history_path=history_path, compact_threshold=compact_threshold)
+
+    def _load_entry_history(self):
+        """
+        Load the history of displayed entries from the feed store.
+
+        Note:
+            If the history can't be loaded, a standard error message is sent to
+            the channel and the bot starts with an empty, in-memory history.
+        """
+        queue_length = int(os.getenv('FEED_HISTORY_QUEUE_LENGTH', 200))
+        try:
+            return self.feed_store.open_history(queue_length)
+        except (IOError, OSError, sqlite3.Error):
+            history_path = getattr(self.feed_store, 'history_path', self.feed_store.path)
+            self.send_groupchat_message(messages.HISTORY_LOAD_ERROR.format(path=history_path))
+            return EntryHistory(maxlen=queue_length)
+
     def _init_data_dir(self):
         """ Ensure the data directory exists and set self.data_file. """
         user_defined_data_dir = os.getenv('FEEDBOT_DATA_DIRECTORY')
@@ -117,31 +406,64 @@ class FeedBot(JabberBot):
             open(data_file, 'a').close()
         self.data_file = data_file
 
-    def _save_feed_data(self):
+    def _save_feed_data(self, operation, **change):
         """
-        Attempt to pickle and save the feed data to a storage file.
+        Record a change to the feed data, eg: `_save_feed_data('remove_feed', name='foo')`.
+
+        The change is appended to the journal of the storage file. Once the
+        journal is long enough a compaction is scheduled FEEDBOT_SAVE_DELAY
+        seconds later, see `_flush_feed_data`.
 
         Note:
             If any exceptions are raised in this method they are caught, a standard
-            error message is sent to the channel, and an IOError is raised.
+            error message is sent to the channel, and an IOError is raised, so
+            that commands don't go on to confirm the change.
         """
         try:
-            feed_data = [feed.to_dict() for feed in self.feeds.values()]
-            with open(self.data_file, 'r+') as data_file:
-                data_file.write(json.dumps(feed_data))
-                return True
+            self.feed_store.record(operation, **change)
         except Exception as exception:
-            error = getattr(exception, 'message', '')
-            message = messages.FEED_SAVE_DATA_ERROR.format(
-                error=error,
-                data_path=self.data_file
-            )
-            self.send_groupchat_message(message)
-            raise IOError()
+            self._report_save_error(exception)
+            raise IOError(str(exception))
+        if self.feed_store.needs_compaction() and self._save_due is None:
+            self._save_due = time.time() + self.save_delay
+
+    def _flush_feed_data(self, force=False):
+        """
+        Compact the storage file's journal if a compaction is due, or pending
+        at all when `force` is set.
+
+        The compaction is started here, but the snapshot is written by the
+        background executor unless `force` is set.
+        """
+        if self._save_due is None or not (force or time.time() >= self._save_due):
+            return
+        self._save_due = None
+        try:
+            compact = self.feed_store.start_compaction(self.feeds.values())
+            if force:
+                compact()
+            else:
+                self._submit(compact, self._in_room(self._feed_data_compacted))
+        except Exception as exception:
+            self._report_save_error(exception)
+
+    def _feed_data_compacted(self, result, error):
+        """ Report the outcome of a background compaction. """
+        if error is not None:
+            self._report_save_error(error)
+
+    def _report_save_error(self, exception):
+        """ Send a standard error message about failing to save the feed data. """
+        error = getattr(exception, 'message', '') or str(exception)
+        message = messages.FEED_SAVE_DATA_ERROR.format(
+            error=error,
+            data_path=self.data_file
+        )
+        self.send_groupchat_message(message)
 
     def get_feed_urls(self):
         """ Return URLs of Feeds. """
-        return [feed.url for feed in self.feeds.values()]
+        return self.feeds.urls()
 
     @botcmd
     def add_feed(self, msg, args):
@@ -150,39 +472,52 @@ class FeedBot(JabberBot):
 
         Feed name should not contain whitespace and URLs must be unique.
         example usage: '/add_feed seclist http://www.seclist.org/rss/list.rss'
-        Feeds are checked at the time they are added to make sure they are valid.
-
-        Raises:
-            FeedDataError: If there is an error parsing the feed.
+        Feeds are checked in the background before they are added to make sure
+        they are valid.
         """
         try:
+            name, url = clean_args(args)
+        except ValueError:
             try:
-                name, url = clean_args(args)
-            except ValueError:
                 # If the user omits 'http://' from the url, jabberbot passes
                 # three args rather than two, we don't care about the third one.
                 name, url, _ = clean_args(args)
                 url = 'http://' + url
+            except ValueError:
+                self.send_groupchat_message(messages.FEED_ADD_HELP)
+                return
 
-            valid_name_url = not (name in self.feeds or url in self.get_feed_urls())
-            if valid_name_url:
-                date_filter = AgeFilter(minutes=90)
-                feed = Feed(name=name, url=url, filters=[date_filter])
-                # get the unfiltered feed once to make sure it's good:
-                feed.get_raw_feed()
-                self.feeds[name] = feed
-                self._save_feed_data()
-                self.send_groupchat_message(messages.OKAY)
-            else:
-                message = messages.FEED_EXISTS_ERROR.format(name=name, url=url)
-                self.send_groupchat_message(message)
-        except ValueError:
-            self.send_groupchat_message(messages.FEED_ADD_HELP)
-        except IOError:
-            pass
-        except exceptions.FeedDataError as e:
-            message = messages.FEED_PARSE_ERROR.format(error=e.message)
+        if self._feed_exists(name, url):
+            message = messages.FEED_EXISTS_ERROR.format(name=name, url=url)
+            self.send_groupchat_message(message)
+            return
+
+        date_filter = AgeFilter(minutes=90)
+        feed = Feed(name=name, url=url, filters=[date_filter])
+        # get the unfiltered feed once to make sure it's good:
+        self._submit(
+            feed.get_raw_feed, self._in_room(lambda result, error: self._feed_checked(feed, error)), self.http_cache,
+            self.fetch_timeout)
+        self.send_groupchat_message(messages.CHECKING_FEED.format(url=url))
+
+    def _feed_exists(self, name, url):
+        """ Is a Feed with this name or URL, spelt any way, already being monitored? """
+        return name in self.feeds or self.feeds.get_by_url(url) is not None
+
+    def _feed_checked(self, feed, error):
+        """ Finish adding a Feed once it has been fetched in the background. """
+        if error is not None:
+            error = getattr(error, 'message', '') or str(error)
+            self.send_groupchat_message(messages.FEED_PARSE_ERROR.format(error=error))
+        elif self._feed_exists(feed.name, feed.url):
+            # Someone else added the same feed while this one was being checked.
+            message = messages.FEED_EXISTS_ERROR.format(name=feed.name, url=feed.url)
             self.send_groupchat_message(message)
+        else:
+            self.feeds[feed.name] = feed
+            self.poller.schedule(feed.name)
+            self._save_feed_data('add_feed', feed=feed.to_dict())
+            self.send_groupchat_message(messages.OKAY)
 
     @botcmd
     def list_feeds(self, msg, args):
@@ -193,6 +528,12 @@ class FeedBot(JabberBot):
             for feed in self.feeds.values():
                 message = messages.FEED_NAME_URL_TEMPLATE.format(name=feed.name, url=feed.url)
                 self.send_groupchat_message(message)
+                health = self.breaker.get_health(feed.url)
+                if health is not None:
+                    message = messages.FEED_FAILING.format(failures=health.failures, error=health.last_error)
+                    if health.retry_at is not None:
+                        message += messages.FEED_FAILING_RETRY.format(retry=time_until(health.retry_at))
+                    self.send_groupchat_message(message)
                 # If there are filters on this feed, inform the channel:
                 if not feed.get_filters():
                     continue
@@ -206,9 +547,9 @@ class FeedBot(JabberBot):
 
     def _url2name(self, url):
         """ Given a URL return the name of the Feed. """
-        for name, feed in self.feeds.items():
-            if feed.url == url:
-                return name
+        feed = self.feeds.get_by_url(url)
+        if feed is not None:
+            return feed.name
 
     @botcmd
     def remove_feed(self, msg, args):
@@ -220,22 +561,19 @@ class FeedBot(JabberBot):
         """
         feed = args.strip()
 
-        if feed in self.feeds:
-            del self.feeds[feed]
-            message = messages.FEED_DELETED.format(feed_name=feed)
-        elif feed in self.get_feed_urls():
-            feed_name = self._url2name(feed)
-            del self.feeds[feed_name]
-            message = messages.FEED_DELETED.format(feed_name=feed_name)
-        else:
+        feed_name = feed if feed in self.feeds else self._url2name(feed)
+        if feed_name is None:
             # this is an unrecognized feed
             self.send_groupchat_message(messages.FEED_REMOVE_HELP)
             return
-        try:
-            self._save_feed_data()
-            self.send_groupchat_message(message)
-        except IOError:
-            pass
+        url = self.feeds[feed_name].url
+        del self.feeds[feed_name]
+        self.poller.unschedule(feed_name)
+        if not any(room.feeds.get_by_url(url) for room in self.rooms.values()):
+            self.breaker.forget(url)
+        message = messages.FEED_DELETED.format(feed_name=feed_name)
+        self._save_feed_data('remove_feed', name=feed_name)
+        self.send_groupchat_message(message)
 
     @botcmd
     def add_filter(self, msg, args):
@@ -260,13 +598,11 @@ class FeedBot(JabberBot):
                     filter_type=filter_type,
                     filter_term=filter_term,
                     feed_name=feed_name)
-                self._save_feed_data()
+                self._save_feed_data('add_filter', name=feed_name, filter=new_filter.to_dict())
                 self.send_groupchat_message(message)
             else:
                 self.send_groupchat_message(messages.UNKNOWN_FILTER_ERROR)
 
-        except IOError:
-            pass
         except ValueError:
             self.send_groupchat_message(messages.ADD_FILTER_HELP)
         except exceptions.UnknownFeedError:
@@ -300,7 +636,7 @@ class FeedBot(JabberBot):
             if valid_filter:
                 feed_filter = feed.get_filter_by_key(filter_index)
                 feed.remove_filter(feed_filter)
-                self._save_feed_data()
+                self._save_feed_data('remove_filter', name=feed.name, index=filter_index)
                 message = messages.REMOVED_FILTER.format(filter=feed_filter, feed=feed.name)
                 del(feed_filter)
                 self.send_groupchat_message(message)
@@ -308,8 +644,6 @@ class FeedBot(JabberBot):
                 self.send_groupchat_message(messages.REMOVE_FILTER_HELP)
         except (ValueError, KeyError):
             self.send_groupchat_message(messages.REMOVE_FILTER_HELP)
-        except IOError:
-            pass
 
     @botcmd
     def dump_feed(self, msg, args):
@@ -318,6 +652,7 @@ class FeedBot(JabberBot):
 
         Use '/get_stories <feed_name> [n]' to get the first 3 or n stories.
         FeedBot does not display entries that have already been shown in channel.
+        Stories are fetched in the background and posted when they are ready.
         """
         args = clean_args(args)
         try:
@@ -327,60 +662,227 @@ class FeedBot(JabberBot):
             elif len(args) == 1:
                 feed_name, = args
                 entries_limit = int(os.environ.get('FEEDBOT_STORY_LIMIT', 5))
-
-            feed = self.feeds[feed_name]
-            feed_entries = feed.get_filtered_feed()
-            entries_limit = min(len(feed_entries), entries_limit)
-            feed_entries = feed_entries[:entries_limit]
-            unseen_entries = [entry for entry in feed_entries if not self._seen_entry(entry)]
-
-            if unseen_entries:
-                self._print_feed(feed.name, unseen_entries)
             else:
-                self.send_groupchat_message(messages.NO_NEW_ENTRIES.format(feed_name=feed.name))
+                raise ValueError()
 
+            feed = self.feeds[feed_name]
         except ValueError:
             self.send_groupchat_message(messages.SORRY)
+            return
         except KeyError:
             self.send_groupchat_message(messages.FEED_NOT_FOUND_ERROR)
+            return
 
-    def _print_feed(self, feed_name, entries):
-        """ Print a Feed to the channel. """
-        self.send_groupchat_message(messages.FEED_HEADER.format(feed_name=feed_name))
-        for entry in entries:
-            if self._seen_entry(entry):
-                continue
-            self._add_entry_to_history(entry)
-            self._print_entry(entry)
-            self.send_groupchat_message(messages.ENTRY_SEPERATOR)
-
-    def _print_entry(self, entry):
-        """ Print a Feed entry to the channel. """
-        fields = ['title', 'published', 'authors', 'link', 'summary']
-        for field in fields:
-            if field in entry:
-                if entry[field] == [{}]:
-                    continue
-                try:
-                    field_string = messages.ENTRY_FIELD_TEMPLATE.format(
-                        field_name=unicode(field.capitalize()),
-                        field_value=unicode(entry[field])
-                    )
-                except UnicodeEncodeError:
-                    continue
-                if field == 'published':
-                    time_string = pub_time_to_string(entry.published_parsed)
-                    field_string += messages.ENTRY_PUBLISHED_FIELD_TEMPLATE.format(publication_time=time_string)
+        if not self._allow_fetch(feed):
+            return
+
+        def feed_fetched(unseen_entries, error):
+            self._record_fetch_results([FetchResult(feed, unseen_entries, error)])
+            if error is not None:
+                self.send_groupchat_message(messages.FEED_FETCH_ERROR.format(feed_name=feed.name, error=error))
+            else:
+                self._save_fetch_state(feed, len(unseen_entries))
+                self._dump_entries(feed, unseen_entries)
+
+        self._submit(
+            self._get_unseen_entries, self._in_room(feed_fetched), feed, entries_limit, self._get_parse_pool(), None,
+            self.room)
+        self.send_groupchat_message(messages.FETCHING_FEEDS)
+
+    def _get_unseen_entries(self, feed, entries_limit, pool=None, response=None, room=None):
+        """
+        Return the first `entries_limit` filtered entries of a Feed which haven't been displayed.
+
+        The Feed is filtered lazily: filtering stops as soon as enough entries
+        have been found, whether or not it was parsed in a process pool.
+
+        Note:
+            This runs on the fetch threads, so the Feed's `room` must be given
+            unless it is called from the bot's thread.
+        """
+        room = room or self.room
+        filtered_entries = feed.iter_filtered_entries(
+            pool=pool, response=response, cache=self.http_cache, timeout=self.fetch_timeout)
+        unseen_entries = (entry for entry in filtered_entries if not self._seen_entry(entry, room))
+        return list(islice(unseen_entries, entries_limit))
+
+    def _fetch_unseen_entries(self, feeds, entries_limit, pool=None, rooms=None):
+        """
+        Fetch many Feeds at once, see `_get_unseen_entries`.
+
+        Each URL is only downloaded and parsed once, by the first Feed with
+        that URL. The other Feeds with that URL, which belong to other rooms,
+        share its entries and only run them through their own filters.
+
+        With the async fetch backend every URL is downloaded first, on the
+        calling thread, and then parsed on the fetch threads. URLs with a
+        fresh copy in the HTTP cache aren't downloaded at all.
+
+        Args:
+            rooms: The Room each Feed belongs to, by default the room being served.
+
+        Returns:
+            A list of `feedbot.fetch.FetchResult` in the same order as `feeds`.
+        """
+        rooms = rooms or [self.room] * len(feeds)
+        subscribers = OrderedDict()
+        for feed, room in zip(feeds, rooms):
+            subscribers.setdefault(feed.url, []).append((feed, room))
+        leaders = [group[0][0] for group in subscribers.values()]
+        responses = {}
+        if self.async_fetcher is not None:
+            responses = self._async_download(leaders)
+
+        def fetch(leader):
+            response = responses.get(leader)
+            if isinstance(response, Exception):
+                raise response
+            (_, leader_room), followers = subscribers[leader.url][0], subscribers[leader.url][1:]
+            unseen_entries = [self._get_unseen_entries(leader, entries_limit, pool, response, leader_room)]
+            for feed, room in followers:
+                feed.share_entries(leader)
+                unseen_entries.append(self._get_unseen_entries(feed, entries_limit, pool, SHARED_RESPONSE, room))
+            return unseen_entries
+
+        session = self.profile_session
+        if session is not None:
+            fetch = partial(session.call, fetch)
+
+        results = {}
+        for leader_result in fetch_feeds(leaders, self.fetch_workers, self.fetch_timeout, fetch):
+            for index, (feed, _) in enumerate(subscribers[leader_result.feed.url]):
+                if leader_result.error is not None:
+                    results[id(feed)] = FetchResult(feed, None, leader_result.error)
                 else:
-                    field_string += messages.NEWLINE
-                self.send_groupchat_message(field_string)
+                    results[id(feed)] = FetchResult(feed, leader_result.entries[index], None)
+        return [results[id(feed)] for feed in feeds]
+
+    def _async_download(self, feeds):
+        """ Download Feeds with the async fetcher, returning a dict of Feed to Download or exception. """
+        cache = self.http_cache
+        responses = {}
+        requests = []
+        for feed in feeds:
+            etag, modified = feed.request_validators()
+            cached = cache.cached_response(feed.url, etag, modified) if cache is not None else None
+            if cached is not None:
+                responses[feed] = cached
+            else:
+                requests.append((feed, etag, modified))
+        with metrics.registry.timer('fetch_batch_seconds'):
+            downloads = self.async_fetcher.fetch([
+                (feed.url,) + (cache.request_validators(feed.url, etag, modified) if cache is not None else (etag, modified))
+                for feed, etag, modified in requests
+            ])
+        for (feed, etag, modified), response in zip(requests, downloads):
+            if not isinstance(response, Exception):
+                metrics.record_response(feed.name, response)
+                if cache is not None:
+                    response = cache.handle_response(feed.url, response, etag, modified)
+            responses[feed] = response
+        return responses
+
+    def _allow_fetch(self, feed):
+        """ Return True if a Feed may be fetched now, otherwise tell the room it is being skipped. """
+        if self.breaker.allow(feed.url):
+            return True
+        health = self.breaker.get_health(feed.url)
+        message = messages.FEED_SUSPENDED.format(
+            feed_name=feed.name, failures=health.failures, retry=time_until(health.retry_at))
+        self.send_groupchat_message(message, priority=outbox.BULK)
+        return False
+
+    def _record_fetch_results(self, results):
+        """ Tell the circuit breaker which URLs could and couldn't be fetched. """
+        errors = OrderedDict()
+        for result in results:
+            errors.setdefault(result.feed.url, result.error)
+        for url, error in errors.items():
+            if error is None:
+                self.breaker.record_success(url)
+            else:
+                self.breaker.record_failure(url, error)
+
+    def _get_parse_pool(self):
+        """
+        Return the process pool Feeds are parsed in, or None if it is disabled.
+
+        The pool is started the first time it is needed, from the bot's thread.
+        """
+        if self._parse_pool is None and self.parse_processes > 0:
+            self._parse_pool = multiprocessing.Pool(self.parse_processes)
+        return self._parse_pool
+
+    def _dump_entries(self, feed, unseen_entries, footer=''):
+        """ Print a Feed's unseen entries, or tell the channel there aren't any. """
+        if unseen_entries:
+            self._print_feed(feed.name, unseen_entries, footer=footer)
+        else:
+            message = messages.NO_NEW_ENTRIES.format(feed_name=feed.name)
+            if footer:
+                message += messages.NEWLINE + footer
+            self.send_groupchat_message(message, priority=outbox.BULK)
+
+    def _print_feed(self, feed_name, entries, footer=''):
+        """ Print a Feed to the channel, followed by `footer`. """
+        parts = [messages.FEED_HEADER.format(feed_name=feed_name)]
+        with metrics.registry.timer('render_seconds', feed=feed_name):
+            for entry in entries:
+                if self._seen_entry(entry):
+                    continue
+                self._add_entry_to_history(entry)
+                parts.append(self._format_entry(entry) + messages.ENTRY_SEPERATOR)
+        if footer:
+            parts.append(footer)
+        self._send_coalesced(parts)
+
+    def _send_coalesced(self, parts):
+        """
+        Send some message parts to the channel in as few messages as possible.
+
+        Consecutive parts are joined into one message for as long as it stays
+        under `max_stanza_size` bytes. A part is never split, so a part which
+        is too big on its own is sent as a message of its own.
+        """
+        message, message_size = [], 0
+        for part in parts:
+            part_size = len(part.encode('utf-8') if isinstance(part, unicode) else part)
+            if message and message_size + part_size > self.max_stanza_size:
+                self.send_groupchat_message(''.join(message), priority=outbox.BULK)
+                message, message_size = [], 0
+            message.append(part)
+            message_size += part_size
+        if message:
+            self.send_groupchat_message(''.join(message), priority=outbox.BULK)
+
+    def _format_entry(self, entry):
+        """ Return a Feed entry formatted as one message. """
+        return self.entry_renderer.render(entry)
 
     @botcmd
     def dump_all(self, msg, args):
         """ Dump all filtered feeds into the channel. """
-        for feed in self.get_feeds():
-            self.dump_feed("", feed.name)
-            self.send_groupchat_message(messages.FEED_SEPERATOR)
+        entries_limit = int(os.environ.get('FEEDBOT_STORY_LIMIT', 5))
+        feeds = [feed for feed in sorted(self.get_feeds(), key=lambda feed: feed.name) if self._allow_fetch(feed)]
+
+        def feeds_fetched(results, error):
+            if error is not None:
+                results = [FetchResult(feed, None, error) for feed in feeds]
+            self._record_fetch_results(results)
+            # Feeds are fetched concurrently but always printed in name order.
+            for result in results:
+                if result.error is not None:
+                    message = messages.FEED_FETCH_ERROR.format(feed_name=result.feed.name, error=result.error)
+                    message += messages.NEWLINE + messages.FEED_SEPERATOR
+                    self.send_groupchat_message(message, priority=outbox.BULK)
+                else:
+                    self._save_fetch_state(result.feed, len(result.entries))
+                    self._dump_entries(result.feed, result.entries, footer=messages.FEED_SEPERATOR)
+
+        self._submit(
+            self._fetch_unseen_entries, self._in_room(feeds_fetched), feeds, entries_limit, self._get_parse_pool(),
+            [self.room] * len(feeds))
+        self.send_groupchat_message(messages.FETCHING_FEEDS)
 
     @botcmd
     def set_age_filter(self, mess, args):
@@ -393,51 +895,281 @@ class FeedBot(JabberBot):
         try:
             feed_name, age_filter_setting = clean_args(args)
             feed = self.get_feed_by_name(feed_name)
-            feed.set_age_filter(int(age_filter_setting))
-            self._save_feed_data()
+            minutes = int(age_filter_setting)
+            feed.set_age_filter(minutes)
+            self._save_feed_data('set_age_filter', name=feed_name, minutes=minutes)
             self.send_groupchat_message(messages.OKAY)
-        except IOError:
-            pass
         except (ValueError, exceptions.UnknownFeedError):
             self.send_groupchat_message(messages.SET_AGE_FILTER_HELP)
 
-    def send_groupchat_message(self, text):
-        """ Send a message to the chatroom. """
-        self.send(self.chatroom, text, message_type='groupchat')
+    @botcmd
+    def profile(self, mess, args):
+        """
+        Profile the bot for a while: `/profile <seconds>`. Admins only.
 
+        Commands and background work are profiled with cProfile. Afterwards the
+        stats are saved to the data directory and the functions which took the
+        most time are posted.
+        """
+        if not self._is_admin(mess):
+            self.send_groupchat_message(messages.ADMINS_ONLY)
+            return
+        try:
+            seconds = float(args.strip())
+            if not 0 < seconds <= MAX_PROFILE_SECONDS:
+                raise ValueError()
+        except ValueError:
+            self.send_groupchat_message(messages.PROFILE_HELP.format(max_seconds=MAX_PROFILE_SECONDS))
+            return
+        if self.profile_session is not None:
+            self.send_groupchat_message(messages.PROFILE_RUNNING)
+            return
+        self.profile_session = ProfileSession(seconds)
+        self._profile_finished = self._in_room(self._profile_saved)
+        self.send_groupchat_message(messages.PROFILE_STARTED.format(seconds=seconds))
 
-def clean_args(args):
-    """ Utility function that removes jabberbot formatting. """
-    return str(args).strip().split()
+    def _is_admin(self, mess):
+        """
+        Was a message sent by one of FEEDBOT_ADMINS?
+
+        Anyone can take a nickname, so senders are only recognized by their
+        real, bare JID. Messages from a room, including private ones, carry
+        the sender's nickname, which is looked up in the JIDs the room
+        announced. Anonymous rooms don't announce them, so nobody is an admin
+        there.
+        """
+        if not mess:
+            return False
+        sender = mess.getFrom()
+        room = self.rooms.get(sender.getStripped())
+        if room is not None:
+            jid = room.occupants.get(sender.getResource())
+        else:
+            jid = sender.getStripped()
+        return jid is not None and jid in self.admins
+
+    def _finish_profile(self):
+        """ Once a /profile has run its course, save and summarize it in the background. """
+        session = self.profile_session
+        if session is None or not session.expired():
+            return
+        self.profile_session = None
+        data_dir = os.path.dirname(self.rooms[self.chatroom].data_file)
+        path = os.path.join(data_dir, 'feedbot-{0}.pstats'.format(time.strftime('%Y%m%d-%H%M%S')))
+        callback, self._profile_finished = self._profile_finished, None
+        self.executor.submit(save_and_summarize, partial(callback, path), session, path, self.profile_top)
+
+    def _profile_saved(self, path, lines, error):
+        """ Post the summary of a finished /profile. """
+        if error is not None:
+            self.send_groupchat_message(messages.PROFILE_ERROR.format(error=error))
+            return
+        self.send_groupchat_message('\n'.join([messages.PROFILE_HEADER.format(path=path)] + lines))
+
+    @botcmd
+    def stats(self, mess, args):
+        """
+        Show where the time goes: `/stats` for every feed, or `/stats <feed name>` for one.
+
+        Timings are given as the median and 95th percentile of recent samples.
+        """
+        feed_name = args.strip()
+        if feed_name and feed_name not in self.feeds:
+            self.send_groupchat_message(messages.FEED_NOT_FOUND_ERROR)
+            return
+        registry = metrics.registry
+        labels = {'feed': feed_name} if feed_name else {}
+        lines = []
+        for stage in STATS_STAGES if not feed_name else STATS_FEED_STAGES:
+            summary = registry.percentiles(stage, **labels)
+            if summary is not None:
+                p50, p95, count = summary
+                lines.append(messages.STATS_STAGE.format(
+                    stage=stage.replace('_seconds', ''), p50=format_seconds(p50), p95=format_seconds(p95), count=count))
+        if not lines:
+            self.send_groupchat_message(messages.NO_STATS)
+            return
+        lines.insert(0, messages.STATS_HEADER)
+
+        if not feed_name:
+            feed_costs = []
+            for feed_labels in registry.label_sets('fetch_seconds'):
+                costs = [registry.percentiles(stage, **feed_labels) for stage in ('fetch_seconds', 'parse_seconds')]
+                feed_costs.append((sum(cost[1] for cost in costs if cost), feed_labels['feed']))
+            if feed_costs:
+                lines.append(messages.STATS_SLOWEST_FEEDS)
+                for cost, name in sorted(feed_costs, reverse=True)[:5]:
+                    lines.append(messages.STATS_ITEM.format(name=name, value=format_seconds(cost)))
+
+        filter_costs = []
+        for filter_labels in registry.label_sets('filter_seconds'):
+            if feed_name and filter_labels['feed'] != feed_name:
+                continue
+            p50, p95, _ = registry.percentiles('filter_seconds', **filter_labels)
+            filter_costs.append((p95, p50, filter_labels['feed'], filter_labels['filter']))
+        if filter_costs:
+            lines.append(messages.STATS_SLOWEST_FILTERS)
+            for p95, p50, name, filter_name in sorted(filter_costs, reverse=True)[:5]:
+                counts = dict(
+                    (outcome, registry.counter('filter_entries_total', feed=name, filter=filter_name, outcome=outcome))
+                    for outcome in ('kept', 'dropped'))
+                lines.append(messages.STATS_FILTER.format(
+                    feed=name, filter=filter_name, p50=format_seconds(p50), p95=format_seconds(p95), **counts))
+        self.send_groupchat_message('\n'.join(lines))
+
+    def idle_proc(self):
+        """ Called by the JabberBot main loop, posts the results of background work. """
+        with self._profiling():
+            super(FeedBot, self).idle_proc()
+            if self.polling:
+                self._poll_feeds()
+            self.executor.drain()
+            for room in self.rooms.values():
+                with self._serving(room):
+                    self._flush_feed_data()
+            self._send_queued_messages()
+            self._write_metrics()
+        self._finish_profile()
+
+    def _write_metrics(self):
+        """ Write the metrics file in the background, if one is configured and it is due. """
+        if not self.metrics_file or time.time() < self._metrics_due:
+            return
+        self._metrics_due = time.time() + self.metrics_interval
+        self._submit(metrics.registry.write_prometheus, self._metrics_written, self.metrics_file)
+
+    def _metrics_written(self, result, error):
+        if error is not None:
+            logger.warning("Error writing the metrics file %s: %s", self.metrics_file, error)
 
+    def _poll_feeds(self):
+        """
+        Start a background fetch of every Feed which is due to be polled, in every room, as one batch.
+
+        When a URL is due in one room, the Feeds with that URL in the other
+        rooms are polled along with it, so that it is only fetched once. They
+        are found through each room's URL index.
+        """
+        due_urls = OrderedDict()
+        for room in self.rooms.values():
+            for feed_name in room.poller.pop_due():
+                feed = room.feeds.get(feed_name)
+                if feed is None or feed.url in due_urls:
+                    continue
+                if self.breaker.allow(feed.url):
+                    due_urls[feed.url] = True
+                else:
+                    # Try again after a poll interval, the breaker may have closed by then.
+                    room.poller.reschedule(feed_name, 0)
+        feeds, rooms = [], []
+        for room in self.rooms.values():
+            for url in due_urls:
+                feed = room.feeds.get_by_url(url)
+                if feed is None or feed.name in room.polls_in_flight:
+                    continue
+                room.polls_in_flight.add(feed.name)
+                feeds.append(feed)
+                rooms.append(room)
+        if not feeds:
+            return
+
+        def feeds_polled(results, error):
+            if error is not None:
+                results = [FetchResult(feed, None, error) for feed in feeds]
+            self._record_fetch_results(results)
+            for room, result in zip(rooms, results):
+                if self.rooms.get(room.jid) is not room:
+                    # The room was left while its Feeds were being polled.
+                    continue
+                with self._serving(room):
+                    try:
+                        self._feed_polled(result.feed, result.entries, result.error)
+                    except Exception:
+                        logger.exception("Error handling a poll of the %s feed.", result.feed.name)
+
+        entries_limit = int(os.environ.get('FEEDBOT_STORY_LIMIT', 5))
+        self._submit(
+            self._fetch_unseen_entries, feeds_polled, feeds, entries_limit, self._get_parse_pool(), rooms)
+
+    def _feed_polled(self, feed, unseen_entries, error):
+        """
+        Post the new entries of a polled Feed and schedule its next poll.
 
-def utc_now():
-    """
-    Return a timezone-aware datetime object, representing this instant in time.
+        The poll interval adapts to the entries the Feed published, before they
+        were filtered, and is kept under half the Feed's AgeFilter window so
+        that its stories are fetched before they are too old to be shown.
+        """
+        self._polls_in_flight.discard(feed.name)
+        published = 0
+        try:
+            if error is not None:
+                logger.warning("Error polling the %s feed: %s", feed.name, error)
+                unseen_entries = []
+            else:
+                published = max(feed.count_new_entries(), len(unseen_entries))
+                if self.feeds.get(feed.name) is feed and unseen_entries:
+                    self._print_feed(feed.name, unseen_entries)
+        finally:
+            # The Feed is always polled again, even if its stories couldn't be posted.
+            age_window = feed.get_age_window()
+            max_interval = age_window / 2 if age_window else None
+            self.poller.reschedule(feed.name, published, max_interval=max_interval)
+        if error is None:
+            self._save_fetch_state(feed, len(unseen_entries))
+
+    def _save_fetch_state(self, feed, new_entries=0):
+        """ Save a Feed's HTTP validators and fetch statistics, if it is still being monitored. """
+        if self.feeds.get(feed.name) is not feed:
+            return
+        poll_interval = self.poller.get_interval(feed.name) if feed.name in self.poller else None
+        try:
+            self.feed_store.save_fetch_state(feed, new_entries=new_entries, poll_interval=poll_interval)
+        except Exception:
+            logger.exception("Error saving the fetch state of the %s feed.", feed.name)
 
-    The timezone of the object will be UTC.
-    """
-    return utc.localize(datetime.now())
+    def shutdown(self):
+        """ Called by the JabberBot when it stops serving. """
+        self.executor.close()
+        if self._parse_pool is not None:
+            self._parse_pool.terminate()
+        if self.async_fetcher is not None:
+            self.async_fetcher.close()
+        for room in self.rooms.values():
+            with self._serving(room):
+                self._close_room()
+        self._send_queued_messages(flush=True)
+        super(FeedBot, self).shutdown()
 
+    def send_groupchat_message(self, text, priority=outbox.INTERACTIVE):
+        """
+        Queue a message for the room being served.
 
-def struct_to_datetime(time_struct):
-    """
-    Given a time.struct_time instance, return a datetime.datetime instance.
+        Args:
+            text (string): The message.
+            priority (int): `outbox.INTERACTIVE` for replies to commands, which
+            are sent first, or `outbox.BULK` for stories.
+        """
+        self.outbox.put((self.room.jid, text, time.time()), priority=priority)
 
-    See Also:
-        http://stackoverflow.com/a/1697838/2557196
-        https://docs.python.org/2/library/time.html#time.struct_time
-    """
-    return utc.localize(datetime(*time_struct[:6]))
+    def _send_queued_messages(self, flush=False):
+        """ Send as many queued messages as the rate limit allows, or all of them if `flush` is set. """
+        ready = self.outbox.pop_all() if flush else self.outbox.pop_ready()
+        for room, text, queued_at in ready:
+            metrics.registry.observe('send_delay_seconds', time.time() - queued_at)
+            try:
+                with metrics.registry.timer('send_seconds'):
+                    self.send(room, text, message_type='groupchat')
+            except Exception:
+                logger.exception("Error sending a message to %s.", room)
 
 
-def time_delta_from_now(prev_time):
-    """ Given a time `then`, returns the difference between `now` and `then`. """
-    return utc_now() - prev_time
+def format_seconds(seconds):
+    """ Return a duration as a short string, eg: '12.5ms'. """
+    if seconds >= 1:
+        return '{0:.2f}s'.format(seconds)
+    return '{0:.1f}ms'.format(seconds * 1000)
 
 
-def pub_time_to_string(time_struct):
-    """ Given a time_struct, return a humanized string representing the elapsed time. """
-    publication_time = struct_to_datetime(time_struct)
-    delta = time_delta_from_now(publication_time)
-    return humanize.naturaltime(delta).capitalize()
+def clean_args(args):
+    """ Utility function that removes jabberbot formatting. """
+    return str(args).strip().split()
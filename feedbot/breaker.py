@@ -0,0 +1,83 @@
+""" Contains the CircuitBreaker class. """
+
+from __future__ import absolute_import
+from collections import namedtuple
+import time
+
+
+FeedHealth = namedtuple('FeedHealth', ['failures', 'last_error', 'retry_at'])
+
+
+class CircuitBreaker(object):
+    """
+    Tracks failing feed URLs, and stops fetching them for a while.
+
+    Once a URL has failed `threshold` times in a row its breaker opens: the
+    URL is skipped until a cool-down has passed, then one more attempt, the
+    probe, is allowed. Other attempts are refused while the probe is in
+    flight, until its success or failure is recorded, or until a cool-down has
+    passed in case it never is. The cool-down starts at `cooldown` seconds and
+    doubles with every failure after that, up to `max_cooldown`. A single
+    success closes the breaker and forgets the failures.
+
+    URLs are tracked rather than Feeds, since a URL followed in several rooms
+    is only fetched once.
+
+    Args:
+        threshold (int): The failures in a row after which a URL is skipped.
+        cooldown (float): The first cool-down, in seconds.
+        max_cooldown (float): The longest cool-down, in seconds.
+    """
+    def __init__(self, threshold=3, cooldown=300, max_cooldown=21600):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self._health = {}
+        self._probes = {}
+
+    def __repr__(self):
+        return '{0}({1} failing)'.format(type(self).__name__, len(self._health))
+
+    def allow(self, url, now=None):
+        """
+        Return True if a URL should be fetched now.
+
+        Once a URL's cool-down has passed, True means the caller is making the
+        probe, and must record its success or failure.
+        """
+        health = self._health.get(url)
+        if health is None or health.retry_at is None:
+            return True
+        now = time.time() if now is None else now
+        if now < health.retry_at:
+            return False
+        probe_started = self._probes.get(url)
+        if probe_started is not None and now < probe_started + self.cooldown:
+            return False
+        self._probes[url] = now
+        return True
+
+    def record_success(self, url):
+        """ Note that a URL was fetched, closing its breaker. """
+        self._health.pop(url, None)
+        self._probes.pop(url, None)
+
+    def record_failure(self, url, error, now=None):
+        """ Note that fetching a URL failed with `error`, opening its breaker after enough failures. """
+        now = time.time() if now is None else now
+        self._probes.pop(url, None)
+        failures = self._health[url].failures + 1 if url in self._health else 1
+        retry_at = None
+        if failures >= self.threshold:
+            cooldown = min(self.max_cooldown, self.cooldown * 2 ** min(failures - self.threshold, 32))
+            retry_at = now + cooldown
+        self._health[url] = FeedHealth(failures, error, retry_at)
+
+    def get_health(self, url):
+        """ Return the `FeedHealth(failures, last_error, retry_at)` of a failing URL, or None. """
+        return self._health.get(url)
+
+    def forget(self, url):
+        """ Stop tracking a URL, eg: once nothing follows it any more. """
+        self._health.pop(url, None)
+        self._probes.pop(url, None)
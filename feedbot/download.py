@@ -0,0 +1,68 @@
+""" Contains the HTTP download stage, which fetches feed documents without parsing them. """
+
+from __future__ import absolute_import
+from collections import namedtuple
+import httplib
+import socket
+import urllib2
+
+from . import exceptions
+
+
+USER_AGENT = 'feedbot (+https://github.com/j5int/feedbot)'
+
+
+class Download(namedtuple('Download', ['status', 'content', 'headers'])):
+    """
+    The result of downloading a feed document.
+
+    Attributes:
+        status (int): The HTTP status, 304 if the document hasn't changed.
+        content (string): The document's raw bytes, empty for a 304. They may
+        still be gzip or deflate encoded: Feed Parser decodes them according
+        to the `content-encoding` header.
+        headers (dict): The response headers, with lowercased names. The final
+        URL of the document is included as `content-location`, so relative
+        links in the document can be resolved when it is parsed.
+    """
+    __slots__ = ()
+
+
+def download(url, etag=None, modified=None, timeout=30):
+    """
+    Download a feed document.
+
+    Args:
+        url (string): The document's URL.
+        etag (string): An ETag to send as `If-None-Match`.
+        modified (string): A Last-Modified date to send as `If-Modified-Since`.
+        timeout (float): Seconds to wait for the server before giving up.
+
+    Returns:
+        A `Download`.
+
+    Raises:
+        FeedDataError: If the document couldn't be downloaded.
+    """
+    request = urllib2.Request(url, headers={'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip, deflate'})
+    if etag:
+        request.add_header('If-None-Match', etag)
+    if modified:
+        request.add_header('If-Modified-Since', modified)
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+        try:
+            content = response.read()
+            headers = dict(response.info().items())
+            headers['content-location'] = response.geturl()
+            status = response.getcode() or 200
+        finally:
+            response.close()
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            return Download(304, '', dict(error.info().items()))
+        raise exceptions.FeedDataError(str(error))
+    except (urllib2.URLError, httplib.HTTPException, socket.error) as error:
+        raise exceptions.FeedDataError(str(error))
+    return Download(status, content, headers)
+
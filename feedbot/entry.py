@@ -0,0 +1,84 @@
+""" Contains the Entry class. """
+
+from __future__ import absolute_import
+import calendar
+
+
+class Entry(object):
+    """
+    A compact copy of the parts of a feed entry the FeedBot uses.
+
+    Feed Parser entries keep every element of the original document, which
+    adds up when many Feeds' entries are held between polls. Feeds convert
+    their entries to Entries as soon as a document is parsed, so the parse
+    tree can be freed.
+
+    Entries can be read like Feed Parser entries, with either attributes or
+    keys: `entry.link`, `entry['link']`, `entry.get('link')` and
+    `'link' in entry` all work. Fields the original entry didn't have are
+    None, and `in` and item access treat them as missing.
+
+    Args:
+        The fields in `Entry.FIELDS`, as keyword arguments.
+
+    Attributes:
+        timestamp (int): The publication time as seconds since the epoch, or
+        None if the entry has no parsable publication time.
+    """
+    FIELDS = ('id', 'title', 'summary', 'link', 'authors', 'published', 'published_parsed', 'updated')
+    __slots__ = FIELDS + ('timestamp',)
+
+    def __init__(self, **fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields.pop(field, None))
+        if fields:
+            raise TypeError("Unknown entry fields: {0}".format(', '.join(sorted(fields))))
+        self.timestamp = calendar.timegm(self.published_parsed) if self.published_parsed else None
+
+    @classmethod
+    def from_parsed(cls, parsed_entry):
+        """ Given a Feed Parser entry, return an Entry holding just the fields we use. """
+        # dict.get skips FeedParserDict's key aliasing and its deprecation warnings.
+        fields = dict((field, dict.get(parsed_entry, field)) for field in cls.FIELDS)
+        if fields['authors']:
+            fields['authors'] = [dict(author) for author in fields['authors']]
+        return cls(**fields)
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, self.link)
+
+    @property
+    def key(self):
+        """ The entry's id, or its link if it has no id. None if it has neither. """
+        return self.id or self.link
+
+    def __getstate__(self):
+        # Objects with __slots__ need these to be pickled, eg: by a process pool.
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, Entry):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __contains__(self, field):
+        return field in self.__slots__ and getattr(self, field) is not None
+
+    def __getitem__(self, field):
+        if field not in self:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        """ Return a field's value, or `default` if the entry doesn't have it. """
+        if field not in self:
+            return default
+        return getattr(self, field)
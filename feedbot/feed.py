@@ -1,15 +1,24 @@
 """ Contains the Feed class. """
 
 from __future__ import absolute_import
+import io
 import repr
+import time
 
 import feedparser
 
 from . import exceptions
+from . import metrics
+from .download import download
+from .entry import Entry
 from .filters import (
     AgeFilter,
+    EntryView,
     FilterBase,
+    NotFilter,
+    NotFilterGroup,
 )
+from .timeutils import utc_now
 
 
 class Feed(object):
@@ -28,26 +37,77 @@ class Feed(object):
         chat channel.
         url (string): The URL this feed will be parsing.
         filters: An iterable container of `feedbot.filters`.
+        etag (string): The ETag header the Feed's server last sent, if any.
+        modified (string): The Last-Modified header the Feed's server last
+        sent, if any.
+
+    Feeds remember the HTTP validators of the last response they received
+    and send them with the next request, so servers can answer with a cheap
+    `304 Not Modified` and the Feed reuses its last entries. Entries are kept
+    as compact `feedbot.entry.Entry` objects rather than Feed Parser's.
 
     See Also:
 
         Universal Feed Parser
             http://pythonhosted.org//feedparser/introduction.html
     """
-    def __init__(self, name, url, filters=None):
+    def __init__(self, name, url, filters=None, etag=None, modified=None):
         self.name = name
         self.url = url
         if not filters:
             filters = []
         self.filters = filters
+        self.etag = etag
+        self.modified = modified
+        self._last_entries = None
+        self._counted_keys = set()
+        self._filter_pipeline = None
 
     def __repr__(self):
         components = repr.repr(self.filters)
         return '{0}(name={1}, url={2}, filters={3})'.format(type(self).__name__, self.name, self.url, components)
 
-    def _accept_entry(self, entry):
-        """ Given an RSS entry returns True if it passes all the Feed's filters. """
-        return all([feed_filter.discard_entry(entry) is False for feed_filter in self.filters])
+    def _accept_entry(self, entry, now=None, stats=None):
+        """
+        Given an RSS entry returns True if it passes all the Feed's filters.
+
+        Args:
+            entry: A feed entry.
+            now (datetime): The time to measure the entry's age against, see
+            `feedbot.filters.EntryView`.
+            stats (dict): If given, the time each filter takes and the number
+            of entries it keeps and drops are added to it, as
+            `{filter class name: [seconds, kept, dropped]}`.
+        """
+        # The filters share one view, so the entry's HTML is only parsed once.
+        view = EntryView(entry, now=now)
+        for feed_filter in self._get_filter_pipeline():
+            if stats is None:
+                discard = feed_filter.discard_entry(entry, view=view)
+            else:
+                start = time.time()
+                discard = feed_filter.discard_entry(entry, view=view)
+                filter_stats = stats.setdefault(type(feed_filter).__name__, [0.0, 0, 0])
+                filter_stats[0] += time.time() - start
+                filter_stats[2 if discard else 1] += 1
+            if discard:
+                return False
+        return True
+
+    def _get_filter_pipeline(self):
+        """
+        Return this Feed's filters, cheapest first.
+
+        All NotFilters are replaced by one NotFilterGroup. The result is cached
+        until the Feed's filters change.
+        """
+        if self._filter_pipeline is None:
+            not_filters = [feed_filter for feed_filter in self.filters if isinstance(feed_filter, NotFilter)]
+            pipeline = [feed_filter for feed_filter in self.filters if not isinstance(feed_filter, NotFilter)]
+            if not_filters:
+                pipeline.append(NotFilterGroup(not_filters))
+            self._filter_pipeline = sorted(pipeline, key=lambda feed_filter: feed_filter.cost)
+        return self._filter_pipeline
 
     def to_dict(self):
         """ Serialize a Feed instance and its Filters to a dict. """
@@ -56,6 +116,10 @@ class Feed(object):
             'name': self.name,
             'url': self.url,
             'filters': [feed_filter.to_dict() for feed_filter in self.filters]}
+        if self.etag:
+            data_dict['etag'] = self.etag
+        if self.modified:
+            data_dict['modified'] = self.modified
         return data_dict
 
     @classmethod
@@ -75,23 +139,147 @@ class Feed(object):
             for serialized_filter in data_dict['filters']:
                 filter_instance = FilterBase.from_dict(serialized_filter)
                 feed_filters.append(filter_instance)
-            return Feed(data_dict['name'], data_dict['url'], filters=feed_filters)
+            return Feed(
+                data_dict['name'],
+                data_dict['url'],
+                filters=feed_filters,
+                etag=data_dict.get('etag'),
+                modified=data_dict.get('modified'))
         except (KeyError, ValueError, AssertionError):
             raise exceptions.DeserializationError("Error parsing Filter json data.")
 
-    def get_raw_feed(self):
+    def get_raw_feed(self, cache=None, timeout=30):
         """
-        Return the unfiltered feed.
+        Return the unfiltered feed, as parsed by Feed Parser.
+
+        Args:
+            cache: A `feedbot.httpcache.HttpCache`. If given, a fresh copy of
+            the document in the cache is used instead of downloading it.
+            timeout (float): Seconds to wait for the server when downloading
+            without a cache. The cache has a timeout of its own.
 
         Raises:
-            BadFeedData: If Feed Parser detects a feed error.
+            FeedDataError: If the feed can't be downloaded, or Feed Parser
+            detects a feed error.
         """
-        feed = feedparser.parse(self.url)
-        # feed.bozo indicates that the feed's XML data is malformed
-        # See: http://pythonhosted.org//feedparser/bozo.html
-        if not feed.bozo:
-            return feed
-        raise exceptions.FeedDataError(feed.bozo_exception.message)
+        with metrics.registry.timer('fetch_seconds', feed=self.name):
+            if cache is None:
+                response = download(self.url, timeout=timeout)
+            else:
+                response = cache.download(self.url)
+        metrics.record_response(self.name, response)
+        # See `parse_entries` for why the body is handed over as a file.
+        return check_parsed(feedparser.parse(io.BytesIO(response.content), response_headers=response.headers))
+
+    def get_entries(self, cache=None, timeout=30):
+        """
+        Return the Feed's entries, as a list of Entries.
+
+        The Feed's ETag and Last-Modified validators are sent along with the
+        request. If the server answers `304 Not Modified` the previous entries
+        are returned without parsing anything.
+
+        Args:
+            cache: A `feedbot.httpcache.HttpCache` to download through.
+            timeout (float): Seconds to wait for the server when downloading
+            without a cache. The cache has a timeout of its own.
+
+        Raises:
+            FeedDataError: If the feed can't be downloaded, Feed Parser detects
+            a feed error, or there are no entries in the stream.
+        """
+        return self.entries_from_response(self._download(cache, timeout))
+
+    def request_validators(self):
+        """
+        Return the `(etag, modified)` validators to send with the next request.
+
+        Validators restored from disc are sent too, even though the entries
+        they describe weren't saved: if the server answers `304 Not Modified`
+        the document is downloaded again without them, see `_download`.
+        """
+        return self.etag, self.modified
+
+    def _download(self, cache=None, timeout=30):
+        """
+        Download the feed document, through an HttpCache if one is given, otherwise with `timeout`.
+
+        If the server says the document hasn't changed but there are no entries
+        to reuse, eg: the validators were restored from disc, it is downloaded
+        again without validators.
+        """
+        etag, modified = self.request_validators()
+        with metrics.registry.timer('fetch_seconds', feed=self.name):
+            response = self._request(cache, timeout, etag, modified)
+            if response.status == 304 and self._last_entries is None and (etag or modified):
+                metrics.record_response(self.name, response)
+                response = self._request(cache, timeout)
+        metrics.record_response(self.name, response)
+        return response
+
+    def _request(self, cache, timeout, etag=None, modified=None):
+        if cache is not None:
+            return cache.download(self.url, etag=etag, modified=modified)
+        return download(self.url, etag=etag, modified=modified, timeout=timeout)
+
+    def _reused_entries(self):
+        """ Return the last entries, for a `304 Not Modified` response. """
+        if self._last_entries is None:
+            raise exceptions.FeedDataError("The server says the feed hasn't changed, but there's nothing to reuse.")
+        return self._last_entries
+
+    def entries_from_response(self, response):
+        """
+        Return the Feed's entries from a downloaded `feedbot.download.Download`.
+
+        Raises:
+            FeedDataError: If Feed Parser detects a feed error, or there are no
+            entries in the stream.
+        """
+        if response.status == 304:
+            return self._reused_entries()
+        with metrics.registry.timer('parse_seconds', feed=self.name):
+            entries = parse_entries(response.content, response.headers)
+        self._remember(response, entries)
+        return entries
+
+    def _remember(self, response, entries):
+        """ Keep the entries and validators of a freshly parsed document. """
+        self._last_entries = entries
+        self.etag = response.headers.get('etag')
+        self.modified = response.headers.get('last-modified')
+
+    def count_new_entries(self):
+        """
+        Return how many of the Feed's entries are new since the last call, before filtering.
+
+        This measures how often the Feed publishes, whether or not its stories
+        pass its filters, eg: a story which is already too old for the Feed's
+        AgeFilter by the time it is fetched still counts.
+        """
+        keys = set(entry.key for entry in self._last_entries or () if entry.key is not None)
+        new_entries = len(keys - self._counted_keys)
+        if self._last_entries is not None:
+            self._counted_keys = keys
+        return new_entries
+
+    def get_age_window(self):
+        """ Return the shortest AgeFilter window of the Feed in seconds, or None if it has no AgeFilter. """
+        windows = [feed_filter.window.total_seconds() for feed_filter in self.filters
+                   if isinstance(feed_filter, AgeFilter)]
+        return min(windows) if windows else None
+
+    def share_entries(self, feed):
+        """
+        Take the entries and validators of another Feed with the same URL.
+
+        This lets Feeds in several chatrooms share one download and parse of a
+        document: afterwards this Feed can be filtered as if the server had
+        answered `304 Not Modified`.
+        """
+        self._last_entries = feed._last_entries
+        self.etag = feed.etag
+        self.modified = feed.modified
 
     def get_filtered_feed(self):
         """
@@ -100,20 +288,61 @@ class Feed(object):
         Raises:
             FeedDataError: If there are no entries in the steam.
         """
-        stream = self.get_raw_feed()
-        if 'entries' in stream:
-            return [entry for entry in stream.entries if self._accept_entry(entry)]
-        raise exceptions.FeedDataError("Could not find entries in this stream.")
+        return list(self.iter_filtered_entries())
+
+    def iter_filtered_entries(self, pool=None, response=None, cache=None, timeout=30):
+        """
+        Yield the entries which pass the Feed's filters, one at a time.
+
+        Entries are only filtered as they are asked for, so callers which stop
+        early don't pay for filtering the rest of the Feed.
+
+        Args:
+            pool: A `multiprocessing.Pool` (or anything with its `apply`
+            method). If given, parsing, which is CPU bound, runs in the pool
+            and only the compact Entries are sent back. They are still
+            filtered lazily, by the Feed's own filters.
+            response: The Feed's document, if it has already been downloaded,
+            eg: by a `feedbot.asyncfetch.AsyncFetcher`. Otherwise it is
+            downloaded on the calling thread.
+            cache: A `feedbot.httpcache.HttpCache` to download through.
+            timeout (float): Seconds to wait for the server when downloading.
+
+        Raises:
+            FeedDataError: If the feed can't be downloaded or parsed, or there
+            are no entries in the steam.
+        """
+        if response is not None and response.status == 304 and self._last_entries is None:
+            # The response was requested with validators restored from disc.
+            response = None
+        if response is None:
+            response = self._download(cache, timeout)
+        now = utc_now()
+        if pool is None or response.status == 304:
+            entries = self.entries_from_response(response)
+        else:
+            entries, parse_seconds = pool.apply(timed_parse_entries, (response.content, response.headers))
+            self._remember(response, entries)
+            metrics.registry.observe('parse_seconds', parse_seconds, feed=self.name)
+        filter_stats = {}
+        try:
+            for entry in entries:
+                if self._accept_entry(entry, now=now, stats=filter_stats):
+                    yield entry
+        finally:
+            metrics.record_filter_stats(self.name, filter_stats)
 
     def add_filter(self, feed_filter):
         """ Given a filter, add it to the feed. """
         self.filters.append(feed_filter)
+        self._filter_pipeline = None
 
     def remove_filter(self, feed_filter):
         """ Remove a filter, remove it from the feed. """
         if feed_filter == getattr(self, 'age_filter', None):
             self.age_filter = None
         self.filters.remove(feed_filter)
+        self._filter_pipeline = None
 
     def get_filters(self):
         """ Return a list of this Feed's filters. """
@@ -135,3 +364,45 @@ class Feed(object):
         else:
             self.age_filter = AgeFilter(time_period)
         self.filters.append(self.age_filter)
+        self._filter_pipeline = None
+
+
+def check_parsed(feed):
+    """ Return a Feed Parser result, or raise FeedDataError if the feed is malformed. """
+    # feed.bozo indicates that the feed's XML data is malformed
+    # See: http://pythonhosted.org//feedparser/bozo.html
+    if feed.bozo:
+        raise exceptions.FeedDataError(feed.bozo_exception.message)
+    return feed
+
+
+# The functions below are the CPU bound half of fetching a Feed. They only take
+# and return picklable values, so they can run in another process.
+
+def parse_entries(content, headers):
+    """
+    Parse a downloaded feed document into a list of Entries.
+
+    Raises:
+        FeedDataError: If Feed Parser detects a feed error, or there are no
+        entries in the stream.
+    """
+    # Feed Parser treats a string which looks like a URL or a path as one, so
+    # the document is handed over as a file: a feed's body mustn't be able to
+    # make the bot read local files or fetch internal URLs.
+    feed = check_parsed(feedparser.parse(io.BytesIO(content), response_headers=headers))
+    if 'entries' not in feed:
+        raise exceptions.FeedDataError("Could not find entries in this stream.")
+    return [Entry.from_parsed(entry) for entry in feed.entries]
+
+
+def timed_parse_entries(content, headers):
+    """
+    Parse a downloaded feed document, see `parse_entries`.
+
+    Returns:
+        A tuple of the entries and the seconds parsing took.
+    """
+    start = time.time()
+    entries = parse_entries(content, headers)
+    return entries, time.time() - start
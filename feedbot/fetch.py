@@ -0,0 +1,141 @@
+""" Contains the concurrent fetch stage and background executor used by the FeedBot. """
+
+from __future__ import absolute_import
+from collections import namedtuple
+import logging
+from multiprocessing.pool import ThreadPool
+import Queue
+import time
+
+from . import exceptions
+
+logger = logging.getLogger(__name__)
+
+
+FetchResult = namedtuple('FetchResult', ['feed', 'entries', 'error'])
+
+
+class FetchTimeoutError(exceptions.FeedbotError):
+    """ Raise if a Feed took longer than the fetch timeout to download. """
+
+
+def fetch_feeds(feeds, workers=8, timeout=30, fetch=None):
+    """
+    Download, parse and filter many Feeds in parallel.
+
+    Every Feed's `get_filtered_feed`, or `fetch(feed)` if given, runs on a
+    pool of `workers` threads. A Feed's timeout starts when a worker picks it
+    up, so Feeds queued behind a slow server are not penalized for waiting.
+    Feeds that run out of time are abandoned: their worker finishes in the
+    background and the result is dropped.
+
+    Args:
+        feeds: An iterable of `feedbot.feed.Feed` instances.
+        workers (int): The number of fetches to run at once.
+        timeout (float): Seconds a single Feed may take before giving up on it.
+        fetch: A function which takes a Feed and returns its entries.
+
+    Returns:
+        A list of `FetchResult(feed, entries, error)` in the same order as
+        `feeds`. Exactly one of `entries` and `error` is None.
+    """
+    feeds = list(feeds)
+    if not feeds:
+        return []
+    if fetch is None:
+        fetch_entries = lambda feed: feed.get_filtered_feed()
+    else:
+        fetch_entries = fetch
+
+    started = {}
+
+    def fetch(index):
+        started[index] = time.time()
+        return fetch_entries(feeds[index])
+
+    pool = ThreadPool(max(1, min(workers, len(feeds))))
+    pending = [pool.apply_async(fetch, (index,)) for index in range(len(feeds))]
+    # Don't join the pool: a hung server would hold up the caller.
+    pool.close()
+
+    results = []
+    for index, async_result in enumerate(pending):
+        feed = feeds[index]
+        while not async_result.ready():
+            start_time = started.get(index)
+            if start_time is None:
+                async_result.wait(0.1)
+                continue
+            remaining = start_time + timeout - time.time()
+            if remaining <= 0:
+                break
+            async_result.wait(remaining)
+
+        if not async_result.ready():
+            error = FetchTimeoutError("Timed out after {0} seconds.".format(timeout))
+            results.append(FetchResult(feed, None, error))
+            continue
+        try:
+            results.append(FetchResult(feed, async_result.get(), None))
+        except Exception as error:
+            results.append(FetchResult(feed, None, error))
+    return results
+
+
+class BackgroundExecutor(object):
+    """
+    Runs blocking work on a thread pool and hands the results back to the bot.
+
+    Work is submitted with a callback. The work itself runs on a pool thread,
+    but callbacks are only ever run by `drain`, which the FeedBot calls from
+    its own thread (see `FeedBot.idle_proc`). Callbacks can therefore touch bot
+    state and send messages without any locking.
+
+    Args:
+        workers (int): The number of pool threads.
+    """
+    def __init__(self, workers=8):
+        self._pool = ThreadPool(max(1, workers))
+        self._results = Queue.Queue()
+        self._pending = 0
+
+    def submit(self, func, callback, *args):
+        """
+        Run `func(*args)` in the background.
+
+        Once it finishes, `drain` calls `callback(result, error)`, where error
+        is the exception raised by `func` or None.
+        """
+        def run():
+            try:
+                self._results.put((callback, func(*args), None))
+            except Exception as error:
+                self._results.put((callback, None, error))
+
+        self._pending += 1
+        self._pool.apply_async(run)
+
+    def drain(self, wait=False):
+        """
+        Run the callbacks of finished work. Returns the number of callbacks run.
+
+        Args:
+            wait (bool): Block until every submitted piece of work is done.
+        """
+        drained = 0
+        while self._pending:
+            try:
+                callback, result, error = self._results.get(block=wait)
+            except Queue.Empty:
+                break
+            self._pending -= 1
+            drained += 1
+            try:
+                callback(result, error)
+            except Exception:
+                logger.exception("Error in background work callback.")
+        return drained
+
+    def close(self):
+        """ Stop accepting work. Work that is already running is abandoned. """
+        self._pool.close()
@@ -0,0 +1,25 @@
+""" File helpers shared by the stores, the HTTP cache and the metrics writer. """
+
+from __future__ import absolute_import
+import os
+import tempfile
+
+
+def atomic_write(path, data):
+    """
+    Replace the file at `path` with `data`.
+
+    The data is written to a temporary file in the same directory which is
+    then renamed over `path`, so `path` always holds either the old or the new
+    data, never a mix of both.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.feedbot-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
@@ -2,20 +2,90 @@
 
 from __future__ import absolute_import
 from abc import abstractmethod
+import calendar
 from datetime import timedelta
 import sys
 
 from bs4 import BeautifulSoup
 
+from .matcher import TermMatcher
+from .timeutils import (
+    struct_to_datetime,
+    utc_now,
+)
+
+
+def normalize_text(entry):
+    """ Return the lowercased plain text of an entry's summary and title. """
+    string = "%s %s" % (entry.get('summary', ''), entry.get('title', ''))
+    return BeautifulSoup(string).get_text().lower().strip()
+
+
+class EntryView(object):
+    """
+    Wraps an entry while it is passed through a Feed's filters.
+
+    Values derived from the entry, such as its normalized text, are computed
+    the first time a filter asks for them and shared by every other filter.
+
+    Args:
+        entry: A feed entry.
+        now (datetime): The time to measure entry ages against. Pass the same
+        value for every entry of a Feed so the whole Feed is filtered as of one
+        instant. Defaults to the time it is first asked for.
+    """
+    __slots__ = ('entry', '_text', '_now', '_now_timestamp')
+
+    def __init__(self, entry, now=None):
+        self.entry = entry
+        self._text = None
+        self._now = now
+        self._now_timestamp = None
+
+    @property
+    def text(self):
+        """ The entry's normalized text, see `normalize_text`. """
+        if self._text is None:
+            self._text = normalize_text(self.entry)
+        return self._text
+
+    @property
+    def now(self):
+        """ The time to measure the entry's age against. """
+        if self._now is None:
+            self._now = utc_now()
+        return self._now
+
+    @property
+    def now_timestamp(self):
+        """ `now` as seconds since the epoch, to compare with `Entry.timestamp`. """
+        if self._now_timestamp is None:
+            self._now_timestamp = calendar.timegm(self.now.utctimetuple())
+        return self._now_timestamp
+
 
 class FilterBase(object):
-    """ Base class for filters."""
+    """
+    Base class for filters.
+
+    Feeds run their cheapest filters first and stop at the first filter which
+    discards an entry. Subclasses declare how expensive they are with `cost`.
+    """
+    cost = 10
+
     def __init__(self, terms):
         self.terms = terms.lower()
 
     @abstractmethod
-    def discard_entry(self, entry):
-        """ Given an entry, return False if we don't want to display it. """
+    def discard_entry(self, entry, view=None):
+        """
+        Given an entry, return False if we don't want to display it.
+
+        Args:
+            entry: A feed entry.
+            view (EntryView): An optional view of the entry, shared with the
+            other filters it is being checked against.
+        """
 
     def to_dict(self):
         return {'class': type(self).__name__}
@@ -62,13 +132,16 @@ class NotFilter(FilterBase):
     Initialize NotFilter with a string. If the string is present in an entry's
     summary or title, it will remove it from the Feed.
     """
+    cost = 5
+
     def __repr__(self):
         return "{0}('{1}')".format(type(self).__name__, self.terms)
 
-    def discard_entry(self, entry):
+    def discard_entry(self, entry, view=None):
         """ Given an entry, returns True if the blacklisted string is in the entry. """
-        string = "%s %s " % (entry.summary.lower(), entry.title.lower())
-        return self.terms in BeautifulSoup(string).get_text()
+        if view is None:
+            view = EntryView(entry)
+        return self.terms in view.text
 
     def to_dict(self):
         """ Serialize the filter to a dict. """
@@ -83,13 +156,15 @@ class AgeFilter(FilterBase):
 
     Initialize an AgeFilter with a dictionary of {minutes: <int>}.
     """
+    cost = 1
+
     def __init__(self, minutes=None):
         self.window = timedelta(minutes=minutes or 5)
 
     def __repr__(self):
         return "{0}({1})".format(type(self).__name__, self.window)
 
-    def discard_entry(self, entry, fail_closed=False):
+    def discard_entry(self, entry, fail_closed=False, view=None):
         """
         Return if the entry was published before the filter's age cutoff.
 
@@ -98,11 +173,15 @@ class AgeFilter(FilterBase):
         the entry). This behavior is specified by the fail_closed kwarg, which
         defaults to False.
         """
-        from .bot import struct_to_datetime, utc_now
-
+        if view is None:
+            view = EntryView(entry)
+        if 'timestamp' in entry:
+            # Entries carry a precomputed timestamp, which is cheaper to compare.
+            return view.now_timestamp - entry['timestamp'] >= self.window.total_seconds()
         if 'published_parsed' in entry:
+            now = view.now
             published_time = struct_to_datetime(entry['published_parsed'])
-            return utc_now() - published_time >= self.window
+            return now - published_time >= self.window
         return fail_closed
 
     def to_dict(self):
@@ -118,7 +197,29 @@ class AgeFilter(FilterBase):
 
     def get_window(self):
         """ Get the time window in minutes. """
-        return self.window.seconds/60.0
+        return self.window.total_seconds() / 60.0
+
+
+class NotFilterGroup(object):
+    """
+    Checks the terms of many NotFilters with a single scan of an entry's text.
+
+    Feeds use this in place of their individual NotFilters. It isn't a
+    FilterBase, as it is never saved or shown to the channel.
+    """
+    cost = NotFilter.cost
+
+    def __init__(self, not_filters):
+        self.matcher = TermMatcher([not_filter.terms for not_filter in not_filters])
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, self.matcher)
+
+    def discard_entry(self, entry, view=None):
+        """ Given an entry, returns True if any of the blacklisted strings are in the entry. """
+        if view is None:
+            view = EntryView(entry)
+        return self.matcher.search(view.text)
 
 
 ALLOWED_FILTER_TYPES = ['not', 'age']
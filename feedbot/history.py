@@ -0,0 +1,133 @@
+""" Contains the EntryHistory classes. """
+
+from __future__ import absolute_import
+from collections import OrderedDict
+import hashlib
+import os
+
+
+DIGEST_SIZE = 8
+
+
+def digest_key(key):
+    """ Return the truncated SHA-1 digest which persistent histories store for a key. """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return hashlib.sha1(key).digest()[:DIGEST_SIZE]
+
+
+def entry_key(entry):
+    """ Return the key an entry is remembered by: its id, or its link if it has no id. None if it has neither. """
+    return entry.get('id') or entry.get('link')
+
+
+class EntryHistory(object):
+    """
+    A bounded, insertion-ordered set of entry keys which have been displayed.
+
+    Membership tests and insertions are constant time. Once `maxlen` keys are
+    held, adding a new key evicts the oldest one.
+
+    Args:
+        maxlen (int): The maximum number of keys to remember.
+    """
+    def __init__(self, maxlen=200):
+        self.maxlen = maxlen
+        self._keys = OrderedDict()
+
+    def __repr__(self):
+        return '{0}(maxlen={1})'.format(type(self).__name__, self.maxlen)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        """ Remember a key. Returns False if it was already known. """
+        if key in self._keys:
+            return False
+        self._keys[key] = None
+        if len(self._keys) > self.maxlen:
+            self._keys.popitem(last=False)
+        return True
+
+    def close(self):
+        """ Release any resources held by the history. """
+
+
+class PersistentEntryHistory(EntryHistory):
+    """
+    An EntryHistory which survives restarts.
+
+    Keys are stored as truncated SHA-1 digests, both in memory and on disc.
+    Each new digest is appended to the history file as a fixed-size record,
+    so remembering an entry never rewrites the file. Once the file holds
+    `COMPACT_FACTOR` times more records than the history keeps, it is
+    rewritten with only the live records.
+
+    Args:
+        path (string): The history file, created if it doesn't exist.
+        maxlen (int): The maximum number of keys to remember.
+    """
+    DIGEST_SIZE = DIGEST_SIZE
+    COMPACT_FACTOR = 2
+
+    def __init__(self, path, maxlen=200):
+        super(PersistentEntryHistory, self).__init__(maxlen=maxlen)
+        self.path = path
+        self._records = self._load()
+        self._file = open(self.path, 'ab')
+
+    def __repr__(self):
+        return '{0}({1}, maxlen={2})'.format(type(self).__name__, self.path, self.maxlen)
+
+    def _load(self):
+        """ Read the newest `maxlen` digests from disc. Returns the number of records read. """
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb') as history_file:
+            data = history_file.read()
+        size = self.DIGEST_SIZE
+        records = len(data) // size
+        if len(data) % size:
+            # Drop a record torn by a crash, so later appends stay aligned.
+            with open(self.path, 'r+b') as history_file:
+                history_file.truncate(records * size)
+        first = max(0, records - self.maxlen)
+        for offset in xrange(first * size, records * size, size):
+            super(PersistentEntryHistory, self).add(data[offset:offset + size])
+        return records
+
+    def __contains__(self, key):
+        return super(PersistentEntryHistory, self).__contains__(digest_key(key))
+
+    def add(self, key):
+        """ Remember a key and append it to the history file. Returns False if it was already known. """
+        digest = digest_key(key)
+        if not super(PersistentEntryHistory, self).add(digest):
+            return False
+        self._file.write(digest)
+        self._file.flush()
+        self._records += 1
+        if self._records > self.maxlen * self.COMPACT_FACTOR:
+            self.compact()
+        return True
+
+    def compact(self):
+        """ Atomically rewrite the history file with only the remembered digests. """
+        self._file.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(''.join(self._keys))
+        os.rename(temp_path, self.path)
+        self._records = len(self._keys)
+        self._file = open(self.path, 'ab')
+
+    def close(self):
+        """ Close the history file. """
+        self._file.close()
@@ -0,0 +1,337 @@
+""" Contains the HttpCache class, an on-disk cache of downloaded feed documents. """
+
+from __future__ import absolute_import
+from email.utils import (
+    mktime_tz,
+    parsedate_tz,
+)
+import errno
+import hashlib
+import json
+import logging
+import os
+import time
+
+from .download import (
+    Download,
+    download,
+)
+from .fileutils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+def freshness_lifetime(headers, now):
+    """
+    Return the number of seconds a response may be reused without asking the server again.
+
+    `Cache-Control: s-maxage` and `max-age` take precedence over `Expires`,
+    and `no-store` and `no-cache` make the response stale straight away. The
+    `Age` header counts against the lifetime.
+
+    Returns:
+        None if the response mustn't be stored at all, otherwise a number of
+        seconds, which is 0 if the response must be revalidated before reuse.
+    """
+    directives = {}
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip().strip('"')
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    lifetime = 0
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                lifetime = int(directives[name])
+            except ValueError:
+                pass
+            break
+    else:
+        expires = _parse_http_date(headers.get('expires'))
+        if expires is not None:
+            lifetime = expires - (_parse_http_date(headers.get('date')) or now)
+    try:
+        lifetime -= int(headers.get('age', 0))
+    except ValueError:
+        pass
+    return max(0, lifetime)
+
+
+def _parse_http_date(value):
+    """ Return an HTTP date header as seconds since the epoch, or None if it can't be parsed. """
+    parsed = parsedate_tz(value) if value else None
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+class HttpCache(object):
+    """
+    A shared on-disk cache of raw feed documents, keyed by URL.
+
+    Document bodies are content addressed, stored under the SHA-1 of their
+    bytes, so a document served at several URLs, or unchanged between
+    downloads, is only stored once. Each URL has a small JSON record of the
+    response headers, the digest of its body and when it stops being fresh.
+
+    Every file is replaced atomically, so many FeedBot processes on one host
+    may share a cache directory.
+
+    When the bodies take up more than `max_size` bytes, the URLs which were
+    used longest ago are forgotten, along with bodies nothing refers to. The
+    size is kept as a running total, which is recounted from disc every
+    `SIZE_CHECK_INTERVAL` seconds to take in the other processes' bodies.
+
+    Args:
+        directory (string): Where the cache is kept. It is created if needed.
+        max_size (int): The most bytes of document bodies to keep.
+        timeout (float): Seconds to wait for a server when downloading.
+    """
+    SIZE_CHECK_INTERVAL = 60
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024, timeout=30):
+        self.directory = directory
+        self.max_size = max_size
+        self.timeout = timeout
+        self._size = None
+        self._size_checked = 0
+        self._objects_dir = os.path.join(directory, 'objects')
+        self._urls_dir = os.path.join(directory, 'urls')
+        for path in (self._objects_dir, self._urls_dir):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as error:
+                    # Another process may have created it first.
+                    if error.errno != errno.EEXIST:
+                        raise
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, self.directory)
+
+    def download(self, url, etag=None, modified=None):
+        """
+        Download a feed document, reusing the cached copy where possible.
+
+        A fresh cached copy is returned without contacting the server. A stale
+        one is revalidated, with the caller's validators or, if the caller has
+        none, the cached copy's.
+
+        Args:
+            url (string): The document's URL.
+            etag (string): The ETag of the copy the caller already has.
+            modified (string): The Last-Modified date of the copy the caller
+            already has.
+
+        Returns:
+            A `feedbot.download.Download`. Its status is 304 only if the
+            caller's validators match the current document.
+
+        Raises:
+            FeedDataError: If the document couldn't be downloaded.
+        """
+        cached = self.cached_response(url, etag, modified)
+        if cached is not None:
+            return cached
+        request_etag, request_modified = self.request_validators(url, etag, modified)
+        response = download(url, etag=request_etag, modified=request_modified, timeout=self.timeout)
+        return self.handle_response(url, response, etag, modified)
+
+    def cached_response(self, url, etag=None, modified=None, now=None):
+        """
+        Return the cached response for a URL if it is still fresh, otherwise None.
+
+        If the cached document is the one the caller's validators describe, a
+        body-less 304 `Download` is returned instead, so nothing is re-parsed.
+        """
+        now = time.time() if now is None else now
+        record = self._load_record(url)
+        if record is None or record['expires'] <= now:
+            return None
+        headers = record['headers']
+        if self._matches(headers, etag, modified):
+            self._touch(url)
+            return Download(304, '', headers)
+        content = self._read_body(record['digest'])
+        if content is None:
+            return None
+        self._touch(url)
+        return Download(record['status'], content, headers)
+
+    def request_validators(self, url, etag=None, modified=None):
+        """ Return the `(etag, modified)` validators to revalidate a URL with. """
+        if etag or modified:
+            return etag, modified
+        record = self._load_record(url)
+        if record is None:
+            return None, None
+        return record['headers'].get('etag'), record['headers'].get('last-modified')
+
+    def handle_response(self, url, response, etag=None, modified=None, now=None):
+        """
+        Store a response downloaded with `request_validators`, and return what the caller should use.
+
+        Args:
+            url (string): The URL which was requested.
+            response: The `feedbot.download.Download`.
+            etag, modified: The caller's own validators, as given to
+            `request_validators`.
+
+        Returns:
+            The response, or the cached document if the server said the
+            cached copy is still current and the caller didn't have one.
+        """
+        now = time.time() if now is None else now
+        if response.status == 304:
+            record = self._load_record(url)
+            if record is None or ((etag or modified) and not self._matches(record['headers'], etag, modified)):
+                # The server vouched for the caller's copy, not the cached one.
+                return response
+            headers = dict(record['headers'])
+            headers.update(response.headers)
+            self._save_record(url, record['status'], headers, record['digest'], now)
+            if etag or modified:
+                return response
+            content = self._read_body(record['digest'])
+            if content is None:
+                return response
+            return Download(record['status'], content, headers)
+        if 200 <= response.status < 300:
+            self.put(url, response, now=now)
+        return response
+
+    def put(self, url, response, now=None):
+        """ Store a downloaded response, unless its headers forbid it. """
+        now = time.time() if now is None else now
+        if freshness_lifetime(response.headers, now) is None:
+            self._remove_record(url)
+            return
+        digest = hashlib.sha1(response.content).hexdigest()
+        body_path = self._body_path(digest)
+        added = 0
+        if not os.path.exists(body_path):
+            body_dir = os.path.dirname(body_path)
+            if not os.path.isdir(body_dir):
+                try:
+                    os.makedirs(body_dir)
+                except OSError as error:
+                    if error.errno != errno.EEXIST:
+                        raise
+            atomic_write(body_path, response.content)
+            added = len(response.content)
+        self._save_record(url, response.status, response.headers, digest, now)
+        if self._running_size(added) > self.max_size:
+            self.evict()
+
+    def size(self):
+        """ Return the number of bytes taken by the cached bodies. """
+        return sum(os.path.getsize(path) for path in self._iter_bodies())
+
+    def _running_size(self, added=0):
+        """ Add `added` bytes to the running size and return it, recounting it if it is due. """
+        now = time.time()
+        if self._size is None or now - self._size_checked >= self.SIZE_CHECK_INTERVAL:
+            self._size, self._size_checked = self.size(), now
+        else:
+            self._size += added
+        return self._size
+
+    def evict(self):
+        """ Forget the least recently used URLs until the bodies fit in `max_size`, then remove unused bodies. """
+        records = []
+        for name in os.listdir(self._urls_dir):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self._urls_dir, name)
+            try:
+                with open(path) as record_file:
+                    digest = json.load(record_file)['digest']
+                records.append((os.path.getmtime(path), path, digest))
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+        records.sort()
+        sizes = {}
+        for body_path in self._iter_bodies():
+            sizes[os.path.basename(body_path)] = os.path.getsize(body_path)
+        users = {}
+        for _, _, digest in records:
+            users[digest] = users.get(digest, 0) + 1
+        # Bodies no URL refers to are removed below, so they don't count.
+        total = sum(size for digest, size in sizes.items() if users.get(digest))
+        for _, path, digest in records:
+            if total <= self.max_size:
+                break
+            _remove(path)
+            users[digest] -= 1
+            if not users[digest]:
+                total -= sizes.get(digest, 0)
+        for digest in sizes:
+            if not users.get(digest):
+                _remove(self._body_path(digest))
+        self._size, self._size_checked = total, time.time()
+
+    @staticmethod
+    def _matches(headers, etag, modified):
+        """ Return True if a caller's validators describe the document with these headers. """
+        if etag:
+            return etag == headers.get('etag')
+        if modified:
+            return modified == headers.get('last-modified')
+        return False
+
+    def _record_path(self, url):
+        return os.path.join(self._urls_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _body_path(self, digest):
+        return os.path.join(self._objects_dir, digest[:2], digest)
+
+    def _iter_bodies(self):
+        for fanout in os.listdir(self._objects_dir):
+            fanout_dir = os.path.join(self._objects_dir, fanout)
+            for name in os.listdir(fanout_dir):
+                if not name.startswith('.'):
+                    yield os.path.join(fanout_dir, name)
+
+    def _load_record(self, url):
+        """ Return the stored record for a URL, or None if it isn't cached. """
+        try:
+            with open(self._record_path(url)) as record_file:
+                return json.load(record_file)
+        except (IOError, ValueError):
+            return None
+
+    def _save_record(self, url, status, headers, digest, now):
+        lifetime = freshness_lifetime(headers, now) or 0
+        record = {'url': url, 'status': status, 'headers': headers, 'digest': digest, 'expires': now + lifetime}
+        atomic_write(self._record_path(url), json.dumps(record))
+
+    def _remove_record(self, url):
+        _remove(self._record_path(url))
+
+    def _touch(self, url):
+        """ Mark a URL as recently used, for eviction. """
+        try:
+            os.utime(self._record_path(url), None)
+        except OSError:
+            pass
+
+    def _read_body(self, digest):
+        """ Return a cached body, or None if it has been evicted. """
+        try:
+            with open(self._body_path(digest), 'rb') as body_file:
+                return body_file.read()
+        except (IOError, OSError):
+            logger.debug("Cached body %s has gone", digest)
+            return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
@@ -7,8 +7,12 @@ ADD_FILTER_HELP = '\n'.join([
     'will filter out articles with the phrase `acme microsoft oogle`',
     'from the `woopList` feed. Filters are case insensitive.'])
 
+ADMINS_ONLY = 'Sorry, only admins can do that.'
+
 ADDED_FILTER = 'Added: {filter_type} `{filter_term}` filter to the {feed_name} feed.'
 
+CHECKING_FEED = 'Checking {url}, hold on..'
+
 CURRENTLY_MONITORING = 'Currently monitoring: '
 
 DATA_DIR_ERROR = "Could not find a $HOME env var, pleas set $FEEDBOT_DATA_DIRECTORY env var. Using /tmp/feedbot for now."
@@ -32,6 +36,14 @@ FEED_REMOVE_HELP = '\n'.join([
 
 FEED_DATA_LOAD_ERROR = 'Error attempting to load feed data from: {path}'
 
+FEED_FETCH_ERROR = 'Could not fetch the <i>{feed_name}</i> feed: {error}'
+
+FEED_FAILING = '\tFailing: {failures} errors in a row, the last was: {error}'
+
+FEED_FAILING_RETRY = ' Skipped, next try {retry}.'
+
+FEED_SUSPENDED = 'Skipping the <i>{feed_name}</i> feed, it has failed {failures} times in a row. Next try {retry}.'
+
 FEED_EXISTS_ERROR = 'Already monitoring: {url} with name: {name}.'
 
 FEED_PARSE_ERROR = 'There was a problem parsing that url. Feedparser returned with: {error}'
@@ -57,14 +69,20 @@ FEED_NAME_URL_TEMPLATE = '<b>{name}:</b>  {url}'
 
 FEED_SEPERATOR = '===========\n\n'
 
+FETCHING_FEEDS = 'Fetching, stories will follow shortly..'
+
 FILTER_HEADER = '\tFilters in effect:\n'
 
 FILTER_KEY_VALUE = '\t{key}:  {filter}'
 
+HISTORY_LOAD_ERROR = 'Error attempting to load the story history from: {path}, already shown stories may be repeated.'
+
 OKAY = 'Okay!'
 
 NEWLINE = ' \n'
 
+NO_STATS = 'Nothing has been measured yet.'
+
 NO_NEW_ENTRIES = '<b>No new entries for the <i>{feed_name}</i> feed.</b>'
 
 SET_AGE_FILTER_HELP = '\n'.join([
@@ -72,6 +90,16 @@ SET_AGE_FILTER_HELP = '\n'.join([
     '`/set_age_filter <feed name> <n>` where n is the number of minutes.'])
 
 
+PROFILE_ERROR = 'Could not save the profile: {error}'
+
+PROFILE_HEADER = '<b>Profile saved to {path}. Most cumulative time:</b>'
+
+PROFILE_HELP = 'To profile the bot use: `/profile <seconds>`, for up to {max_seconds} seconds.'
+
+PROFILE_RUNNING = 'A profile is already running.'
+
+PROFILE_STARTED = 'Profiling for {seconds:g} seconds..'
+
 REMOVE_FILTER_HELP = '\n'.join([
     'To remove a filter from FooFeed, call `/remove_filter FooFeed <filter id>`.',
     'Eg: `/remove_filter FooFeed 3`.'])
@@ -80,4 +108,16 @@ REMOVED_FILTER = 'Removed \'{filter}\' filter from {feed} feed.'
 
 SORRY = 'Sorry?'
 
+STATS_HEADER = '<b>Time taken, median / 95th percentile:</b>'
+
+STATS_STAGE = '\t{stage}: {p50} / {p95} ({count} samples)'
+
+STATS_SLOWEST_FEEDS = '<b>Slowest feeds, fetch + parse at the 95th percentile:</b>'
+
+STATS_SLOWEST_FILTERS = '<b>Slowest filters, time per fetch:</b>'
+
+STATS_ITEM = '\t{name}: {value}'
+
+STATS_FILTER = '\t{feed} {filter}: {p50} / {p95}, kept {kept} and dropped {dropped} entries'
+
 UNKNOWN_FILTER_ERROR = 'Unknown filter type.'
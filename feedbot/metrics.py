@@ -0,0 +1,225 @@
+"""
+Contains the performance metrics the FeedBot keeps.
+
+Timings go into rolling histograms, which keep the most recent samples for
+percentiles along with running totals, and sizes and outcomes go into
+counters. Both are labelled, eg: by feed and filter. The process's metrics
+are kept in `registry`, which the FeedBot summarizes with `/stats` and can
+write out in the Prometheus text format.
+"""
+
+from __future__ import absolute_import
+from collections import deque
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+from .fileutils import atomic_write
+
+
+HELP = {
+    'fetch_seconds': 'Time taken to download a feed document.',
+    'fetch_batch_seconds': 'Time taken to download a batch of feed documents with the async fetcher.',
+    'fetch_bytes_total': 'Bytes of feed documents downloaded.',
+    'fetch_responses_total': 'Feed document responses, by HTTP status.',
+    'parse_seconds': 'Time taken to parse a feed document.',
+    'filter_seconds': 'Time spent in one filter while filtering a feed.',
+    'filter_entries_total': 'Entries a filter kept or dropped.',
+    'render_seconds': 'Time taken to format the stories of a feed.',
+    'send_seconds': 'Time taken to hand a message to the chat server.',
+    'send_delay_seconds': 'Time a message waited in the outbox before it was sent.',
+}
+
+
+class RollingHistogram(object):
+    """
+    The most recent samples of a measurement, plus a running count and sum of all of them.
+
+    Args:
+        maxlen (int): The number of samples percentiles are taken over.
+    """
+    def __init__(self, maxlen=1000):
+        self._samples = deque(maxlen=maxlen)
+        self.count = 0
+        self.total = 0.0
+
+    def __repr__(self):
+        return '{0}(count={1})'.format(type(self).__name__, self.count)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def observe(self, value):
+        """ Add a sample. """
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, percent):
+        """ Return the nearest-rank percentile of the recent samples, or None if there are none. """
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        rank = int(math.ceil(percent / 100.0 * len(samples)))
+        return samples[min(len(samples), max(1, rank)) - 1]
+
+
+class MetricsRegistry(object):
+    """
+    A thread-safe collection of labelled RollingHistograms and counters.
+
+    Every sample is also added to an unlabelled histogram of the same name,
+    which summarizes all feeds at once.
+
+    Args:
+        maxlen (int): The number of samples each histogram keeps.
+    """
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def __repr__(self):
+        return '{0}({1} histograms, {2} counters)'.format(
+            type(self).__name__, len(self._histograms), len(self._counters))
+
+    def observe(self, name, value, **labels):
+        """ Add a sample to the `name` histogram with these labels, eg: `observe('parse_seconds', 0.2, feed='foo')`. """
+        keys = [(name, ())]
+        if labels:
+            keys.append((name, tuple(sorted(labels.items()))))
+        with self._lock:
+            for key in keys:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = RollingHistogram(self.maxlen)
+                histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        """ Add to the `name` counter with these labels. """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Time a block of code into the `name` histogram, whether or not it raises. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def percentiles(self, name, percents=(50, 95), **labels):
+        """
+        Return percentiles of a histogram, or None if it has no samples.
+
+        Returns:
+            A tuple of the requested percentiles, followed by the number of
+            samples they were taken over.
+        """
+        with self._lock:
+            histogram = self._histograms.get((name, tuple(sorted(labels.items()))))
+            if histogram is None or not len(histogram):
+                return None
+            return tuple(histogram.percentile(percent) for percent in percents) + (len(histogram),)
+
+    def label_sets(self, name):
+        """ Return the labels of every labelled histogram called `name`, as dicts. """
+        with self._lock:
+            return [dict(labels) for hist_name, labels in self._histograms if hist_name == name and labels]
+
+    def counter(self, name, **labels):
+        """ Return the value of a counter. """
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def reset(self):
+        """ Forget every measurement. """
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def to_prometheus(self, prefix='feedbot_'):
+        """
+        Return the metrics in the Prometheus text exposition format.
+
+        Histograms are written as summaries with 0.5, 0.95 and 0.99 quantiles
+        over their recent samples. The unlabelled summary of a histogram is
+        only written if it has no labelled ones, so that nothing is counted
+        twice.
+        """
+        lines = []
+        with self._lock:
+            histograms = {}
+            for (name, labels), histogram in self._histograms.items():
+                histograms.setdefault(name, {})[labels] = histogram
+            for name in sorted(histograms):
+                series = histograms[name]
+                if len(series) > 1:
+                    series.pop((), None)
+                metric = prefix + name
+                lines.extend(_metadata(metric, name, 'summary'))
+                for labels in sorted(series):
+                    histogram = series[labels]
+                    for quantile in (0.5, 0.95, 0.99):
+                        value = histogram.percentile(quantile * 100)
+                        if value is not None:
+                            lines.append(_sample(metric, labels + (('quantile', str(quantile)),), value))
+                    lines.append(_sample(metric + '_sum', labels, histogram.total))
+                    lines.append(_sample(metric + '_count', labels, histogram.count))
+            counters = {}
+            for (name, labels), value in self._counters.items():
+                counters.setdefault(name, {})[labels] = value
+            for name in sorted(counters):
+                metric = prefix + name
+                lines.extend(_metadata(metric, name, 'counter'))
+                for labels in sorted(counters[name]):
+                    lines.append(_sample(metric, labels, counters[name][labels]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """ Atomically write the metrics to a file, eg: for node_exporter's textfile collector. """
+        atomic_write(path, self.to_prometheus())
+
+
+def _metadata(metric, name, metric_type):
+    lines = []
+    if name in HELP:
+        lines.append('# HELP {0} {1}'.format(metric, HELP[name]))
+    lines.append('# TYPE {0} {1}'.format(metric, metric_type))
+    return lines
+
+
+def _sample(metric, labels, value):
+    if not labels:
+        return '{0} {1!r}'.format(metric, float(value))
+    label_text = ','.join('{0}="{1}"'.format(key, _escape(value)) for key, value in labels)
+    return '{0}{{{1}}} {2!r}'.format(metric, label_text, float(value))
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def record_filter_stats(feed_name, filter_stats):
+    """ Add the filter statistics gathered by `Feed._accept_entry` to the registry. """
+    for filter_name, (seconds, kept, dropped) in filter_stats.items():
+        registry.observe('filter_seconds', seconds, feed=feed_name, filter=filter_name)
+        if kept:
+            registry.increment('filter_entries_total', kept, feed=feed_name, filter=filter_name, outcome='kept')
+        if dropped:
+            registry.increment('filter_entries_total', dropped, feed=feed_name, filter=filter_name, outcome='dropped')
+
+
+def record_response(feed_name, response):
+    """ Count the bytes and HTTP status of a downloaded `feedbot.download.Download`. """
+    registry.increment('fetch_bytes_total', len(response.content), feed=feed_name)
+    registry.increment('fetch_responses_total', feed=feed_name, status=str(response.status))
+
+
+registry = MetricsRegistry()
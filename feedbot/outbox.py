@@ -0,0 +1,83 @@
+""" Contains the Outbox and TokenBucket classes. """
+
+from __future__ import absolute_import
+import heapq
+import itertools
+import time
+
+
+INTERACTIVE = 0
+BULK = 1
+
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter.
+
+    The bucket holds up to `burst` tokens and refills at `rate` tokens per
+    second. Sending a message takes one token, so short bursts go out at once
+    while the long-run rate never exceeds `rate`.
+
+    Args:
+        rate (float): Tokens added per second.
+        burst (int): The most tokens the bucket can hold.
+    """
+    def __init__(self, rate=1.0, burst=5, now=None):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time() if now is None else now
+
+    def __repr__(self):
+        return '{0}(rate={1}, burst={2})'.format(type(self).__name__, self.rate, self.burst)
+
+    def take(self, now=None):
+        """ Take a token if one is available. Returns False if the bucket is empty. """
+        now = time.time() if now is None else now
+        elapsed = max(0, now - self._updated)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class Outbox(object):
+    """
+    A rate-limited priority queue of messages waiting to be sent.
+
+    Messages are released no faster than the TokenBucket allows. Waiting
+    `INTERACTIVE` messages, such as replies to commands, always go before
+    waiting `BULK` ones, such as stories, and messages of the same priority
+    go in the order they were queued.
+
+    Args:
+        rate (float): The number of messages which may be sent per second.
+        burst (int): The number of messages which may be sent at once.
+    """
+    def __init__(self, rate=1.0, burst=5, now=None):
+        self.bucket = TokenBucket(rate=rate, burst=burst, now=now)
+        self._queue = []
+        self._counter = itertools.count()
+
+    def __repr__(self):
+        return '{0}({1} queued)'.format(type(self).__name__, len(self._queue))
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, message, priority=INTERACTIVE):
+        """ Queue a message to be sent. """
+        heapq.heappush(self._queue, (priority, next(self._counter), message))
+
+    def pop_ready(self, now=None):
+        """ Remove and return the messages which may be sent now, in sending order. """
+        ready = []
+        while self._queue and self.bucket.take(now):
+            ready.append(heapq.heappop(self._queue)[-1])
+        return ready
+
+    def pop_all(self):
+        """ Remove and return every queued message, ignoring the rate limit. """
+        return [heapq.heappop(self._queue)[-1] for _ in xrange(len(self._queue))]
@@ -0,0 +1,93 @@
+""" Contains the ProfileSession class, which profiles a running FeedBot for a while. """
+
+from __future__ import absolute_import
+from contextlib import contextmanager
+import cProfile
+import os
+import pstats
+import threading
+import time
+
+
+class ProfileSession(object):
+    """
+    Profiles the bot's thread and its background work until `duration` seconds have passed.
+
+    cProfile only sees the thread it runs on, so the session has one profile
+    for the bot's own thread, which is switched on around command dispatch
+    and `idle_proc`, and a fresh profile for every piece of background work
+    run through `call`. The profiles are merged when the session ends.
+    Background work which is still running then is left out, as is the work
+    of the parse processes, which shows up as time spent waiting for them.
+
+    Args:
+        duration (float): How long to profile for, in seconds.
+    """
+    def __init__(self, duration, now=None):
+        now = time.time() if now is None else now
+        self.duration = duration
+        self.ends_at = now + duration
+        self._bot_profile = cProfile.Profile()
+        self._profiles = [self._bot_profile]
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def __repr__(self):
+        return '{0}(duration={1})'.format(type(self).__name__, self.duration)
+
+    def expired(self, now=None):
+        """ Return True once the session's time is up. """
+        now = time.time() if now is None else now
+        return now >= self.ends_at
+
+    @contextmanager
+    def on_bot_thread(self):
+        """ Profile a block of code on the bot's thread. """
+        self._bot_profile.enable()
+        try:
+            yield
+        finally:
+            self._bot_profile.disable()
+
+    def call(self, func, *args, **kwargs):
+        """ Call `func` under a profile of its own, eg: on a background thread, and return its result. """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with self._lock:
+                if not self._finished:
+                    self._profiles.append(profile)
+
+    def finish(self):
+        """ Stop collecting profiles and return the merged `pstats.Stats`. """
+        with self._lock:
+            self._finished = True
+            profiles = list(self._profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+def summarize(stats, limit=15):
+    """
+    Return the `limit` functions with the most cumulative time, as strings.
+
+    Eg: 'feedparser.py:3844(parse): 1.203s cumulative, 0.012s own, 12 calls'.
+    """
+    # pstats keeps its table as {(file, line, function): (primitive calls, calls, own time, cumulative time, callers)}.
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    lines = []
+    for (filename, line, function), (_, calls, own_time, cumulative_time, _) in rows:
+        location = '{0}:{1}({2})'.format(os.path.basename(filename), line, function) if line else function
+        lines.append('{0}: {1:.3f}s cumulative, {2:.3f}s own, {3} calls'.format(
+            location, cumulative_time, own_time, calls))
+    return lines
+
+
+def save_and_summarize(session, path, limit=15):
+    """ Finish a ProfileSession, write its stats to `path` and return `summarize`'s lines. """
+    stats = session.finish()
+    stats.dump_stats(path)
+    return summarize(stats, limit)
@@ -0,0 +1,93 @@
+""" Contains the FeedRegistry class, which indexes Feeds by name and URL. """
+
+from __future__ import absolute_import
+from collections import MutableMapping
+import urlparse
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """
+    Return a URL in a form which is the same for every spelling of it.
+
+    The scheme is dropped, so `http` and `https` URLs match, the host is
+    lowercased, default ports and trailing slashes are removed, and the
+    fragment is ignored. Eg: 'HTTPS://Example.com:443/feed/' and
+    'http://example.com/feed' both become '//example.com/feed'.
+    """
+    parts = urlparse.urlsplit(url.strip())
+    if not parts.netloc and not parts.scheme:
+        # A URL without a scheme, eg: 'example.com/feed'.
+        parts = urlparse.urlsplit('//' + url.strip())
+    host = (parts.hostname or '').rstrip('.')
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS.get(parts.scheme.lower()):
+        host = '{0}:{1}'.format(host, port)
+    path = parts.path.rstrip('/')
+    query = '?' + parts.query if parts.query else ''
+    return '//{0}{1}{2}'.format(host, path, query)
+
+
+class FeedRegistry(MutableMapping):
+    """
+    A dict of Feeds by name, which can also find Feeds by URL in constant time.
+
+    Besides the names, the registry keeps an index of every Feed's URL and of
+    its `normalize_url` form, and keeps them in step as Feeds are added and
+    removed. This lets the FeedBot spot a Feed which is already monitored
+    under a different spelling of its URL.
+
+    Args:
+        feeds: A dict of Feeds by name, or an iterable of (name, Feed) pairs.
+    """
+    def __init__(self, feeds=()):
+        self._feeds = {}
+        self._names_by_url = {}
+        self._names_by_normalized_url = {}
+        self.update(feeds)
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, sorted(self._feeds))
+
+    def __getitem__(self, name):
+        return self._feeds[name]
+
+    def __setitem__(self, name, feed):
+        if name in self._feeds:
+            del self[name]
+        self._feeds[name] = feed
+        self._names_by_url[feed.url] = name
+        self._names_by_normalized_url[normalize_url(feed.url)] = name
+
+    def __delitem__(self, name):
+        feed = self._feeds.pop(name)
+        if self._names_by_url.get(feed.url) == name:
+            del self._names_by_url[feed.url]
+        normalized_url = normalize_url(feed.url)
+        if self._names_by_normalized_url.get(normalized_url) == name:
+            del self._names_by_normalized_url[normalized_url]
+
+    def __iter__(self):
+        return iter(self._feeds)
+
+    def __len__(self):
+        return len(self._feeds)
+
+    def __contains__(self, name):
+        return name in self._feeds
+
+    def urls(self):
+        """ Return the URLs of the Feeds. """
+        return list(self._names_by_url)
+
+    def get_by_url(self, url):
+        """ Return the Feed with this URL, or with another spelling of it, or None. """
+        name = self._names_by_url.get(url)
+        if name is None:
+            name = self._names_by_normalized_url.get(normalize_url(url))
+        return self._feeds.get(name) if name is not None else None
@@ -0,0 +1,101 @@
+""" Contains the EntryRenderer class, which formats Feed entries as chat messages. """
+
+from __future__ import absolute_import
+from collections import OrderedDict
+import hashlib
+
+from . import messages
+from .timeutils import pub_time_to_string
+
+
+ENTRY_FIELDS = ('title', 'published', 'authors', 'link', 'summary')
+
+
+def template_version():
+    """ Return a short digest of the templates entries are rendered with. """
+    templates = [messages.ENTRY_FIELD_TEMPLATE, messages.ENTRY_PUBLISHED_FIELD_TEMPLATE, messages.NEWLINE]
+    templates.extend(ENTRY_FIELDS)
+    return hashlib.sha1('\0'.join(templates)).hexdigest()[:8]
+
+
+class EntryRenderer(object):
+    """
+    Formats Feed entries as messages, caching what doesn't change between sends.
+
+    Everything but the "About <n> minutes ago" part of a rendered entry stays
+    the same every time it is shown, so it is kept in a bounded LRU cache
+    keyed by the entry's id (or link), its updated time and the version of
+    the templates. Showing a cached entry again only formats the relative
+    publication time.
+
+    Args:
+        maxlen (int): The maximum number of rendered entries to keep.
+    """
+    def __init__(self, maxlen=500):
+        self.maxlen = maxlen
+        self.version = template_version()
+        self._cache = OrderedDict()
+
+    def __repr__(self):
+        return '{0}(maxlen={1})'.format(type(self).__name__, self.maxlen)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def render(self, entry):
+        """ Return a Feed entry formatted as one message. """
+        key = self._cache_key(entry)
+        parts = self._cache.pop(key, None) if key is not None else None
+        if parts is None:
+            parts = self._render_static(entry)
+        if key is not None:
+            self._cache[key] = parts
+            if len(self._cache) > self.maxlen:
+                self._cache.popitem(last=False)
+        head, published_parsed, tail = parts
+        if tail is None:
+            return head
+        time_string = pub_time_to_string(published_parsed)
+        return head + messages.ENTRY_PUBLISHED_FIELD_TEMPLATE.format(publication_time=time_string) + tail
+
+    def _cache_key(self, entry):
+        """ Return the key an entry is cached under, or None if it can't be identified. """
+        identity = entry.get('id') or entry.get('link')
+        if not identity:
+            return None
+        updated = entry['updated'] if 'updated' in entry else None
+        return (self.version, identity, updated)
+
+    def _render_static(self, entry):
+        """
+        Format the fields of an entry.
+
+        Returns:
+            A tuple of the text before the relative publication time, the
+            entry's `published_parsed` and the text after the relative
+            publication time. If the entry isn't shown with a publication time
+            the whole text is in the first element and the others are None.
+        """
+        field_strings = []
+        published_parsed = None
+        published_index = None
+        for field in ENTRY_FIELDS:
+            if field in entry:
+                if entry[field] == [{}]:
+                    continue
+                try:
+                    field_string = messages.ENTRY_FIELD_TEMPLATE.format(
+                        field_name=unicode(field.capitalize()),
+                        field_value=unicode(entry[field])
+                    )
+                except UnicodeEncodeError:
+                    continue
+                if field == 'published':
+                    published_parsed = entry.published_parsed
+                    published_index = len(field_strings) + 1
+                else:
+                    field_string += messages.NEWLINE
+                field_strings.append(field_string)
+        if published_index is None:
+            return ''.join(field_strings), None, None
+        return ''.join(field_strings[:published_index]), published_parsed, ''.join(field_strings[published_index:])
@@ -0,0 +1,52 @@
+""" Contains the Room class. """
+
+from __future__ import absolute_import
+
+from .registry import FeedRegistry
+
+
+class Room(object):
+    """
+    The feeds, filters and story history of one chatroom.
+
+    A FeedBot may serve many chatrooms at once. Each has its own Feeds, its
+    own store and its own history of entries which have been shown there, but
+    Feeds with the same URL are fetched and parsed once for every room which
+    follows them.
+
+    Args:
+        jid (string): The chatroom, formatted '<name>@<server>'.
+
+    Attributes:
+        data_file (string): The path of the room's data file.
+        feeds (FeedRegistry): The room's Feeds, by name. A dict assigned to it
+        is indexed as a FeedRegistry.
+        feed_store: The JsonFeedStore or SqliteFeedStore the Feeds are saved to.
+        entry_history: The EntryHistory of entries shown in the room.
+        poller: The PollScheduler which decides when the room's Feeds are polled.
+        save_due (float): When the store's journal should next be compacted, or None.
+        polls_in_flight (set): The names of Feeds which are being polled.
+        occupants (dict): The bare JIDs of the room's occupants, by nickname.
+        Only known in rooms which aren't anonymous.
+    """
+    def __init__(self, jid):
+        self.jid = jid
+        self.data_file = None
+        self.feeds = FeedRegistry()
+        self.feed_store = None
+        self.entry_history = None
+        self.poller = None
+        self.save_due = None
+        self.polls_in_flight = set()
+        self.occupants = {}
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, self.jid)
+
+    @property
+    def feeds(self):
+        return self._feeds
+
+    @feeds.setter
+    def feeds(self, feeds):
+        self._feeds = feeds if isinstance(feeds, FeedRegistry) else FeedRegistry(feeds)
@@ -0,0 +1,92 @@
+""" Contains the PollScheduler class. """
+
+from __future__ import absolute_import
+import heapq
+import random
+import time
+
+
+class PollScheduler(object):
+    """
+    Decides when each Feed should next be polled.
+
+    The scheduler keeps a priority queue of next-due times keyed by Feed name.
+    Every Feed has its own polling interval which adapts to how often the Feed
+    actually publishes: the interval halves whenever a poll finds new entries
+    and grows by half whenever a poll comes back empty, always staying within
+    [min_interval, max_interval]. A Feed may also have a maximum interval of
+    its own, eg: so that it is polled before its stories get too old. Newly
+    scheduled Feeds get a random offset so polls are spread out rather than
+    all falling due at once.
+
+    Args:
+        min_interval (float): The shortest time between polls, in seconds.
+        max_interval (float): The longest time between polls, in seconds.
+    """
+    BACKOFF = 1.5
+    SPEEDUP = 0.5
+
+    def __init__(self, min_interval=300, max_interval=21600):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self._queue = []
+        self._due = {}
+        self._intervals = {}
+
+    def __contains__(self, name):
+        return name in self._due
+
+    def __len__(self):
+        return len(self._due)
+
+    def schedule(self, name, now=None):
+        """ Start polling a Feed, at a random point within the minimum interval. """
+        now = time.time() if now is None else now
+        self._intervals.setdefault(name, self.min_interval)
+        self._push(name, now + random.uniform(0, self.min_interval))
+
+    def unschedule(self, name):
+        """ Stop polling a Feed. """
+        self._due.pop(name, None)
+        self._intervals.pop(name, None)
+
+    def get_interval(self, name):
+        """ Return the current polling interval of a Feed, in seconds. """
+        return self._intervals[name]
+
+    def pop_due(self, now=None):
+        """ Remove and return the names of all Feeds which are due, oldest first. """
+        now = time.time() if now is None else now
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            due_time, name = heapq.heappop(self._queue)
+            # Rescheduled or unscheduled Feeds leave stale queue items behind.
+            if self._due.get(name) == due_time:
+                del self._due[name]
+                due.append(name)
+        return due
+
+    def reschedule(self, name, new_entries, now=None, max_interval=None):
+        """
+        Schedule a Feed's next poll after it has been polled.
+
+        Args:
+            name (string): The name of the Feed.
+            new_entries (int): How many new entries the last poll found.
+            max_interval (float): The Feed's own maximum interval, if it is
+            shorter than the scheduler's. It never goes below `min_interval`.
+        """
+        if name not in self._intervals:
+            return
+        now = time.time() if now is None else now
+        factor = self.SPEEDUP if new_entries else self.BACKOFF
+        interval = self._intervals[name] * factor
+        if max_interval is not None:
+            interval = min(max_interval, interval)
+        interval = min(self.max_interval, max(self.min_interval, interval))
+        self._intervals[name] = interval
+        self._push(name, now + interval)
+
+    def _push(self, name, due_time):
+        self._due[name] = due_time
+        heapq.heappush(self._queue, (due_time, name))
@@ -0,0 +1,247 @@
+""" Contains the SQLite storage backend for Feeds, Filters and the entry history. """
+
+from __future__ import absolute_import
+import json
+import os
+import sqlite3
+import time
+
+from .feed import Feed
+from .history import (
+    DIGEST_SIZE,
+    EntryHistory,
+    digest_key,
+)
+from .storage import (
+    JsonFeedStore,
+    apply_change,
+)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS feeds (
+    name TEXT PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE,
+    etag TEXT,
+    modified TEXT
+);
+CREATE TABLE IF NOT EXISTS filters (
+    feed_name TEXT NOT NULL REFERENCES feeds(name) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (feed_name, position)
+);
+CREATE TABLE IF NOT EXISTS feed_stats (
+    feed_name TEXT PRIMARY KEY REFERENCES feeds(name) ON DELETE CASCADE,
+    fetches INTEGER NOT NULL DEFAULT 0,
+    new_entries INTEGER NOT NULL DEFAULT 0,
+    last_fetched REAL,
+    poll_interval REAL
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    digest BLOB NOT NULL UNIQUE
+);
+"""
+
+
+def _feed_dict(name, url, etag, modified):
+    """ Return a Feed serialization dict, without filters, from a row of the feeds table. """
+    return {'class': 'Feed', 'name': name, 'url': url, 'etag': etag, 'modified': modified, 'filters': []}
+
+
+class SqliteFeedStore(object):
+    """
+    Saves Feeds, their Filters, fetch metadata and the entry history in SQLite.
+
+    Every change is applied to just the rows it touches, inside a transaction,
+    so edits stay cheap however many Feeds there are and the database is never
+    left half-updated. The whole configuration lives in one file which can be
+    backed up with the `sqlite3` command line tool.
+
+    When the database is first created, the Feeds and entry history of the
+    JSON store are imported into it, if there are any.
+
+    Args:
+        path (string): The database file.
+        import_path (string): A JsonFeedStore snapshot to import from.
+        import_history_path (string): A PersistentEntryHistory file to import from.
+    """
+    def __init__(self, path, import_path=None, import_history_path=None):
+        self.path = path
+        self.import_path = import_path
+        self.import_history_path = import_history_path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(SCHEMA)
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, self.path)
+
+    def load(self):
+        """
+        Return a dict of Feeds, keyed by name.
+
+        Raises:
+            sqlite3.Error: If the database can't be read.
+        """
+        if self._get_meta('imported') is None:
+            self._import_json()
+        feed_data = {}
+        for row in self.connection.execute('SELECT name, url, etag, modified FROM feeds'):
+            feed_data[row[0]] = _feed_dict(*row)
+        filters = self.connection.execute('SELECT feed_name, data FROM filters ORDER BY feed_name, position')
+        for feed_name, data in filters:
+            feed_data[feed_name]['filters'].append(json.loads(data))
+        return dict((name, Feed.from_dict(data)) for name, data in feed_data.items())
+
+    def _import_json(self):
+        """ Copy the Feeds and history of the JSON store into the database. """
+        feeds = {}
+        if self.import_path and os.path.exists(self.import_path):
+            feeds = JsonFeedStore(self.import_path).load()
+        digests = []
+        if self.import_history_path and os.path.exists(self.import_history_path):
+            with open(self.import_history_path, 'rb') as history_file:
+                data = history_file.read()
+            digests = [data[offset:offset + DIGEST_SIZE] for offset in range(0, len(data) - DIGEST_SIZE + 1, DIGEST_SIZE)]
+        with self.connection:
+            for feed in feeds.values():
+                self._write_feed(feed)
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO history (digest) VALUES (?)',
+                [(sqlite3.Binary(digest),) for digest in digests])
+            self._set_meta('imported', self.import_path or '')
+
+    def _get_meta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def _read_feed(self, name):
+        """ Return a single Feed from the database. """
+        row = self.connection.execute('SELECT url, etag, modified FROM feeds WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        feed_data = _feed_dict(name, *row)
+        filters = self.connection.execute('SELECT data FROM filters WHERE feed_name = ? ORDER BY position', (name,))
+        feed_data['filters'] = [json.loads(data) for data, in filters]
+        return Feed.from_dict(feed_data)
+
+    def _write_feed(self, feed):
+        """ Insert or update a Feed and replace its Filters. """
+        updated = self.connection.execute(
+            'UPDATE feeds SET url = ?, etag = ?, modified = ? WHERE name = ?',
+            (feed.url, feed.etag, feed.modified, feed.name))
+        if not updated.rowcount:
+            self.connection.execute(
+                'INSERT INTO feeds (name, url, etag, modified) VALUES (?, ?, ?, ?)',
+                (feed.name, feed.url, feed.etag, feed.modified))
+        self.connection.execute('DELETE FROM filters WHERE feed_name = ?', (feed.name,))
+        self.connection.executemany(
+            'INSERT INTO filters (feed_name, position, data) VALUES (?, ?, ?)',
+            [(feed.name, position, json.dumps(feed_filter.to_dict()))
+             for position, feed_filter in enumerate(feed.filters)])
+
+    def record(self, operation, **change):
+        """
+        Apply a change to the database, eg: `record('remove_feed', name='foo')`.
+
+        Changes take the same form as `JsonFeedStore.record`. Only the rows of
+        the Feed being changed are read and written.
+        """
+        change['op'] = operation
+        with self.connection:
+            if operation == 'add_feed':
+                self._write_feed(Feed.from_dict(change['feed']))
+            elif operation == 'remove_feed':
+                self.connection.execute('DELETE FROM feeds WHERE name = ?', (change['name'],))
+            else:
+                feeds = {change['name']: self._read_feed(change['name'])}
+                apply_change(feeds, change)
+                self._write_feed(feeds[change['name']])
+
+    def save_fetch_state(self, feed, new_entries=0, poll_interval=None):
+        """ Save a Feed's HTTP validators and update its fetch statistics. """
+        with self.connection:
+            self.connection.execute(
+                'UPDATE feeds SET etag = ?, modified = ? WHERE name = ?',
+                (feed.etag, feed.modified, feed.name))
+            self.connection.execute(
+                'INSERT OR IGNORE INTO feed_stats (feed_name) SELECT name FROM feeds WHERE name = ?',
+                (feed.name,))
+            self.connection.execute(
+                'UPDATE feed_stats SET fetches = fetches + 1, new_entries = new_entries + ?, '
+                'last_fetched = ?, poll_interval = COALESCE(?, poll_interval) WHERE feed_name = ?',
+                (new_entries, time.time(), poll_interval, feed.name))
+
+    def get_feed_stats(self, name):
+        """ Return a dict of the fetch statistics of a Feed, or None if there aren't any. """
+        cursor = self.connection.execute(
+            'SELECT fetches, new_entries, last_fetched, poll_interval FROM feed_stats WHERE feed_name = ?',
+            (name,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def open_history(self, maxlen):
+        """ Return the entry history kept in the database. """
+        return SqliteEntryHistory(self.connection, maxlen=maxlen)
+
+    def needs_compaction(self):
+        """ Changes are applied in place, so the database never needs compacting. """
+        return False
+
+    def start_compaction(self, feeds):
+        """ Save every Feed's HTTP validators. Returns a function which does nothing. """
+        with self.connection:
+            for feed in feeds:
+                self.connection.execute(
+                    'UPDATE feeds SET etag = ?, modified = ? WHERE name = ?',
+                    (feed.etag, feed.modified, feed.name))
+        return lambda: None
+
+    def close(self):
+        """ Close the database. """
+        self.connection.close()
+
+
+class SqliteEntryHistory(EntryHistory):
+    """
+    An EntryHistory kept in the `history` table of a SqliteFeedStore.
+
+    Like `feedbot.history.PersistentEntryHistory` it stores truncated digests
+    of its keys. The newest `maxlen` digests are held in memory for fast
+    lookups, and rows older than that are deleted as new ones are added.
+
+    Args:
+        connection: The store's sqlite3 connection.
+        maxlen (int): The maximum number of keys to remember.
+    """
+    def __init__(self, connection, maxlen=200):
+        super(SqliteEntryHistory, self).__init__(maxlen=maxlen)
+        self.connection = connection
+        rows = connection.execute('SELECT digest FROM history ORDER BY id DESC LIMIT ?', (maxlen,)).fetchall()
+        for digest, in reversed(rows):
+            super(SqliteEntryHistory, self).add(str(digest))
+
+    def __contains__(self, key):
+        return super(SqliteEntryHistory, self).__contains__(digest_key(key))
+
+    def add(self, key):
+        """ Remember a key and insert it into the database. Returns False if it was already known. """
+        digest = digest_key(key)
+        if not super(SqliteEntryHistory, self).add(digest):
+            return False
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT OR REPLACE INTO history (digest) VALUES (?)', (sqlite3.Binary(digest),))
+            self.connection.execute('DELETE FROM history WHERE id <= ?', (cursor.lastrowid - self.maxlen,))
+        return True
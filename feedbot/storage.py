@@ -0,0 +1,215 @@
+""" Contains the classes which persist Feeds and their Filters. """
+
+from __future__ import absolute_import
+import json
+import logging
+import os
+import threading
+
+from . import exceptions
+from .feed import Feed
+from .fileutils import atomic_write
+from .filters import FilterBase
+from .history import (
+    EntryHistory,
+    PersistentEntryHistory,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def apply_change(feeds, change):
+    """
+    Apply a change recorded by `JsonFeedStore.record` to a dict of Feeds.
+
+    Raises:
+        KeyError, ValueError: If the change doesn't make sense for these Feeds.
+    """
+    operation = change['op']
+    if operation == 'add_feed':
+        feed = Feed.from_dict(change['feed'])
+        feeds[feed.name] = feed
+    elif operation == 'remove_feed':
+        del feeds[change['name']]
+    elif operation == 'add_filter':
+        feeds[change['name']].add_filter(FilterBase.from_dict(change['filter']))
+    elif operation == 'remove_filter':
+        feed = feeds[change['name']]
+        feed.remove_filter(feed.get_filter_by_key(change['index']))
+    elif operation == 'set_age_filter':
+        feeds[change['name']].set_age_filter(change['minutes'])
+    else:
+        raise ValueError("Unknown operation: {0}".format(operation))
+
+
+class JsonFeedStore(object):
+    """
+    Saves Feeds as a JSON snapshot plus an append-only journal of changes.
+
+    Every change to the Feed configuration is appended to the journal as one
+    line of JSON, so an edit costs the same however many Feeds there are.
+    Loading reads the snapshot and replays the journal on top of it. Once the
+    journal holds `compact_threshold` changes, the FeedBot compacts it: the
+    journal is set aside, a new snapshot is written and the old journal is
+    deleted.
+
+    Journal lines are numbered and the snapshot records the number of the last
+    change it contains, so a crash part way through a compaction never causes
+    a change to be replayed twice. Compactions which overlap, eg: a forced one
+    at shutdown while a background one is still running, take turns, and an
+    older snapshot is never written over a newer one.
+
+    Snapshots written by earlier versions, a bare list of serialized Feeds,
+    are still understood.
+
+    Args:
+        path (string): The snapshot file. The journal lives next to it.
+        history_path (string): The file to keep the entry history in, see
+        `feedbot.history.PersistentEntryHistory`. If it isn't given the
+        history is only kept in memory.
+        compact_threshold (int): The number of journaled changes which makes
+        the store ask for a compaction.
+    """
+    def __init__(self, path, history_path=None, compact_threshold=500):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.history_path = history_path
+        self.compact_threshold = compact_threshold
+        self._sequence = 0
+        self._journaled = 0
+        self._journal = None
+        self._compaction_lock = threading.Lock()
+        self._compacted_sequence = None
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, self.path)
+
+    def load(self):
+        """
+        Return a dict of Feeds, keyed by name, built from the snapshot and journal.
+
+        Raises:
+            ValueError, DeserializationError: If the snapshot can't be parsed.
+        """
+        feeds = {}
+        snapshot_sequence = 0
+        with open(self.path, 'r') as data_file:
+            data = data_file.read()
+        if data.strip():
+            snapshot = json.loads(data)
+            if isinstance(snapshot, dict):
+                snapshot_sequence = snapshot['journal_sequence']
+                snapshot = snapshot['feeds']
+            for feed_data in snapshot:
+                feed = Feed.from_dict(feed_data)
+                feeds[feed.name] = feed
+
+        self._sequence = snapshot_sequence
+        self._journaled = 0
+        for journal_path in self._journal_paths():
+            for change in self._read_journal(journal_path):
+                if change['seq'] <= snapshot_sequence:
+                    continue
+                try:
+                    apply_change(feeds, change)
+                except (KeyError, IndexError, ValueError, exceptions.DeserializationError):
+                    logger.warning("Skipping journaled change which doesn't apply: %s", change)
+                self._sequence = change['seq']
+                self._journaled += 1
+        return feeds
+
+    def _journal_paths(self):
+        """ Return the journals which haven't been compacted yet, oldest first. """
+        paths = [path for _, path in sorted(self._set_aside_journals())]
+        if os.path.exists(self.journal_path):
+            paths.append(self.journal_path)
+        return paths
+
+    def _set_aside_journals(self):
+        """ Return (sequence, path) pairs for the journals set aside by compactions. """
+        data_dir = os.path.dirname(self.journal_path) or '.'
+        prefix = os.path.basename(self.journal_path) + '.'
+        journals = []
+        for filename in os.listdir(data_dir):
+            suffix = filename[len(prefix):]
+            if filename.startswith(prefix) and suffix.isdigit():
+                journals.append((int(suffix), os.path.join(data_dir, filename)))
+        return journals
+
+    def _read_journal(self, journal_path):
+        """ Return the changes in a journal, dropping a last line torn by a crash. """
+        with open(journal_path, 'r+') as journal:
+            lines = journal.read().split('\n')
+            torn_line = lines.pop()
+            if torn_line:
+                # Later changes are appended, so they mustn't end up on this line.
+                journal.truncate(journal.tell() - len(torn_line))
+        return [json.loads(line) for line in lines]
+
+    def record(self, operation, **change):
+        """ Append a change to the journal, eg: `record('remove_feed', name='foo')`. """
+        self._sequence += 1
+        change.update(op=operation, seq=self._sequence)
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a')
+        self._journal.write(json.dumps(change) + '\n')
+        self._journal.flush()
+        self._journaled += 1
+
+    def save_fetch_state(self, feed, new_entries=0, poll_interval=None):
+        """
+        Save what was learnt by fetching a Feed.
+
+        A Feed's HTTP validators are saved with the next snapshot, and fetch
+        statistics aren't kept by this store, so this does nothing.
+        """
+
+    def open_history(self, maxlen):
+        """
+        Return the entry history kept with this store.
+
+        Raises:
+            IOError, OSError: If the history file can't be opened.
+        """
+        if self.history_path is None:
+            return EntryHistory(maxlen=maxlen)
+        return PersistentEntryHistory(self.history_path, maxlen=maxlen)
+
+    def needs_compaction(self):
+        """ Has the journal grown past the compaction threshold? """
+        return self._journaled >= self.compact_threshold
+
+    def start_compaction(self, feeds):
+        """
+        Snapshot the given Feeds and set the current journal aside.
+
+        This is quick and must happen on the thread which records changes. It
+        returns a function which does the slow part, writing the snapshot and
+        deleting the journals it replaces, and can run on any thread.
+        """
+        snapshot = json.dumps({
+            'journal_sequence': self._sequence,
+            'feeds': [feed.to_dict() for feed in feeds]})
+        sequence = self._sequence
+        self.close()
+        if os.path.exists(self.journal_path):
+            os.rename(self.journal_path, '{0}.{1}'.format(self.journal_path, sequence))
+        self._journaled = 0
+
+        def compact():
+            with self._compaction_lock:
+                if self._compacted_sequence is not None and self._compacted_sequence >= sequence:
+                    # A later compaction got there first, and replaced this one's journals.
+                    return
+                atomic_write(self.path, snapshot)
+                self._compacted_sequence = sequence
+                for journal_sequence, journal_path in self._set_aside_journals():
+                    if journal_sequence <= sequence:
+                        os.remove(journal_path)
+        return compact
+
+    def close(self):
+        """ Close the journal. """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
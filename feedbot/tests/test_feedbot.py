@@ -1,18 +1,82 @@
+from BaseHTTPServer import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
 from datetime import timedelta
+from email.utils import formatdate
+from SocketServer import ThreadingMixIn
+import json
+import multiprocessing
+import os
+import threading
+import time
 
 from feedparser import FeedParserDict
 from mock import (
     Mock,
+    call,
     patch
 )
 import pytest
+from xmpp import (
+    NS_MUC_USER,
+    Message,
+    Presence,
+)
 
 from .. import messages
+from .. import metrics
+from .. import outbox
+from ..asyncfetch import AsyncFetcher
+from ..breaker import CircuitBreaker
 from ..bot import (
     FeedBot,
     utc_now,
 )
-from ..feed import Feed
+from ..download import (
+    Download,
+    download,
+)
+from ..entry import Entry
+from ..feed import (
+    Feed,
+    parse_entries,
+)
+from ..fetch import (
+    FetchResult,
+    FetchTimeoutError,
+    fetch_feeds,
+)
+from ..matcher import TermMatcher
+from ..metrics import (
+    MetricsRegistry,
+    RollingHistogram,
+)
+from ..profiling import (
+    ProfileSession,
+    save_and_summarize,
+    summarize,
+)
+from ..render import EntryRenderer
+from ..sqlite_storage import SqliteFeedStore
+from ..storage import (
+    JsonFeedStore,
+    atomic_write,
+)
+from ..httpcache import (
+    HttpCache,
+    freshness_lifetime,
+)
+from ..history import (
+    EntryHistory,
+    PersistentEntryHistory,
+)
+from ..registry import (
+    FeedRegistry,
+    normalize_url,
+)
+from ..room import Room
+from ..scheduler import PollScheduler
 from ..filters import (
     AgeFilter,
     FilterBase,
@@ -43,6 +107,111 @@ STALE_FEED_ENTRY = FeedParserDict({
     'published_parsed': (2000, 1, 1, 1, 1, 1),
 })
 
+RSS_DOCUMENT = """<?xml version="1.0"?>
+<rss version="2.0"><channel><title>Test</title>
+<item><title>look, a title</title><link>http://test.org/good</link>
+<description>perfectly innocent test summary</description></item>
+<item><title>foobar</title><link>http://test.org/bad</link>
+<description>a summary</description></item>
+</channel></rss>"""
+
+RSS_HEADERS = {'content-type': 'application/rss+xml'}
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    """ Serves RSS_DOCUMENT, honouring If-None-Match. """
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', RSS_HEADERS['content-type'])
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(RSS_DOCUMENT)))
+        self.end_headers()
+        self.wfile.write(RSS_DOCUMENT)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def feed_server(request):
+    """ Run a local HTTP server which serves RSS_DOCUMENT. Returns its base URL. """
+    server = HTTPServer(('127.0.0.1', 0), FeedRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    return 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+class KeepAliveRequestHandler(BaseHTTPRequestHandler):
+    """ An HTTP/1.1 stand-in feed server which records the connections it is sent requests on. """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        if self.path == '/slow':
+            time.sleep(1)
+        if self.path == '/moved':
+            self.send_response(301)
+            self.send_header('Location', '/feed.xml')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+        elif self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Content-Type', RSS_HEADERS['content-type'])
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(RSS_DOCUMENT), 100):
+                chunk = RSS_DOCUMENT[start:start + 100]
+                self.wfile.write('{0:x}\r\n{1}\r\n'.format(len(chunk), chunk))
+            self.wfile.write('0\r\n\r\n')
+        elif self.path == '/missing':
+            self.send_error(404)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', RSS_HEADERS['content-type'])
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(RSS_DOCUMENT)))
+            self.end_headers()
+            self.wfile.write(RSS_DOCUMENT)
+        if self.server.close_connections:
+            # Hang up without saying so, like a server dropping idle connections.
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    close_connections = False
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), KeepAliveRequestHandler)
+        self.connections = set()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+
+@pytest.fixture
+def keepalive_server(request):
+    """ Run a local keep-alive HTTP/1.1 server which serves RSS_DOCUMENT. """
+    server = KeepAliveServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    return server
+
 
 class TestSetupMixin(object):
     """ Class to setup the fixture for Feedbot tests. """
@@ -66,6 +235,42 @@ class TestFilters(TestSetupMixin, object):
         assert self.not_filter.discard_entry(FOOBAR_FEED_ENTRY) is True
         assert self.not_filter.discard_entry(GOOD_FEED_ENTRY) is False
 
+    def test_age_filter_round_trip(self):
+        """ Assert that AgeFilter windows of a day or more survive serialization. """
+        age_filter = FilterBase.from_dict(AgeFilter(minutes=2880).to_dict())
+        assert age_filter.get_window() == 2880
+        assert age_filter.window == timedelta(days=2)
+
+    def test_not_filter_strips_html(self):
+        """ Assert that NotFilters match the text of an entry, not its markup. """
+        entry = FeedParserDict({'summary': '<b>FOO</b>bar', 'title': 'a <i>title</i>'})
+        assert self.not_filter.discard_entry(entry) is True
+        assert NotFilter('<b>').discard_entry(entry) is False
+
+
+class TestTermMatcher(object):
+    """ Tests for the multi-term TermMatcher. """
+    def test_search(self):
+        """ Assert that the matcher finds any of its terms, anywhere in the text. """
+        matcher = TermMatcher(['foo bar', 'food', 'baz', 'a.b'])
+        assert matcher.search('some foo bar here')
+        assert matcher.search('seafood')
+        assert matcher.search('bazooka')
+        assert matcher.search('xa.by')
+        assert not matcher.search('fo bar axb')
+
+    def test_overlapping_terms(self):
+        """ Assert that terms which contain other terms still match. """
+        matcher = TermMatcher(['foobar', 'foo', 'oba'])
+        assert matcher.search('xfoox')
+        assert matcher.search('xobax')
+        assert not matcher.search('fo-ob-ar')
+
+    def test_empty(self):
+        """ Assert the edge cases of no terms and an empty term. """
+        assert not TermMatcher().search('anything')
+        assert TermMatcher(['']).search('anything')
+
 
 class TestFeed(TestSetupMixin, object):
     """ Tests for the feedbot Feed class. """
@@ -75,19 +280,141 @@ class TestFeed(TestSetupMixin, object):
         assert self.feed._accept_entry(FOOBAR_FEED_ENTRY) is False
         assert self.feed._accept_entry(STALE_FEED_ENTRY) is False
 
-    @patch('feedbot.bot.Feed.get_raw_feed')
-    def test_get_filtered_stream(self, feed):
-        """ Assert that feed returns a filtered stream. """
-        feed.return_value = FeedParserDict({'entries': [GOOD_FEED_ENTRY, FOOBAR_FEED_ENTRY, STALE_FEED_ENTRY]})
-        assert self.feed.get_filtered_feed() == [GOOD_FEED_ENTRY]
+    @patch('feedbot.filters.BeautifulSoup')
+    def test_accept_entry_parses_html_once(self, BeautifulSoup):
+        """ Assert that every NotFilter shares one parse of the entry. """
+        BeautifulSoup.return_value.get_text.return_value = 'perfectly innocent'
+        for term in ['foo', 'bar', 'baz']:
+            self.feed.add_filter(NotFilter(term))
+
+        assert self.feed._accept_entry(GOOD_FEED_ENTRY) is True
+        assert BeautifulSoup.call_count == 1
+
+    def test_filter_pipeline_order(self):
+        """ Assert that the cheap AgeFilter runs before the NotFilters. """
+        pipeline = self.feed._get_filter_pipeline()
+        assert pipeline[0] is self.age_filter
+        assert [type(feed_filter).__name__ for feed_filter in pipeline] == ['AgeFilter', 'NotFilterGroup']
+
+    @patch('feedbot.filters.normalize_text')
+    def test_accept_entry_short_circuits(self, normalize_text):
+        """ Assert that stale entries are dropped without looking at their text. """
+        assert self.feed._accept_entry(STALE_FEED_ENTRY) is False
+        assert not normalize_text.called
+
+    def test_accept_compact_entry(self):
+        """ Assert that Entries are filtered like the Feed Parser entries they came from. """
+        assert self.feed._accept_entry(Entry.from_parsed(GOOD_FEED_ENTRY)) is True
+        assert self.feed._accept_entry(Entry.from_parsed(FOOBAR_FEED_ENTRY)) is False
+        assert self.feed._accept_entry(Entry.from_parsed(STALE_FEED_ENTRY)) is False
+
+    @patch('feedbot.feed.utc_now')
+    @patch('feedbot.feed.feedparser.parse')
+    @patch('feedbot.feed.download')
+    def test_get_filtered_stream_single_now(self, download, parse, utc_now):
+        """ Assert that one filtering pass asks for the time once. """
+        utc_now.return_value = now
+        download.return_value = Download(200, RSS_DOCUMENT, {})
+        parse.return_value = FeedParserDict({'bozo': 0, 'entries': [GOOD_FEED_ENTRY, FOOBAR_FEED_ENTRY, STALE_FEED_ENTRY]})
+        assert self.feed.get_filtered_feed() == [Entry.from_parsed(GOOD_FEED_ENTRY)]
+        assert utc_now.call_count == 1
+
+    @patch('feedbot.feed.feedparser.parse')
+    @patch('feedbot.feed.download')
+    def test_get_filtered_stream(self, download, parse):
+        """ Assert that feed returns a filtered stream of Entries. """
+        download.return_value = Download(200, RSS_DOCUMENT, {'content-type': 'application/rss+xml'})
+        parse.return_value = FeedParserDict({'bozo': 0, 'entries': [GOOD_FEED_ENTRY, FOOBAR_FEED_ENTRY, STALE_FEED_ENTRY]})
+        filtered = self.feed.get_filtered_feed()
+        assert filtered == [Entry.from_parsed(GOOD_FEED_ENTRY)]
+        assert isinstance(filtered[0], Entry)
+        document, = parse.call_args[0]
+        assert document.read() == RSS_DOCUMENT
+        assert parse.call_args[1] == {'response_headers': {'content-type': 'application/rss+xml'}}
+
+    @pytest.mark.parametrize('body', ['{path}', 'file://{path}'])
+    def test_body_is_never_a_location(self, body, tmpdir):
+        """ Assert that a body which looks like a path or URL is parsed as a document, not opened. """
+        local_file = tmpdir.join('local.xml')
+        local_file.write(RSS_DOCUMENT)
+        with pytest.raises(FeedDataError):
+            parse_entries(body.format(path=local_file), {})
 
-    @patch('feedbot.bot.Feed.get_raw_feed')
-    def test_get_filtered_stream_raises_stream_error(self, feed):
+    @patch('feedbot.feed.feedparser.parse')
+    @patch('feedbot.feed.download')
+    def test_get_filtered_stream_raises_stream_error(self, download, parse):
         """ Assert FeedDataError is raised if there are no entries. """
-        feed.return_value = FeedParserDict()
+        download.return_value = Download(200, '', {})
+        parse.return_value = FeedParserDict({'bozo': 0})
         with pytest.raises(FeedDataError):
             self.feed.get_filtered_feed()
 
+    @patch('feedbot.feed.download')
+    def test_get_raw_feed_timeout(self, download):
+        """ Assert that checking a feed downloads it with a timeout, so a hung server can't block a worker. """
+        download.return_value = Download(200, RSS_DOCUMENT, RSS_HEADERS)
+        assert self.feed.get_raw_feed(timeout=5).entries
+        download.assert_called_with(self.feed.url, timeout=5)
+
+    @patch('feedbot.feed.download')
+    def test_get_entries_sends_validators(self, download):
+        """ Assert that the Feed remembers and sends its HTTP validators. """
+        download.return_value = Download(200, RSS_DOCUMENT, dict(RSS_HEADERS, etag='abc', **{'last-modified': 'yesterday'}))
+        self.feed.get_entries()
+        self.feed.get_entries()
+
+        download.assert_called_with(self.feed_url, etag='abc', modified='yesterday', timeout=30)
+        assert self.feed.etag == 'abc'
+        assert self.feed.modified == 'yesterday'
+
+    @patch('feedbot.feed.download')
+    def test_get_entries_not_modified(self, download):
+        """ Assert that a 304 response reuses the last entries. """
+        download.return_value = Download(200, RSS_DOCUMENT, dict(RSS_HEADERS, etag='abc'))
+        entries = self.feed.get_entries()
+
+        download.return_value = Download(304, '', {})
+        assert self.feed.get_entries() is entries
+        assert self.feed.etag == 'abc'
+
+    @patch('feedbot.feed.download')
+    def test_get_entries_without_cache(self, download):
+        """ Assert that validators restored from disc are sent, and a 304 falls back to a full download. """
+        download.side_effect = [Download(304, '', {}), Download(200, RSS_DOCUMENT, RSS_HEADERS)]
+        self.feed.etag = 'abc'
+
+        assert [entry.title for entry in self.feed.get_entries()] == ['look, a title', 'foobar']
+        assert download.call_args_list == [
+            call(self.feed_url, etag='abc', modified=None, timeout=30),
+            call(self.feed_url, etag=None, modified=None, timeout=30),
+        ]
+
+    @patch('feedbot.feed.download')
+    def test_parse_in_process_pool(self, download):
+        """ Assert that Feeds can be parsed in another process. """
+        download.return_value = Download(200, RSS_DOCUMENT, RSS_HEADERS)
+        pool = multiprocessing.Pool(1)
+        try:
+            entries = list(self.feed.iter_filtered_entries(pool=pool))
+            assert [entry.link for entry in entries] == ['http://test.org/good']
+
+            download.return_value = Download(304, '', {})
+            assert list(self.feed.iter_filtered_entries(pool=pool)) == entries
+        finally:
+            pool.terminate()
+
+    def test_filter_changes_rebuild_matcher(self):
+        """ Assert that adding and removing NotFilters updates the Feed's matcher. """
+        bad_juju = NotFilter("juju")
+        entry = FeedParserDict({'summary': 'bad juju', 'title': 'a title', 'published_parsed': NOW_TUPLE})
+        assert self.feed._accept_entry(entry) is True
+
+        self.feed.add_filter(bad_juju)
+        assert self.feed._accept_entry(entry) is False
+
+        self.feed.remove_filter(bad_juju)
+        assert self.feed._accept_entry(entry) is True
+
     def test_add_filter(self):
         """ Assert that new Filters are added to the Feed. """
         number_of_filters = len(self.feed.get_filters())
@@ -116,15 +443,624 @@ class TestFeed(TestSetupMixin, object):
             assert self.feed.get_filter_by_key(index) == feed_filter
 
 
+class TestFeedRegistry(object):
+    """ Tests for the FeedRegistry and URL normalization. """
+    def setup(self):
+        self.feed = Feed('news', 'http://Example.com/feed/')
+        self.registry = FeedRegistry({'news': self.feed})
+
+    def test_normalize_url(self):
+        """ Assert that spellings of the same URL normalize alike, and different URLs don't. """
+        assert normalize_url('HTTPS://Example.COM:443/feed/') == normalize_url('http://example.com/feed')
+        assert normalize_url('example.com/feed') == normalize_url('http://example.com/feed')
+        assert normalize_url('http://example.com:8080/feed') != normalize_url('http://example.com/feed')
+        assert normalize_url('http://example.com/feed?page=2') != normalize_url('http://example.com/feed')
+
+    def test_lookups(self):
+        """ Assert that Feeds can be found by name, URL or another spelling of the URL. """
+        assert self.registry['news'] is self.feed
+        assert self.registry.get_by_url('http://Example.com/feed/') is self.feed
+        assert self.registry.get_by_url('https://example.com/feed') is self.feed
+        assert self.registry.get_by_url('http://example.com/other') is None
+        assert self.registry.urls() == ['http://Example.com/feed/']
+
+    def test_indexes_follow_changes(self):
+        """ Assert that the URL indexes are updated when Feeds are replaced or removed. """
+        replacement = Feed('news', 'http://example.org/rss')
+        self.registry['news'] = replacement
+        assert self.registry.get_by_url('http://example.com/feed') is None
+        assert self.registry.get_by_url('http://example.org/rss') is replacement
+
+        del self.registry['news']
+        assert self.registry.get_by_url('http://example.org/rss') is None
+        assert not self.registry and self.registry.urls() == []
+
+
+class TestDownload(object):
+    """ Tests for the HTTP download stage. """
+    def test_download(self, feed_server):
+        """ Assert that documents are downloaded unparsed, with their validators. """
+        response = download(feed_server + '/feed.xml')
+        assert response.status == 200
+        assert response.content == RSS_DOCUMENT
+        assert response.headers['etag'] == '"v1"'
+        assert response.headers['content-location'] == feed_server + '/feed.xml'
+
+        assert download(feed_server + '/feed.xml', etag='"v1"').status == 304
+
+    def test_download_errors(self, feed_server):
+        """ Assert that HTTP and network errors are raised as FeedDataErrors. """
+        with pytest.raises(FeedDataError):
+            download(feed_server + '/missing')
+        with pytest.raises(FeedDataError):
+            download('http://127.0.0.1:1/feed.xml')
+
+
+class TestHttpCache(object):
+    """ Tests for the on-disk HttpCache. """
+    def setup(self):
+        self.url = 'http://test.org/feed.xml'
+        self.headers = dict(RSS_HEADERS, etag='"v1"', **{'cache-control': 'max-age=60'})
+
+    def test_freshness_lifetime(self):
+        """ Assert that Cache-Control takes precedence over Expires, and Age counts against both. """
+        assert freshness_lifetime({'cache-control': 'max-age=60', 'age': '10'}, 0) == 50
+        assert freshness_lifetime({'cache-control': 's-maxage=30, max-age=60'}, 0) == 30
+        assert freshness_lifetime({'cache-control': 'no-cache, max-age=60'}, 0) == 0
+        assert freshness_lifetime({'cache-control': 'no-store'}, 0) is None
+        assert freshness_lifetime({
+            'date': 'Thu, 01 Jan 2015 00:00:00 GMT', 'expires': 'Thu, 01 Jan 2015 00:02:00 GMT'}, 0) == 120
+        assert freshness_lifetime({}, 0) == 0
+
+    @patch('feedbot.httpcache.download')
+    def test_fresh_copies_are_reused(self, mock_download, tmpdir):
+        """ Assert that fresh documents are served from disc, and unchanged ones as 304s. """
+        mock_download.return_value = Download(200, RSS_DOCUMENT, self.headers)
+        cache = HttpCache(str(tmpdir))
+        assert cache.download(self.url).content == RSS_DOCUMENT
+
+        other_process_cache = HttpCache(str(tmpdir))
+        response = other_process_cache.download(self.url)
+        assert (response.status, response.content) == (200, RSS_DOCUMENT)
+        assert response.headers['etag'] == '"v1"'
+        assert other_process_cache.download(self.url, etag='"v1"').status == 304
+        assert mock_download.call_count == 1
+
+    @patch('feedbot.httpcache.download')
+    def test_stale_copies_are_revalidated(self, mock_download, tmpdir):
+        """ Assert that stale documents are revalidated with the cached validators. """
+        cache = HttpCache(str(tmpdir))
+        stale_headers = dict(self.headers, **{'cache-control': 'no-cache'})
+        mock_download.return_value = Download(200, RSS_DOCUMENT, stale_headers)
+        cache.download(self.url)
+
+        mock_download.return_value = Download(304, '', {'cache-control': 'max-age=60'})
+        response = cache.download(self.url)
+        mock_download.assert_called_with(self.url, etag='"v1"', modified=None, timeout=30)
+        assert (response.status, response.content) == (200, RSS_DOCUMENT)
+
+        cache.download(self.url)
+        assert mock_download.call_count == 2
+
+    @patch('feedbot.httpcache.download')
+    def test_no_store(self, mock_download, tmpdir):
+        """ Assert that responses marked no-store aren't kept. """
+        mock_download.return_value = Download(200, RSS_DOCUMENT, dict(RSS_HEADERS, **{'cache-control': 'no-store'}))
+        cache = HttpCache(str(tmpdir))
+        cache.download(self.url)
+        cache.download(self.url)
+        assert mock_download.call_count == 2
+        assert cache.size() == 0
+
+    def test_bodies_are_shared_and_evicted(self, tmpdir):
+        """ Assert that identical bodies are stored once, and the least recently used URLs go first. """
+        cache = HttpCache(str(tmpdir), max_size=len(RSS_DOCUMENT) * 2 + 3)
+        for name, content in [('a', RSS_DOCUMENT), ('b', RSS_DOCUMENT), ('c', RSS_DOCUMENT + ' ')]:
+            cache.put('http://test.org/' + name, Download(200, content, self.headers))
+        assert cache.size() == len(RSS_DOCUMENT) * 2 + 1
+
+        os.utime(cache._record_path('http://test.org/a'), (0, 0))
+        os.utime(cache._record_path('http://test.org/b'), (0, 0))
+        cache.put('http://test.org/d', Download(200, RSS_DOCUMENT + '  ', self.headers))
+
+        assert cache.cached_response('http://test.org/a') is None
+        assert cache.cached_response('http://test.org/b') is None
+        assert cache.cached_response('http://test.org/c').content == RSS_DOCUMENT + ' '
+        assert cache.cached_response('http://test.org/d').content == RSS_DOCUMENT + '  '
+        assert cache.size() == len(RSS_DOCUMENT) * 2 + 3
+
+    def test_raw_feed_body_is_never_a_location(self, tmpdir):
+        """ Assert that checking a feed never opens a body which looks like a URL. """
+        local_file = tmpdir.join('local.xml')
+        local_file.write(RSS_DOCUMENT)
+        cache = Mock()
+        cache.download.return_value = Download(200, 'file://{0}'.format(local_file), {})
+        with pytest.raises(FeedDataError):
+            Feed('test', 'http://test.org/feed.xml').get_raw_feed(cache=cache)
+
+    def test_size_is_a_running_total(self, tmpdir):
+        """ Assert that storing documents doesn't recount the whole cache every time. """
+        cache = HttpCache(str(tmpdir))
+        with patch.object(cache, 'size', wraps=cache.size) as size:
+            for name in 'abc':
+                cache.put('http://test.org/' + name, Download(200, RSS_DOCUMENT + name, self.headers))
+            assert size.call_count == 1
+            assert cache._running_size() == cache.size() == (len(RSS_DOCUMENT) + 1) * 3
+
+            cache._size_checked -= cache.SIZE_CHECK_INTERVAL
+            cache.put('http://test.org/d', Download(200, RSS_DOCUMENT, self.headers))
+            assert size.call_count == 3
+
+    def test_feed_downloads_through_cache(self, tmpdir):
+        """ Assert that Feeds download through a cache when given one. """
+        cache = Mock()
+        cache.download.return_value = Download(200, RSS_DOCUMENT, RSS_HEADERS)
+        feed = Feed('test', 'http://test.org/feed.xml')
+
+        assert [entry.link for entry in feed.get_entries(cache=cache)] == ['http://test.org/good', 'http://test.org/bad']
+        cache.download.assert_called_with(feed.url, etag=None, modified=None)
+        assert feed.get_raw_feed(cache=cache).entries[0].link == 'http://test.org/good'
+
+
+class TestAsyncFetcher(object):
+    """ Tests for the single threaded AsyncFetcher. """
+    def setup(self):
+        self.fetcher = AsyncFetcher(per_host=2, timeout=5)
+
+    def teardown(self):
+        self.fetcher.close()
+
+    def test_fetch_many(self, keepalive_server):
+        """ Assert that many documents are fetched over a few reused connections. """
+        urls = [keepalive_server.url + '/feed{0}.xml'.format(index) for index in range(20)]
+        results = self.fetcher.fetch([(url, None, None) for url in urls])
+
+        assert [result.content for result in results] == [RSS_DOCUMENT] * 20
+        assert [result.headers['content-location'] for result in results] == urls
+        assert len(keepalive_server.connections) <= 2
+
+        self.fetcher.fetch([(keepalive_server.url + '/again.xml', None, None)])
+        assert len(keepalive_server.connections) <= 2
+
+    def test_responses(self, keepalive_server):
+        """ Assert that chunked, redirected, unmodified and missing documents are handled. """
+        url = keepalive_server.url
+        chunked, moved, unmodified, missing, unsupported = self.fetcher.fetch([
+            (url + '/chunked', None, None),
+            (url + '/moved', None, None),
+            (url + '/feed.xml', '"v1"', None),
+            (url + '/missing', None, None),
+            ('ftp://test.org/feed.xml', None, None)])
+
+        assert chunked.content == RSS_DOCUMENT
+        assert (moved.content, moved.headers['content-location']) == (RSS_DOCUMENT, url + '/feed.xml')
+        assert unmodified.status == 304
+        assert isinstance(missing, FeedDataError) and '404' in str(missing)
+        assert isinstance(unsupported, FeedDataError)
+
+    def test_errors(self, keepalive_server):
+        """ Assert that timeouts and refused connections become FeedDataErrors. """
+        self.fetcher.timeout = 0.2
+        slow, refused = self.fetcher.fetch([(keepalive_server.url + '/slow', None, None), ('http://127.0.0.1:1/', None, None)])
+
+        assert isinstance(slow, FeedDataError) and 'Timed out' in str(slow)
+        assert isinstance(refused, FeedDataError)
+
+    def test_stale_connection_retried(self, keepalive_server):
+        """ Assert that a request on a connection the server dropped is retried on a new one. """
+        keepalive_server.close_connections = True
+        self.fetcher.fetch([(keepalive_server.url + '/feed.xml', None, None)])
+        time.sleep(0.1)
+        result, = self.fetcher.fetch([(keepalive_server.url + '/feed.xml', None, None)])
+
+        assert result.content == RSS_DOCUMENT
+        assert len(keepalive_server.connections) == 2
+
+
+class TestEntry(object):
+    """ Tests for the compact Entry model. """
+    def setup(self):
+        self.parsed = FeedParserDict({
+            'id': 'tag:test.org,2001:1',
+            'link': 'http://test.org/story',
+            'title': 'a title',
+            'published_parsed': (2001, 1, 1, 0, 0, 0, 0, 1, 0),
+            'authors': [FeedParserDict({'name': 'Ann Author'})],
+            'content': [FeedParserDict({'value': 'a lot of text'})],
+            'media_thumbnail': [{'url': 'http://test.org/image.png'}]})
+        self.entry = Entry.from_parsed(self.parsed)
+
+    def test_fields(self):
+        """ Assert that Entries are read like Feed Parser entries. """
+        assert self.entry.link == self.entry['link'] == self.entry.get('link') == 'http://test.org/story'
+        assert self.entry.authors == [{'name': 'Ann Author'}]
+        assert type(self.entry.authors[0]) is dict
+        assert self.entry.timestamp == 978307200
+
+        assert 'summary' not in self.entry
+        assert self.entry.get('summary', '') == ''
+        with pytest.raises(KeyError):
+            self.entry['summary']
+
+    def test_unused_fields_dropped(self):
+        """ Assert that only the fields the FeedBot uses are kept. """
+        assert 'content' not in self.entry
+        assert not hasattr(self.entry, '__dict__')
+        with pytest.raises(AttributeError):
+            self.entry.media_thumbnail = []
+
+
+class TestFetch(object):
+    """ Tests for the concurrent fetch stage. """
+    def test_fetch_feeds_keeps_order(self):
+        """ Assert that results come back in the order the Feeds were given. """
+        feeds = [Mock(), Mock(), Mock()]
+        for index, feed in enumerate(feeds):
+            feed.get_filtered_feed.return_value = [index]
+
+        results = fetch_feeds(feeds, workers=3)
+        assert [result.feed for result in results] == feeds
+        assert [result.entries for result in results] == [[0], [1], [2]]
+
+    def test_fetch_feeds_reports_errors(self):
+        """ Assert that a failing Feed doesn't stop the others. """
+        bad_feed, good_feed = Mock(), Mock()
+        bad_feed.get_filtered_feed.side_effect = FeedDataError("foobar")
+        good_feed.get_filtered_feed.return_value = [GOOD_FEED_ENTRY]
+
+        bad_result, good_result = fetch_feeds([bad_feed, good_feed])
+        assert isinstance(bad_result.error, FeedDataError)
+        assert bad_result.entries is None
+        assert good_result.entries == [GOOD_FEED_ENTRY]
+
+    def test_fetch_feeds_timeout(self):
+        """ Assert that a hung Feed is abandoned after the timeout. """
+        hung = threading.Event()
+        slow_feed, fast_feed = Mock(), Mock()
+        slow_feed.get_filtered_feed.side_effect = lambda: hung.wait(5)
+        fast_feed.get_filtered_feed.return_value = []
+
+        slow_result, fast_result = fetch_feeds([slow_feed, fast_feed], workers=2, timeout=0.1)
+        hung.set()
+        assert isinstance(slow_result.error, FetchTimeoutError)
+        assert fast_result.entries == []
+
+
+class TestEntryHistory(object):
+    """ Tests for the bounded EntryHistory. """
+    def test_add(self):
+        """ Assert that keys are remembered once. """
+        history = EntryHistory(maxlen=3)
+        assert history.add('a') is True
+        assert history.add('a') is False
+        assert 'a' in history
+        assert len(history) == 1
+
+    def test_evicts_oldest(self):
+        """ Assert that the oldest key is forgotten once the history is full. """
+        history = EntryHistory(maxlen=3)
+        for key in ['a', 'b', 'c', 'd']:
+            history.add(key)
+
+        assert 'a' not in history
+        assert list(history) == ['b', 'c', 'd']
+
+    def test_persistent_history_survives_restart(self, tmpdir):
+        """ Assert that a PersistentEntryHistory reloads the keys it was given. """
+        path = str(tmpdir.join('feedbot.history'))
+        history = PersistentEntryHistory(path, maxlen=3)
+        for key in ['a', 'b', 'c', 'd']:
+            history.add(key)
+        history.close()
+
+        reloaded = PersistentEntryHistory(path, maxlen=3)
+        assert 'a' not in reloaded
+        assert all(key in reloaded for key in ['b', 'c', 'd'])
+        assert reloaded.add(u'c') is False
+
+    def test_persistent_history_compacts(self, tmpdir):
+        """ Assert that the history file is rewritten once it holds too many records. """
+        path = str(tmpdir.join('feedbot.history'))
+        history = PersistentEntryHistory(path, maxlen=2)
+        for key in ['a', 'b', 'c', 'd', 'e']:
+            history.add(key)
+
+        assert tmpdir.join('feedbot.history').size() == 2 * PersistentEntryHistory.DIGEST_SIZE
+        assert 'd' in history and 'e' in history
+
+    def test_persistent_history_drops_torn_record(self, tmpdir):
+        """ Assert that a partially written record is discarded on load. """
+        path = str(tmpdir.join('feedbot.history'))
+        history = PersistentEntryHistory(path)
+        history.add('a')
+        history.close()
+        tmpdir.join('feedbot.history').write('xyz', mode='ab')
+
+        reloaded = PersistentEntryHistory(path)
+        reloaded.add('b')
+        reloaded.close()
+        assert 'a' in PersistentEntryHistory(path) and 'b' in PersistentEntryHistory(path)
+
+
+class TestPollScheduler(object):
+    """ Tests for the adaptive PollScheduler. """
+    def setup(self):
+        self.scheduler = PollScheduler(min_interval=10, max_interval=100)
+
+    def test_schedule_spreads_feeds(self):
+        """ Assert that new Feeds fall due within the minimum interval. """
+        for name in ['a', 'b', 'c']:
+            self.scheduler.schedule(name, now=0)
+
+        assert self.scheduler.pop_due(now=-1) == []
+        assert sorted(self.scheduler.pop_due(now=10)) == ['a', 'b', 'c']
+        assert self.scheduler.pop_due(now=10) == []
+
+    def test_reschedule_adapts_interval(self):
+        """ Assert that quiet Feeds back off and busy Feeds speed up, within bounds. """
+        self.scheduler.schedule('feed', now=0)
+        self.scheduler.pop_due(now=10)
+
+        self.scheduler.reschedule('feed', 0, now=10)
+        assert self.scheduler.get_interval('feed') == 15
+        assert self.scheduler.pop_due(now=24) == []
+        assert self.scheduler.pop_due(now=25) == ['feed']
+
+        for _ in range(20):
+            self.scheduler.reschedule('feed', 0, now=0)
+        assert self.scheduler.get_interval('feed') == 100
+
+        self.scheduler.reschedule('feed', 3, now=0)
+        assert self.scheduler.get_interval('feed') == 50
+        for _ in range(20):
+            self.scheduler.reschedule('feed', 3, now=0)
+        assert self.scheduler.get_interval('feed') == 10
+
+    def test_reschedule_max_interval(self):
+        """ Assert that a Feed's own maximum interval caps its back-off, but not below the minimum. """
+        self.scheduler.schedule('feed', now=0)
+        for _ in range(20):
+            self.scheduler.reschedule('feed', 0, now=0, max_interval=40)
+        assert self.scheduler.get_interval('feed') == 40
+        self.scheduler.reschedule('feed', 0, now=0, max_interval=1)
+        assert self.scheduler.get_interval('feed') == 10
+
+    def test_unschedule(self):
+        """ Assert that unscheduled Feeds are never returned. """
+        self.scheduler.schedule('feed', now=0)
+        self.scheduler.unschedule('feed')
+        self.scheduler.reschedule('feed', 0, now=0)
+
+        assert 'feed' not in self.scheduler
+        assert self.scheduler.pop_due(now=1000) == []
+
+
+class TestCircuitBreaker(object):
+    """ Tests for the CircuitBreaker. """
+    def setup(self):
+        self.breaker = CircuitBreaker(threshold=2, cooldown=10, max_cooldown=30)
+        self.url = 'http://test.org/feed.xml'
+
+    def test_opens_after_threshold(self):
+        """ Assert that a URL is only skipped once it has failed `threshold` times in a row. """
+        self.breaker.record_failure(self.url, 'boom', now=0)
+        assert self.breaker.allow(self.url, now=0)
+        assert self.breaker.get_health(self.url) == (1, 'boom', None)
+
+        self.breaker.record_failure(self.url, 'boom', now=0)
+        assert not self.breaker.allow(self.url, now=9)
+        assert self.breaker.allow(self.url, now=10)
+
+    def test_one_probe_at_a_time(self):
+        """ Assert that only one attempt is let through once the cool-down has passed. """
+        for _ in range(2):
+            self.breaker.record_failure(self.url, 'boom', now=0)
+        assert self.breaker.allow(self.url, now=10)
+        assert not self.breaker.allow(self.url, now=11)
+
+        self.breaker.record_failure(self.url, 'boom', now=12)
+        assert not self.breaker.allow(self.url, now=31)
+        assert self.breaker.allow(self.url, now=32)
+        # A probe whose outcome is never recorded is given up on after a cool-down.
+        assert not self.breaker.allow(self.url, now=41)
+        assert self.breaker.allow(self.url, now=42)
+
+        self.breaker.record_success(self.url)
+        assert self.breaker.allow(self.url, now=43)
+        assert self.breaker.allow(self.url, now=43)
+
+    def test_cooldown_grows(self):
+        """ Assert that the cool-down doubles with every failure, up to the maximum. """
+        retry_times = []
+        for _ in range(5):
+            self.breaker.record_failure(self.url, 'boom', now=0)
+            retry_times.append(self.breaker.get_health(self.url).retry_at)
+        assert retry_times == [None, 10, 20, 30, 30]
+
+    def test_success_closes(self):
+        """ Assert that a success forgets the failures. """
+        for _ in range(3):
+            self.breaker.record_failure(self.url, 'boom', now=0)
+        self.breaker.record_success(self.url)
+        assert self.breaker.allow(self.url, now=0)
+        assert self.breaker.get_health(self.url) is None
+
+
+class TestEntryRenderer(object):
+    """ Tests for the caching EntryRenderer. """
+    def setup(self):
+        self.renderer = EntryRenderer(maxlen=2)
+        self.entry = FeedParserDict({
+            'link': 'http://test.org/story',
+            'title': 'a title',
+            'published': 'Mon, 01 Jan 2001 00:00:00 GMT',
+            'published_parsed': (now - timedelta(minutes=5)).timetuple(),
+            'summary': 'a summary'})
+
+    @patch('feedbot.render.pub_time_to_string')
+    def test_only_relative_time_is_recomputed(self, pub_time_to_string):
+        """ Assert that a cached entry is rendered again with a fresh publication time. """
+        pub_time_to_string.return_value = '5 minutes ago'
+        first = self.renderer.render(self.entry)
+        self.entry['title'] = 'changed'
+        pub_time_to_string.return_value = '6 minutes ago'
+        second = self.renderer.render(self.entry)
+
+        assert first.index('a title') < first.index('5 minutes ago') < first.index('a summary')
+        assert second == first.replace('5 minutes ago', '6 minutes ago')
+        assert pub_time_to_string.call_count == 2
+
+    def test_lru_eviction(self):
+        """ Assert that the least recently rendered entry is evicted. """
+        entries = [FeedParserDict({'link': 'http://test.org/{0}'.format(index)}) for index in range(3)]
+        self.renderer.render(entries[0])
+        self.renderer.render(entries[1])
+        self.renderer.render(entries[0])
+        self.renderer.render(entries[2])
+
+        assert len(self.renderer) == 2
+        assert self.renderer._cache_key(entries[0]) in self.renderer._cache
+        assert self.renderer._cache_key(entries[1]) not in self.renderer._cache
+
+    def test_uncacheable_entry(self):
+        """ Assert that entries without an id or link are rendered but not cached. """
+        assert 'a title' in self.renderer.render(FeedParserDict({'title': 'a title'}))
+        assert len(self.renderer) == 0
+
+
+class TestMetrics(object):
+    """ Tests for the rolling histograms and the metrics registry. """
+    def setup(self):
+        self.registry = MetricsRegistry(maxlen=100)
+
+    def test_rolling_histogram(self):
+        """ Assert that percentiles are taken over the recent samples, and totals over all of them. """
+        histogram = RollingHistogram(maxlen=100)
+        assert histogram.percentile(50) is None
+        for value in range(1, 201):
+            histogram.observe(value)
+        assert (histogram.percentile(50), histogram.percentile(95), histogram.percentile(100)) == (150, 195, 200)
+        assert (histogram.count, histogram.total) == (200, sum(range(1, 201)))
+
+    def test_labels_and_totals(self):
+        """ Assert that samples go into their labelled histogram and the unlabelled one. """
+        self.registry.observe('parse_seconds', 1, feed='a')
+        self.registry.observe('parse_seconds', 3, feed='b')
+        assert self.registry.percentiles('parse_seconds', feed='a') == (1, 1, 1)
+        assert self.registry.percentiles('parse_seconds') == (1, 3, 2)
+        assert self.registry.percentiles('parse_seconds', feed='c') is None
+        assert sorted(labels['feed'] for labels in self.registry.label_sets('parse_seconds')) == ['a', 'b']
+
+    def test_to_prometheus(self, tmpdir):
+        """ Assert that metrics are written in the Prometheus text format. """
+        self.registry.observe('parse_seconds', 0.5, feed='a "quoted" feed')
+        self.registry.observe('send_seconds', 0.25)
+        self.registry.increment('fetch_bytes_total', 100, feed='a')
+        path = str(tmpdir.join('feedbot.prom'))
+        self.registry.write_prometheus(path)
+
+        lines = open(path).read().splitlines()
+        assert '# TYPE feedbot_parse_seconds summary' in lines
+        assert 'feedbot_parse_seconds{feed="a \\"quoted\\" feed",quantile="0.95"} 0.5' in lines
+        assert 'feedbot_parse_seconds_count{feed="a \\"quoted\\" feed"} 1.0' in lines
+        assert 'feedbot_parse_seconds_count 1.0' not in lines
+        assert 'feedbot_send_seconds_sum 0.25' in lines
+        assert '# TYPE feedbot_fetch_bytes_total counter' in lines
+        assert 'feedbot_fetch_bytes_total{feed="a"} 100.0' in lines
+
+    @patch('feedbot.feed.download')
+    def test_feeds_are_measured(self, mock_download):
+        """ Assert that Feeds record their download, parse and filter measurements. """
+        metrics.registry.reset()
+        mock_download.return_value = Download(200, RSS_DOCUMENT, RSS_HEADERS)
+        feed = Feed('news', 'http://test.org/feed.xml', filters=[NotFilter('foobar')])
+        assert len(feed.get_filtered_feed()) == 1
+
+        for stage in ('fetch_seconds', 'parse_seconds'):
+            assert metrics.registry.percentiles(stage, feed='news')[-1] == 1
+        assert metrics.registry.counter('fetch_bytes_total', feed='news') == len(RSS_DOCUMENT)
+        assert metrics.registry.counter('fetch_responses_total', feed='news', status='200') == 1
+        for outcome, count in [('kept', 1), ('dropped', 1)]:
+            assert metrics.registry.counter(
+                'filter_entries_total', feed='news', filter='NotFilterGroup', outcome=outcome) == count
+
+
+class TestProfileSession(object):
+    """ Tests for the ProfileSession class. """
+    def test_profiles_are_merged(self, tmpdir):
+        """ Assert that work on the bot's thread and background work end up in one summary and file. """
+        session = ProfileSession(10, now=0)
+        assert not session.expired(now=9)
+        assert session.expired(now=10)
+
+        with session.on_bot_thread():
+            sorted(range(10))
+        thread = threading.Thread(target=session.call, args=(json.dumps, {'a': 1}))
+        thread.start()
+        thread.join()
+        assert session.call(len, 'abc') == 3
+
+        path = str(tmpdir.join('feedbot.pstats'))
+        lines = save_and_summarize(session, path)
+        assert os.path.exists(path)
+        summary = '\n'.join(lines)
+        assert 'sorted' in summary
+        assert 'dumps' in summary
+        assert 'len' in summary
+        # Work which finishes after the session has ended is left out.
+        session.call(max, 1, 2)
+        assert 'max' not in '\n'.join(summarize(session.finish()))
+
+    def test_summarize_limit(self):
+        """ Assert that only the functions with the most cumulative time are summarized. """
+        session = ProfileSession(10)
+        with session.on_bot_thread():
+            sorted(range(10))
+            len('abc')
+        lines = summarize(session.finish(), limit=1)
+        assert len(lines) == 1
+        assert 'cumulative' in lines[0]
+
+
+class TestOutbox(object):
+    """ Tests for the rate-limited Outbox. """
+    def test_rate_limit(self):
+        """ Assert that messages are released in bursts and then at the refill rate. """
+        box = outbox.Outbox(rate=2, burst=3, now=0)
+        for index in range(6):
+            box.put(index)
+
+        assert box.pop_ready(now=0) == [0, 1, 2]
+        assert box.pop_ready(now=0.25) == []
+        assert box.pop_ready(now=1) == [3, 4]
+        assert box.pop_ready(now=100) == [5]
+        assert box.pop_ready(now=100) == []
+
+    def test_priority(self):
+        """ Assert that interactive messages go first and order is kept within a priority. """
+        box = outbox.Outbox(rate=1, burst=10, now=0)
+        box.put('story 1', priority=outbox.BULK)
+        box.put('story 2', priority=outbox.BULK)
+        box.put('okay')
+        box.put('help')
+
+        assert box.pop_all() == ['okay', 'help', 'story 1', 'story 2']
+        assert len(box) == 0
+
+
 class TestFeedBot(object):
     """ Tests for the FeedBot class. """
     @patch('feedbot.bot.FeedBot._init_data_dir')  # prevents tests from writing files.
+    @patch('feedbot.bot.FeedBot._load_entry_history')
     @patch('feedbot.bot.FeedBot._load_feed_data')
     @patch('feedbot.bot.FeedBot.connect')
-    def setup(self, Jabberbot, load_data, touch_file_system):
+    def setup(self, Jabberbot, load_data, load_history, touch_file_system):
         load_data.return_value = {}
+        load_history.return_value = EntryHistory()
         self.bot = FeedBot('test chatroom', 'test bot name', 'test bot password', )
         assert not self.bot.feeds, 'Feedbot tests may be accessing real saved data. Exiting!'
+        self.bot.feed_store = Mock()
+        self.bot.parse_processes = 0
 
         self.first_feed = Feed('First-test-Feed', 'http://test.org/fake/rss/feed/url.xml')
         self.not_filter = NotFilter('foobar')
@@ -134,6 +1070,20 @@ class TestFeedBot(object):
         self.feeds = {feed.name: feed for feed in [self.first_feed, self.second_feed]}
         self.bot.feeds = self.feeds
 
+    @patch('feedbot.bot.FeedBot.send')
+    def test_send_queued_messages(self, send):
+        """ Assert that messages are sent from idle_proc, replies ahead of stories. """
+        self.bot.outbox = outbox.Outbox(rate=1, burst=2)
+        self.bot.send_groupchat_message('story', priority=outbox.BULK)
+        self.bot.send_groupchat_message(messages.OKAY)
+        self.bot.send_groupchat_message(messages.SORRY, priority=outbox.BULK)
+        assert not send.called
+
+        self.bot.idle_proc()
+        assert [args[1] for args, _ in send.call_args_list] == [messages.OKAY, 'story']
+        self.bot._send_queued_messages(flush=True)
+        send.assert_called_with('test chatroom', messages.SORRY, message_type='groupchat')
+
     def test_get_feed_urls(self):
         """ Assert that we can get feed URLs from the bot. """
         assert len(self.bot.get_feed_urls()) == 2
@@ -162,6 +1112,23 @@ class TestFeedBot(object):
         EXPECTED_MESSAGE = messages.FEED_EXISTS_ERROR.format(name=feed_name, url=feed_url)
         send_to_channel.assert_called_with(EXPECTED_MESSAGE)
 
+    @patch('feedbot.bot.FeedBot.send_groupchat_message')
+    def test_add_feed_existing_url_spelling(self, send_to_channel):
+        """ Assert that the bot catches URLs which only differ in spelling. """
+        feed_url = self.first_feed.url.replace('http://', 'HTTPS://') + '/'
+        self.bot.add_feed("", "another-name " + feed_url)
+
+        send_to_channel.assert_called_with(messages.FEED_EXISTS_ERROR.format(name='another-name', url=feed_url))
+
+    @patch('feedbot.bot.FeedBot._save_feed_data')
+    @patch('feedbot.bot.FeedBot.send_groupchat_message')
+    def test_remove_feed_by_url_spelling(self, send_to_channel, _save_feed_data):
+        """ Assert that feeds can be removed by another spelling of their URL. """
+        self.bot.remove_feed("", self.second_feed.url.replace('another_test_fake.com', 'Another_Test_Fake.com'))
+
+        send_to_channel.assert_called_with(messages.FEED_DELETED.format(feed_name=self.second_feed.name))
+        assert self.second_feed.name not in self.bot.feeds
+
     @patch('feedbot.bot.Feed')
     @patch('feedbot.bot.FeedBot.send_groupchat_message')
     def test_add_bad_feed(self, send_to_channel, Feed):
@@ -171,9 +1138,11 @@ class TestFeedBot(object):
         mock_feed.get_raw_feed.side_effect = FeedDataError(EXCEPTION_MESSAGE)
         Feed.return_value = mock_feed
         self.bot.add_feed("", "unique-name http://www.valid.url.com")
+        self.bot.executor.drain(wait=True)
 
         EXPECTED_MESSAGE = messages.FEED_PARSE_ERROR.format(error=EXCEPTION_MESSAGE)
         send_to_channel.assert_called_with(EXPECTED_MESSAGE)
+        assert "unique-name" not in self.bot.feeds
 
     @patch('feedbot.bot.Feed')
     @patch('feedbot.bot.FeedBot._save_feed_data')
@@ -182,13 +1151,36 @@ class TestFeedBot(object):
         """ Assert that valid args add a feed to the bot. """
         EXPECTED_FEED_NAME = "unique-name"
         EXPECTED_FEED_URL = "http://www.valid.url.com"
-        Feed.return_value = Mock(name=EXPECTED_FEED_NAME, url=EXPECTED_FEED_URL)
+        Feed.return_value = Mock(url=EXPECTED_FEED_URL)
+        # `name` is a Mock constructor argument, so it has to be set afterwards:
+        Feed.return_value.name = EXPECTED_FEED_NAME
         self.bot.add_feed("", "unique-name http://www.valid.url.com")
+        send_to_channel.assert_called_with(messages.CHECKING_FEED.format(url=EXPECTED_FEED_URL))
+        assert EXPECTED_FEED_NAME not in self.bot.feeds
 
+        self.bot.executor.drain(wait=True)
+        Feed.return_value.get_raw_feed.assert_called_with(None, self.bot.fetch_timeout)
         assert EXPECTED_FEED_NAME in self.bot.feeds
         assert EXPECTED_FEED_URL in self.bot.get_feed_urls()
         send_to_channel.assert_called_with(messages.OKAY)
 
+    def test_save_feed_data_is_debounced(self):
+        """ Assert that changes are journaled and compactions are coalesced. """
+        self.bot.feed_store = Mock()
+        self.bot.feed_store.needs_compaction.return_value = True
+        self.bot.save_delay = 60
+        for index in range(10):
+            self.bot._save_feed_data('remove_feed', name=str(index))
+        self.bot._flush_feed_data()
+
+        assert self.bot.feed_store.record.call_count == 10
+        assert not self.bot.feed_store.start_compaction.called
+
+        self.bot._flush_feed_data(force=True)
+        self.bot._flush_feed_data(force=True)
+        assert self.bot.feed_store.start_compaction.call_count == 1
+        assert self.bot.feed_store.start_compaction.return_value.call_count == 1
+
     @patch('feedbot.bot.FeedBot.send_groupchat_message')
     def test_list_feeds(self, send_to_channel):
         """ Assert that list filters sends the right messages to the channel. """
@@ -256,6 +1248,16 @@ class TestFeedBot(object):
         send_to_channel.assert_called_with(EXPECTED_MESSAGE)
         assert number_of_filters + 1 == len(self.second_feed.filters)
 
+    @patch('feedbot.bot.FeedBot.send_groupchat_message')
+    def test_save_error_skips_confirmation(self, send_to_channel):
+        """ Assert that a change which can't be saved is reported, and not confirmed. """
+        self.bot.feed_store.record.side_effect = IOError("disc full")
+        with pytest.raises(IOError):
+            self.bot.add_filter("", "{0} not: bar".format(self.second_feed.name))
+
+        message = send_to_channel.call_args[0][0]
+        assert message == messages.FEED_SAVE_DATA_ERROR.format(error="disc full", data_path=self.bot.data_file)
+
     def test_get_feeds(self):
         """ Assert that we can get the feed instances. """
         assert self.bot.get_feeds() == self.feeds.values()
@@ -300,6 +1302,351 @@ class TestFeedBot(object):
         assert self.not_filter not in self.first_feed.get_filters()
         send_to_channel.assert_called_with(EXPECTED_MESSAGE)
 
+    @patch('feedbot.bot.FeedBot._print_feed')
+    @patch('feedbot.bot.FeedBot.send_groupchat_message')
+    def test_dump_all(self, send_to_channel, print_feed):
+        """ Assert that dump_all prints every feed in name order. """
+        entry = FeedParserDict({'link': 'http://test.org/story', 'title': 'a title'})
+        self.first_feed.iter_filtered_entries = Mock(return_value=iter([entry]))
+        self.second_feed.iter_filtered_entries = Mock(side_effect=FeedDataError("foobar"))
+        self.bot.dump_all("", "")
+        send_to_channel.assert_called_with(messages.FETCHING_FEEDS)
+        self.bot.executor.drain(wait=True)
+
+        print_feed.assert_called_once_with(self.first_feed.name, [entry], footer=messages.FEED_SEPERATOR)
+        EXPECTED_MESSAGE = messages.FEED_FETCH_ERROR.format(feed_name=self.second_feed.name, error="foobar")
+        send_to_channel.assert_any_call(EXPECTED_MESSAGE + messages.NEWLINE + messages.FEED_SEPERATOR, priority=outbox.BULK)
+
+    @patch('feedbot.bot.time_until', Mock(return_value='soon'))
+    @patch('feedbot.bot.FeedBot._print_feed')
+    @patch('feedbot.bot.FeedBot.send_groupchat_message')
+    def test_dump_all_skips_failing_feeds(self, send_to_channel, print_feed):
+        """ Assert that feeds which keep failing are skipped until their cool-down is over. """
+        self.bot.breaker = CircuitBreaker(threshold=2, cooldown=60)
+        self.second_feed.iter_filtered_entries = Mock(side_effect=FeedDataError("foobar"))
+        self.first_feed.iter_filtered_entries = Mock(return_value=iter([]))
+        for _ in range(2):
+            self.bot.dump_all("", "")
+            self.bot.executor.drain(wait=True)
+        assert self.second_feed.iter_filtered_entries.call_count == 2
+
+        self.bot.dump_all("", "")
+        self.bot.executor.drain(wait=True)
+        assert self.second_feed.iter_filtered_entries.call_count == 2
+        send_to_channel.assert_any_call(messages.FEED_SUSPENDED.format(
+            feed_name=self.second_feed.name, failures=2, retry='soon'), priority=outbox.BULK)
+
+        send_to_channel.reset_mock()
+        self.bot.list_feeds("", "")
+        send_to_channel.assert_any_call(
+            messages.FEED_FAILING.format(failures=2, error='foobar') +
+            messages.FEED_FAILING_RETRY.format(retry='soon'))
+
+    @patch('feedbot.bot.FeedBot.send_groupchat_message')
+    def test_stats(self, send_to_channel):
+        """ Assert that /stats summarizes the stages, the slowest feeds and the slowest filters. """
+        metrics.registry.reset()
+        self.bot.stats("", "")
+        send_to_channel.assert_called_with(messages.NO_STATS)
+
+        metrics.registry.observe('fetch_seconds', 0.5, feed=self.first_feed.name)
+        metrics.registry.observe('fetch_seconds', 2, feed=self.second_feed.name)
+        metrics.record_filter_stats(self.first_feed.name, {'NotFilterGroup': [0.001, 3, 1]})
+        self.bot.stats("", "")
+        report = send_to_channel.call_args[0][0].split('\n')
+        assert messages.STATS_STAGE.format(stage='fetch', p50='500.0ms', p95='2.00s', count=2) in report
+        slowest = report.index(messages.STATS_SLOWEST_FEEDS)
+        assert report[slowest + 1:slowest + 3] == [
+            messages.STATS_ITEM.format(name=self.second_feed.name, value='2.00s'),
+            messages.STATS_ITEM.format(name=self.first_feed.name, value='500.0ms')]
+        assert report[-1] == messages.STATS_FILTER.format(
+            feed=self.first_feed.name, filter='NotFilterGroup', p50='1.0ms', p95='1.0ms', kept=3, dropped=1)
+
+        self.bot.stats("", self.second_feed.name)
+        report = send_to_channel.call_args[0][0].split('\n')
+        assert report == [
+            messages.STATS_HEADER, messages.STATS_STAGE.format(stage='fetch', p50='2.00s', p95='2.00s', count=1)]
+
+    def test_is_admin(self):
+        """ Assert that admins are recognized by their real JID, never by their nickname. """
+        self.bot.admins = set(['admin@example.com'])
+        self.add_room('room@conference.example.com')
+
+        def presence(nickname, jid=None, typ=None):
+            stanza = Presence(frm='room@conference.example.com/' + nickname, typ=typ)
+            if jid:
+                stanza.setTag('x', namespace=NS_MUC_USER).setTag('item', {'jid': jid, 'role': 'participant'})
+            return stanza
+
+        def message(nickname, typ='groupchat'):
+            return Message(frm='room@conference.example.com/' + nickname, typ=typ)
+
+        self.bot.callback_presence(None, presence('admin@example.com', 'mallory@example.com/phone'))
+        self.bot.callback_presence(None, presence('anonymous'))
+        self.bot.callback_presence(None, presence('boss', 'admin@example.com/laptop'))
+        assert not self.bot._is_admin(message('admin@example.com'))
+        assert not self.bot._is_admin(message('anonymous'))
+        assert self.bot._is_admin(message('boss'))
+        assert self.bot._is_admin(message('boss', typ='chat'))
+        assert self.bot._is_admin(Message(frm='admin@example.com/laptop', typ='chat'))
+
+        self.bot.callback_presence(None, presence('boss', 'admin@example.com/laptop', typ='unavailable'))
+        assert not self.bot._is_admin(message('boss'))
+
+    @patch('feedbot.bot.FeedBot.send_groupchat_message')
+    def test_profile(self, send_to_channel, tmpdir):
+        """ Assert that only admins can /profile, and that the results are saved and posted. """
+        self.bot.admins = set(['admin@example.com'])
+        self.bot.rooms[self.bot.chatroom].data_file = str(tmpdir.join('feedbot.json'))
+        self.bot.profile(Message(frm='someone@example.com/laptop', typ='chat'), "10")
+        send_to_channel.assert_called_with(messages.ADMINS_ONLY)
+        assert self.bot.profile_session is None
+
+        mess = Message(frm='admin@example.com/laptop', typ='chat')
+        self.bot.profile(mess, "forever")
+        send_to_channel.assert_called_with(messages.PROFILE_HELP.format(max_seconds=600))
+        self.bot.profile(mess, "10")
+        send_to_channel.assert_called_with(messages.PROFILE_STARTED.format(seconds=10))
+        self.bot.profile(mess, "10")
+        send_to_channel.assert_called_with(messages.PROFILE_RUNNING)
+
+        session = self.bot.profile_session
+        with self.bot._profiling():
+            self.bot.list_feeds(None, "")
+        session.ends_at = 0
+        with patch('feedbot.bot.JabberBot.idle_proc'):
+            self.bot.idle_proc()
+            assert self.bot.profile_session is None
+            self.bot.executor.drain(wait=True)
+
+        saved = tmpdir.listdir(lambda path: path.ext == '.pstats')
+        assert len(saved) == 1
+        report = send_to_channel.call_args[0][0].split('\n')
+        assert report[0] == messages.PROFILE_HEADER.format(path=str(saved[0]))
+        assert any('list_feeds' in line for line in report[1:])
+
+    @patch('feedbot.bot.FeedBot.send_groupchat_message')
+    def test_print_feed(self, send_to_channel):
+        """ Assert that a Feed is printed as one message. """
+        entries = [FeedParserDict({'link': 'http://test.org/{0}'.format(index), 'title': 'a title'}) for index in range(5)]
+        self.bot._print_feed(self.first_feed.name, entries, footer=messages.FEED_SEPERATOR)
+
+        assert send_to_channel.call_count == 1
+        message = send_to_channel.call_args[0][0]
+        assert message.startswith(messages.FEED_HEADER.format(feed_name=self.first_feed.name))
+        assert message.endswith(messages.FEED_SEPERATOR)
+        assert all(entry.link in message for entry in entries)
+
+    def test_history_keys(self, tmpdir):
+        """ Assert that entries are remembered by id or link, and entries with neither are skipped. """
+        self.bot.entry_history = PersistentEntryHistory(str(tmpdir.join('history')))
+        self.bot.entry_history.add('http://test.org/legacy')
+        entries = [
+            Entry(id='tag:test.org,2016:1', title='no link'),
+            Entry(title='no id or link'),
+            Entry(id='tag:test.org,2016:2', link='http://test.org/legacy'),
+        ]
+        self.first_feed.iter_filtered_entries = Mock(return_value=iter(entries))
+        assert self.bot._get_unseen_entries(self.first_feed, 5) == entries[:1]
+
+        self.bot._add_entry_to_history(entries[0])
+        self.bot._add_entry_to_history(entries[1])
+        assert self.bot._seen_entry(entries[0])
+        assert len(self.bot.entry_history) == 2
+
+    @patch('feedbot.bot.FeedBot.send_groupchat_message')
+    def test_send_coalesced(self, send_to_channel):
+        """ Assert that messages are split between parts once they reach the maximum stanza size. """
+        self.bot.max_stanza_size = 10
+        self.bot._send_coalesced(['aaaa', 'bbbb', 'cc', 'dddddddddddd', u'\xe9\xe9\xe9'])
+
+        assert [args[0] for args, _ in send_to_channel.call_args_list] == [
+            'aaaabbbbcc', 'dddddddddddd', u'\xe9\xe9\xe9']
+
+    @patch('feedbot.bot.FeedBot._print_feed')
+    @patch('feedbot.bot.FeedBot.send_groupchat_message')
+    def test_dump_feed(self, send_to_channel, print_feed):
+        """ Assert that dump_feed answers right away and posts stories from idle_proc. """
+        entry = FeedParserDict({'link': 'http://test.org/story', 'title': 'a title'})
+        fetched = threading.Event()
+        self.first_feed.iter_filtered_entries = Mock(side_effect=lambda **kwargs: fetched.wait(5) and iter([entry]))
+        self.bot.dump_feed("", self.first_feed.name)
+
+        send_to_channel.assert_called_with(messages.FETCHING_FEEDS)
+        assert not print_feed.called
+
+        fetched.set()
+        for _ in range(50):
+            self.bot.idle_proc()
+            if print_feed.called:
+                break
+            time.sleep(0.1)
+        print_feed.assert_called_once_with(self.first_feed.name, [entry], footer='')
+
+    @patch('feedbot.feed.download')
+    def test_get_unseen_entries_in_process_pool(self, download):
+        """ Assert that Feeds parsed in the process pool keep their filters, and are filtered lazily. """
+        items = ''.join(
+            '<item><title>{0}</title><link>http://test.org/{0}</link><pubDate>{1}</pubDate></item>'.format(
+                title, formatdate(time.time() - age, usegmt=True))
+            for title, age in [('recent', 3600), ('foobar', 3600), ('later', 7200), ('stale', 3 * 86400)])
+        download.return_value = Download(200, '<rss version="2.0"><channel>{0}</channel></rss>'.format(items), RSS_HEADERS)
+        feed = Feed('aged', 'http://test.org/aged.xml', filters=[AgeFilter(minutes=2880), NotFilter('foobar')])
+        self.bot.feeds = {feed.name: feed}
+        self.bot.parse_processes = 1
+        pool = self.bot._get_parse_pool()
+        try:
+            entries = self.bot._get_unseen_entries(feed, 5, pool)
+            assert [entry.link for entry in entries] == ['http://test.org/recent', 'http://test.org/later']
+            download.assert_called_with(feed.url, etag=None, modified=None, timeout=self.bot.fetch_timeout)
+
+            pipeline = feed._get_filter_pipeline()
+            with patch.object(feed, '_accept_entry', wraps=feed._accept_entry) as accept_entry:
+                assert self.bot._get_unseen_entries(feed, 1, pool) == entries[:1]
+            assert accept_entry.call_count == 1
+            assert feed._get_filter_pipeline() is pipeline
+        finally:
+            pool.terminate()
+
+    def test_fetch_unseen_entries_async(self, keepalive_server):
+        """ Assert that the async backend downloads feeds and parses them on the fetch threads. """
+        self.bot.async_fetcher = AsyncFetcher()
+        good_feed = Feed('good', keepalive_server.url + '/feed.xml', filters=[NotFilter('foobar')])
+        missing_feed = Feed('missing', keepalive_server.url + '/missing')
+        try:
+            good, missing = self.bot._fetch_unseen_entries([good_feed, missing_feed], 5)
+        finally:
+            self.bot.async_fetcher.close()
+
+        assert [entry.link for entry in good.entries] == ['http://test.org/good']
+        assert good_feed.etag == '"v1"'
+        assert isinstance(missing.error, FeedDataError)
+
+    def add_room(self, jid):
+        """ Serve another chatroom, without joining it or touching the file system. """
+        room = Room(jid)
+        room.entry_history = EntryHistory()
+        room.feed_store = Mock()
+        room.poller = PollScheduler()
+        self.bot.rooms[jid] = room
+        return room
+
+    @patch('feedbot.feed.download')
+    def test_fetch_unseen_entries_fans_out(self, mock_download):
+        """ Assert that a URL followed in several rooms is fetched once, and filtered with each room's filters and history. """
+        mock_download.return_value = Download(200, RSS_DOCUMENT, RSS_HEADERS)
+        other_room = self.add_room('other chatroom')
+        other_room.entry_history.add('http://test.org/good')
+        filtered_feed = Feed('news', 'http://test.org/feed.xml', filters=[NotFilter('foobar')])
+        unfiltered_feed = Feed('news', 'http://test.org/feed.xml')
+
+        filtered, unfiltered = self.bot._fetch_unseen_entries(
+            [filtered_feed, unfiltered_feed], 5, rooms=[self.bot.room, other_room])
+
+        assert mock_download.call_count == 1
+        assert [entry.link for entry in filtered.entries] == ['http://test.org/good']
+        assert [entry.link for entry in unfiltered.entries] == ['http://test.org/bad']
+
+    @patch('feedbot.bot.FeedBot.send')
+    @patch('feedbot.feed.download')
+    def test_poll_feeds_in_many_rooms(self, mock_download, send):
+        """ Assert that a due URL is polled in every room which follows it, and stories go to each room. """
+        mock_download.return_value = Download(200, RSS_DOCUMENT, RSS_HEADERS)
+        other_room = self.add_room('other chatroom')
+        other_room.feeds = {'news': Feed('news', self.first_feed.url)}
+        other_room.poller.schedule('news', now=time.time() + 3600)
+        self.bot.feeds = {self.first_feed.name: self.first_feed}
+        self.bot.poller.schedule(self.first_feed.name, now=0)
+
+        self.bot._poll_feeds()
+        self.bot.executor.drain(wait=True)
+        self.bot._send_queued_messages(flush=True)
+
+        assert mock_download.call_count == 1
+        stories = dict((args[0], args[1]) for args, _ in send.call_args_list)
+        assert 'http://test.org/bad' not in stories['test chatroom']
+        assert 'http://test.org/bad' in stories['other chatroom']
+        assert 'http://test.org/good' in other_room.entry_history
+        assert other_room.poller.get_interval('news') == other_room.poller.min_interval
+
+    @patch('feedbot.bot.FeedBot._print_feed')
+    @patch('feedbot.bot.FeedBot._fetch_unseen_entries')
+    def test_poll_results_are_handled_one_by_one(self, fetch_unseen_entries, print_feed):
+        """ Assert that a poll result which can't be handled, or whose room was left, doesn't strand the others. """
+        fetch_unseen_entries.side_effect = lambda feeds, *args: [
+            FetchResult(feed, [Entry(link=feed.url + '/story')], None) for feed in feeds]
+        print_feed.side_effect = IOError("history closed")
+        self.bot.feeds = {}
+        rooms = [self.add_room(jid) for jid in ['room1', 'room2', 'room3']]
+        for index, room in enumerate(rooms):
+            room.feeds = {'feed': Feed('feed', 'http://test.org/{0}.xml'.format(index))}
+            room.poller.schedule('feed', now=0)
+
+        self.bot._poll_feeds()
+        del self.bot.rooms['room2']
+        self.bot.executor.drain(wait=True)
+
+        assert print_feed.call_count == 2
+        for room in [rooms[0], rooms[2]]:
+            assert not room.polls_in_flight
+            assert 'feed' in room.poller
+
+    def test_room_for_message(self):
+        """ Assert that commands are served in the room they were sent from. """
+        other_room = self.add_room('other chatroom')
+        message = Mock()
+        message.getType.return_value = 'groupchat'
+        message.getFrom.return_value.getStripped.return_value = 'other chatroom'
+        assert self.bot._room_for(message) is other_room
+
+        message.getType.return_value = 'chat'
+        assert self.bot._room_for(message) is self.bot.rooms['test chatroom']
+        assert self.bot._room_for('') is self.bot.rooms['test chatroom']
+
+    def test_get_unseen_entries(self):
+        """ Assert that only as many entries as needed are filtered. """
+        entries = [FeedParserDict({'link': 'http://test.org/{0}'.format(index), 'title': 'a title'}) for index in range(10)]
+        self.bot._add_entry_to_history(entries[0])
+        self.first_feed._download = Mock()
+        self.first_feed.entries_from_response = Mock(return_value=entries)
+        self.first_feed._accept_entry = Mock(return_value=True)
+
+        assert self.bot._get_unseen_entries(self.first_feed, 3) == entries[1:4]
+        assert self.first_feed._accept_entry.call_count == 4
+
+    @patch('feedbot.bot.FeedBot._print_feed')
+    def test_poll_feeds(self, print_feed):
+        """ Assert that due feeds are polled and only unseen entries are posted. """
+        seen_entry = FeedParserDict({'link': 'http://test.org/old', 'title': 'old'})
+        new_entry = FeedParserDict({'link': 'http://test.org/new', 'title': 'new'})
+        self.bot._add_entry_to_history(seen_entry)
+        self.first_feed.iter_filtered_entries = Mock(return_value=iter([new_entry, seen_entry]))
+        self.bot.poller.schedule(self.first_feed.name, now=0)
+
+        self.bot._poll_feeds()
+        self.bot.executor.drain(wait=True)
+
+        print_feed.assert_called_once_with(self.first_feed.name, [new_entry])
+        assert self.bot.poller.get_interval(self.first_feed.name) == self.bot.poller.min_interval
+        assert self.first_feed.name in self.bot.poller
+
+    @patch('feedbot.bot.FeedBot._print_feed')
+    def test_poll_interval_follows_publishing(self, print_feed):
+        """ Assert that polls adapt to the entries a Feed publishes, even if they're all filtered out. """
+        feed = Feed('aged', 'http://test.org/aged.xml', filters=[AgeFilter(minutes=90)])
+        self.bot.feeds = {feed.name: feed}
+        self.bot.poller.schedule(feed.name)
+        for _ in range(20):
+            self.bot._feed_polled(feed, [], None)
+        assert self.bot.poller.get_interval(feed.name) == 45 * 60
+
+        feed._last_entries = [Entry(link='http://test.org/{0}'.format(index)) for index in range(3)]
+        self.bot._feed_polled(feed, [], None)
+        assert self.bot.poller.get_interval(feed.name) == 45 * 60 / 2
+        self.bot._feed_polled(feed, [], None)
+        assert self.bot.poller.get_interval(feed.name) == 45 * 60 / 2 * 1.5
+        assert not print_feed.called
+
     @patch('feedbot.bot.FeedBot._save_feed_data')
     @patch('feedbot.bot.FeedBot.send_groupchat_message')
     def test_set_age_filter(self, send_to_channel, _save_feed_data):
@@ -313,6 +1660,175 @@ class TestFeedBot(object):
         assert expected_age_filter[0].get_window() == MINUTES
 
 
+class TestJsonFeedStore(TestSetupMixin, object):
+    """ Tests for the snapshot and journal JsonFeedStore. """
+    def make_store(self, tmpdir, compact_threshold=500):
+        data_file = tmpdir.join('feedbot.conf')
+        data_file.ensure()
+        return JsonFeedStore(str(data_file), compact_threshold=compact_threshold)
+
+    def test_load_legacy_snapshot(self, tmpdir):
+        """ Assert that a bare list of Feeds, the old format, is loaded. """
+        tmpdir.join('feedbot.conf').write(json.dumps([self.feed.to_dict()]))
+        feeds = self.make_store(tmpdir).load()
+        assert feeds.keys() == [self.feed_name]
+
+    def test_journal_replay(self, tmpdir):
+        """ Assert that journaled changes are replayed on top of the snapshot. """
+        store = self.make_store(tmpdir)
+        assert store.load() == {}
+        store.record('add_feed', feed=self.feed.to_dict())
+        store.record('add_filter', name=self.feed_name, filter=NotFilter('bad juju').to_dict())
+        store.record('remove_filter', name=self.feed_name, index=0)
+        store.record('set_age_filter', name=self.feed_name, minutes=10)
+        store.close()
+
+        feed = self.make_store(tmpdir).load()[self.feed_name]
+        assert [str(feed_filter) for feed_filter in feed.filters] == [
+            "NotFilter('foobar')", "NotFilter('bad juju')", "AgeFilter(0:10:00)"]
+
+    def test_compaction(self, tmpdir):
+        """ Assert that compaction replaces the journal without losing changes. """
+        store = self.make_store(tmpdir, compact_threshold=2)
+        feeds = store.load()
+        for name in ['a', 'b']:
+            feeds[name] = Feed(name, 'http://test.org/' + name)
+            store.record('add_feed', feed=feeds[name].to_dict())
+        assert store.needs_compaction()
+
+        compact = store.start_compaction(feeds.values())
+        assert not store.needs_compaction()
+        # Changes made while the snapshot is being written go to a new journal.
+        del feeds['a']
+        store.record('remove_feed', name='a')
+        compact()
+        store.close()
+
+        assert sorted(path.basename for path in tmpdir.listdir()) == ['feedbot.conf', 'feedbot.conf.journal']
+        assert self.make_store(tmpdir).load().keys() == ['b']
+
+    def test_overlapping_compactions(self, tmpdir):
+        """ Assert that a compaction which finishes after a later one doesn't undo it. """
+        store = self.make_store(tmpdir)
+        feeds = store.load()
+        compactions = []
+        for name in ['a', 'b']:
+            feeds[name] = Feed(name, 'http://test.org/' + name)
+            store.record('add_feed', feed=feeds[name].to_dict())
+            compactions.append(store.start_compaction(feeds.values()))
+        compactions[1]()
+        compactions[0]()
+        store.close()
+
+        assert sorted(self.make_store(tmpdir).load()) == ['a', 'b']
+
+    def test_interrupted_compaction(self, tmpdir):
+        """ Assert that a set aside journal isn't replayed twice after a crash. """
+        store = self.make_store(tmpdir)
+        feeds = store.load()
+        store.record('add_feed', feed=self.feed.to_dict())
+        store.record('add_filter', name=self.feed_name, filter=NotFilter('bad juju').to_dict())
+        feeds = self.make_store(tmpdir).load()
+        store.start_compaction(feeds.values())
+        # Simulate a crash after writing the snapshot but before cleaning up.
+        atomic_write(store.path, json.dumps({'journal_sequence': 2, 'feeds': [feeds[self.feed_name].to_dict()]}))
+
+        feed = self.make_store(tmpdir).load()[self.feed_name]
+        assert len(feed.filters) == 3
+
+    def test_torn_journal_line(self, tmpdir):
+        """ Assert that a half-written change is dropped and later changes survive. """
+        store = self.make_store(tmpdir)
+        store.load()
+        store.record('add_feed', feed=self.feed.to_dict())
+        store.close()
+        tmpdir.join('feedbot.conf.journal').write('{"op": "remove_fe', mode='a')
+
+        store = self.make_store(tmpdir)
+        assert store.load().keys() == [self.feed_name]
+        store.record('add_filter', name=self.feed_name, filter=NotFilter('bad juju').to_dict())
+        store.close()
+        assert len(self.make_store(tmpdir).load()[self.feed_name].filters) == 3
+
+    def test_atomic_write(self, tmpdir):
+        """ Assert that files are replaced rather than overwritten in place. """
+        data_file = tmpdir.join('feedbot.conf')
+        data_file.write('x' * 10000)
+        atomic_write(str(data_file), '[]')
+
+        assert data_file.read() == '[]'
+        assert tmpdir.listdir() == [data_file]
+
+
+class TestSqliteFeedStore(TestSetupMixin, object):
+    """ Tests for the SQLite storage backend. """
+    def make_store(self, tmpdir, **kwargs):
+        return SqliteFeedStore(str(tmpdir.join('feedbot.sqlite')), **kwargs)
+
+    def test_changes_persist(self, tmpdir):
+        """ Assert that recorded changes survive reopening the database. """
+        store = self.make_store(tmpdir)
+        assert store.load() == {}
+        store.record('add_feed', feed=self.feed.to_dict())
+        store.record('add_feed', feed=Feed('other', 'http://test.org/other').to_dict())
+        store.record('add_filter', name=self.feed_name, filter=NotFilter('bad juju').to_dict())
+        store.record('remove_filter', name=self.feed_name, index=0)
+        store.record('remove_feed', name='other')
+        store.close()
+
+        feeds = self.make_store(tmpdir).load()
+        assert feeds.keys() == [self.feed_name]
+        assert [str(feed_filter) for feed_filter in feeds[self.feed_name].filters] == [
+            "NotFilter('foobar')", "NotFilter('bad juju')"]
+
+    def test_fetch_state(self, tmpdir):
+        """ Assert that validators and fetch statistics are saved. """
+        store = self.make_store(tmpdir)
+        store.load()
+        store.record('add_feed', feed=self.feed.to_dict())
+        self.feed.etag = 'abc'
+        store.save_fetch_state(self.feed, new_entries=2, poll_interval=60)
+        store.save_fetch_state(self.feed, new_entries=1)
+
+        assert store.load()[self.feed_name].etag == 'abc'
+        stats = store.get_feed_stats(self.feed_name)
+        assert (stats['fetches'], stats['new_entries'], stats['poll_interval']) == (2, 3, 60)
+
+        store.record('remove_feed', name=self.feed_name)
+        assert store.get_feed_stats(self.feed_name) is None
+
+    def test_import_json(self, tmpdir):
+        """ Assert that the JSON store's feeds and history are imported once. """
+        json_path = str(tmpdir.join('feedbot.conf'))
+        history_path = str(tmpdir.join('feedbot.history'))
+        tmpdir.join('feedbot.conf').write(json.dumps([self.feed.to_dict()]))
+        history = PersistentEntryHistory(history_path)
+        history.add('http://test.org/story')
+        history.close()
+
+        store = self.make_store(tmpdir, import_path=json_path, import_history_path=history_path)
+        assert store.load().keys() == [self.feed_name]
+        assert 'http://test.org/story' in store.open_history(200)
+
+        store.record('remove_feed', name=self.feed_name)
+        assert store.load() == {}
+
+    def test_history(self, tmpdir):
+        """ Assert that the history is bounded and survives reopening the database. """
+        store = self.make_store(tmpdir)
+        history = store.open_history(2)
+        for key in ['a', 'b', 'c']:
+            history.add(key)
+        assert history.add('c') is False
+        store.close()
+
+        store = self.make_store(tmpdir)
+        history = store.open_history(2)
+        assert 'a' not in history
+        assert 'b' in history and 'c' in history
+        assert store.connection.execute('SELECT COUNT(*) FROM history').fetchone()[0] == 2
+
+
 def filter_list_sorter(feed_filter):
     """ Provide a key to sort a list of feed filters. """
     return feed_filter['class']
@@ -390,3 +1906,11 @@ class TestSerialization(TestSetupMixin, object):
         actual_feed_filters = feed.filters
         assert NotFilter in [type(feed_filter) for feed_filter in actual_feed_filters]
         assert AgeFilter in [type(feed_filter) for feed_filter in actual_feed_filters]
+
+    def test_feed_validators_round_trip(self):
+        """ Assert that a Feed's HTTP validators survive serialization. """
+        self.feed.etag = '"abc"'
+        self.feed.modified = 'Wed, 27 May 2015 10:00:00 GMT'
+        feed = Feed.from_dict(self.feed.to_dict())
+        assert feed.etag == self.feed.etag
+        assert feed.modified == self.feed.modified
@@ -0,0 +1,45 @@
+""" Time helpers shared by the FeedBot, Feeds and Filters. """
+
+from __future__ import absolute_import
+from datetime import datetime
+import time
+
+import humanize
+from pytz import utc
+
+
+def utc_now():
+    """
+    Return a timezone-aware datetime object, representing this instant in time.
+
+    The timezone of the object will be UTC.
+    """
+    return utc.localize(datetime.now())
+
+
+def struct_to_datetime(time_struct):
+    """
+    Given a time.struct_time instance, return a datetime.datetime instance.
+
+    See Also:
+        http://stackoverflow.com/a/1697838/2557196
+        https://docs.python.org/2/library/time.html#time.struct_time
+    """
+    return utc.localize(datetime(*time_struct[:6]))
+
+
+def time_delta_from_now(prev_time):
+    """ Given a time `then`, returns the difference between `now` and `then`. """
+    return utc_now() - prev_time
+
+
+def pub_time_to_string(time_struct):
+    """ Given a time_struct, return a humanized string representing the elapsed time. """
+    publication_time = struct_to_datetime(time_struct)
+    delta = time_delta_from_now(publication_time)
+    return humanize.naturaltime(delta).capitalize()
+
+
+def time_until(timestamp):
+    """ Given seconds since the epoch, return a humanized string of the time left until then, eg: 'in 5 minutes'. """
+    return 'in ' + humanize.naturaldelta(max(0, timestamp - time.time()))